@@ -0,0 +1,77 @@
+"""Throughput of outbound calls with a fresh client per call vs the shared pool.
+
+Run with `python -m benchmarks.bench_http_client`. A minimal keep-alive HTTP/1.1
+stub server runs locally; each strategy sends the same number of concurrent
+POSTs to it. Against real APIs the gap is wider, as every fresh client also
+pays for a TLS handshake.
+"""
+import asyncio
+import os
+import time
+
+os.environ.setdefault("ENV_STATE", "test")
+
+import httpx  # noqa: E402
+from storeapi.tasks import create_http_client  # noqa: E402
+
+REQUESTS = 2000
+CONCURRENCY = 20
+
+
+async def handle_connection(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            length = 0
+            for line in head.split(b"\r\n"):
+                if line.lower().startswith(b"content-length:"):
+                    length = int(line.split(b":")[1])
+            await reader.readexactly(length)
+            writer.write(
+                b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                b"Content-Length: 2\r\n\r\n{}"
+            )
+            await writer.drain()
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def run(send) -> float:
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+
+    async def limited():
+        async with semaphore:
+            response = await send()
+            response.raise_for_status()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(limited() for _ in range(REQUESTS)))
+    return REQUESTS / (time.perf_counter() - start)
+
+
+async def main():
+    server = await asyncio.start_server(handle_connection, "127.0.0.1", 0)
+    host, port = server.sockets[0].getsockname()[:2]
+    base_url = f"http://{host}:{port}"
+
+    async def fresh_client():
+        async with httpx.AsyncClient() as client:
+            return await client.post(f"{base_url}/messages", data={"to": "a"})
+
+    pooled = create_http_client(base_url)
+
+    async def shared_client():
+        return await pooled.post("/messages", data={"to": "a"})
+
+    print(f"fresh client per call: {await run(fresh_client):8.0f} req/s")
+    print(f"shared pooled client:  {await run(shared_client):8.0f} req/s")
+
+    await pooled.aclose()
+    server.close()
+    await server.wait_closed()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,104 @@
+"""Per-page latency of GET /post as the posts table grows.
+
+Run with `python -m benchmarks.bench_pagination`. Each table size is seeded into
+a throwaway SQLite database, then the first page and a page 500 posts deep are
+timed for every sorting. With keyset pagination the deep page costs the same as
+the first one, instead of growing with its offset.
+"""
+import asyncio
+import collections
+import os
+import random
+import tempfile
+import time
+
+os.environ["ENV_STATE"] = "test"
+os.environ["TEST_DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/bench_pagination.db"
+os.environ["TEST_DB_FORCE_ROLL_BACK"] = "false"
+# Measure the queries, not the response cache
+os.environ["TEST_RESPONSE_CACHE_ENABLED"] = "false"
+
+from httpx import AsyncClient  # noqa: E402
+from storeapi.database import (  # noqa: E402
+    database,
+    engine,
+    like_table,
+    post_table,
+    user_table,
+)
+from storeapi.main import app  # noqa: E402
+
+TABLE_SIZES = [1_000, 10_000, 100_000]
+PAGE_SIZE = 20
+REPEATS = 20
+
+
+def seed(total_posts: int):
+    # A user can like a post only once, so each like comes from its own user
+    likes = [
+        {"post_id": random.randint(1, total_posts), "user_id": user_id}
+        for user_id in range(1, total_posts + 1)
+    ]
+    like_counts = collections.Counter(like["post_id"] for like in likes)
+    with engine.begin() as conn:
+        conn.execute(like_table.delete())
+        conn.execute(post_table.delete())
+        conn.execute(user_table.delete())
+        conn.execute(
+            user_table.insert(),
+            [
+                {"id": user_id, "email": f"bench{user_id}@example.net"}
+                for user_id in range(1, total_posts + 1)
+            ],
+        )
+        conn.execute(
+            post_table.insert(),
+            [
+                {
+                    "id": i,
+                    "body": f"Post {i}",
+                    "user_id": 1,
+                    "like_count": like_counts[i],
+                }
+                for i in range(1, total_posts + 1)
+            ],
+        )
+        conn.execute(like_table.insert(), likes)
+
+
+async def time_page(client: AsyncClient, params: dict) -> float:
+    start = time.perf_counter()
+    for _ in range(REPEATS):
+        response = await client.get("/post", params=params)
+        response.raise_for_status()
+    return (time.perf_counter() - start) / REPEATS * 1000
+
+
+async def deep_cursor(client: AsyncClient, sorting: str, pages: int) -> str:
+    params = {"sorting": sorting, "limit": 100}
+    for _ in range(pages):
+        response = await client.get("/post", params=params)
+        params["cursor"] = response.headers["X-Next-Cursor"]
+    return params["cursor"]
+
+
+async def main():
+    await database.connect()
+    async with AsyncClient(app=app, base_url="http://bench") as client:
+        print(f"{'posts':>8} {'sorting':>11} {'first page':>12} {'page 500+':>12}")
+        for size in TABLE_SIZES:
+            seed(size)
+            for sorting in ("new", "old", "most_likes"):
+                first = await time_page(
+                    client, {"sorting": sorting, "limit": PAGE_SIZE}
+                )
+                cursor = await deep_cursor(client, sorting, pages=5)
+                deep = await time_page(
+                    client, {"sorting": sorting, "limit": PAGE_SIZE, "cursor": cursor}
+                )
+                print(f"{size:>8} {sorting:>11} {first:>10.2f}ms {deep:>10.2f}ms")
+    await database.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
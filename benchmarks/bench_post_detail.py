@@ -0,0 +1,112 @@
+"""Latency percentiles of the post detail page under concurrent load.
+
+Run with `python -m benchmarks.bench_post_detail`. Compares the query behind
+GET /post/{id}, which fetches the post and its comments in one round trip,
+against the previous approach of two sequential queries, and reports the
+latency of the endpoint itself. Point BENCH_DATABASE_URL at a networked database to
+see the effect of the saved round trip; SQLite only shows the query overhead.
+"""
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+os.environ["ENV_STATE"] = "test"
+os.environ["TEST_DATABASE_URL"] = os.environ.get(
+    "BENCH_DATABASE_URL", f"sqlite:///{tempfile.mkdtemp()}/bench_post_detail.db"
+)
+os.environ["TEST_DB_FORCE_ROLL_BACK"] = "false"
+# Measure the queries, not the response cache
+os.environ["TEST_RESPONSE_CACHE_ENABLED"] = "false"
+
+from httpx import AsyncClient  # noqa: E402
+from storeapi.database import (  # noqa: E402
+    comment_table,
+    database,
+    engine,
+    post_table,
+    user_table,
+)
+from storeapi.main import app  # noqa: E402
+from storeapi.routers.post import (  # noqa: E402
+    select_post_and_likes,
+    select_post_with_comments,
+)
+
+POSTS = 100
+COMMENTS_PER_POST = 50
+CONCURRENCY = 50
+ROUNDS = 20
+
+
+def seed():
+    with engine.begin() as conn:
+        conn.execute(comment_table.delete())
+        conn.execute(post_table.delete())
+        conn.execute(user_table.delete())
+        conn.execute(user_table.insert().values(id=1, email="bench@example.net"))
+        conn.execute(
+            post_table.insert(),
+            [{"id": i, "body": f"Post {i}", "user_id": 1} for i in range(1, POSTS + 1)],
+        )
+        conn.execute(
+            comment_table.insert(),
+            [
+                {"body": f"Comment {i}", "post_id": post_id, "user_id": 1}
+                for post_id in range(1, POSTS + 1)
+                for i in range(COMMENTS_PER_POST)
+            ],
+        )
+
+
+async def two_queries(post_id: int):
+    post = await database.fetch_one(
+        select_post_and_likes.where(post_table.c.id == post_id)
+    )
+    comments = await database.fetch_all(
+        comment_table.select().where(comment_table.c.post_id == post_id)
+    )
+    return post, comments
+
+
+async def one_query(post_id: int):
+    return await database.fetch_all(select_post_with_comments(post_id, 50, None))
+
+
+async def measure(request) -> list[float]:
+    async def timed(post_id: int) -> float:
+        start = time.perf_counter()
+        await request(post_id)
+        return (time.perf_counter() - start) * 1000
+
+    latencies = []
+    for round_ in range(ROUNDS):
+        latencies += await asyncio.gather(
+            *(timed(1 + (round_ * CONCURRENCY + i) % POSTS) for i in range(CONCURRENCY))
+        )
+    return latencies
+
+
+def report(name: str, latencies: list[float]):
+    percentiles = statistics.quantiles(latencies, n=100)
+    print(f"{name:>28} p50={percentiles[49]:7.2f}ms p99={percentiles[98]:7.2f}ms")
+
+
+async def main():
+    seed()
+    await database.connect()
+    async with AsyncClient(app=app, base_url="http://bench") as client:
+
+        async def get_detail(post_id: int):
+            response = await client.get(f"/post/{post_id}")
+            response.raise_for_status()
+
+        report("one query", await measure(one_query))
+        report("two sequential queries", await measure(two_queries))
+        report("GET /post/{id}", await measure(get_detail))
+    await database.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
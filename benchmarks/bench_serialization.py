@@ -0,0 +1,80 @@
+"""Cost of turning 10k post rows into a JSON response body.
+
+Run with `python -m benchmarks.bench_serialization`. Compares what FastAPI
+does with a response_model (validate every Record through UserPostWithLikes
+with from_attributes, run jsonable_encoder, then json.dumps) against the
+fast path used by the read endpoints in storeapi.routers.post (map rows to
+dicts and dump them with orjson).
+"""
+import asyncio
+import os
+import tempfile
+import time
+
+os.environ["ENV_STATE"] = "test"
+os.environ["TEST_DATABASE_URL"] = (
+    f"sqlite:///{tempfile.mkdtemp()}/bench_serialization.db"
+)
+os.environ["TEST_DB_FORCE_ROLL_BACK"] = "false"
+
+import orjson  # noqa: E402
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+from pydantic import TypeAdapter  # noqa: E402
+from storeapi.database import database, engine, post_table, user_table  # noqa: E402
+from storeapi.models.post import UserPostWithLikes  # noqa: E402
+from storeapi.routers.post import rows_to_dicts, select_post_and_likes  # noqa: E402
+
+POSTS = 10_000
+ROUNDS = 20
+
+
+def seed():
+    with engine.begin() as conn:
+        conn.execute(post_table.delete())
+        conn.execute(user_table.delete())
+        conn.execute(user_table.insert().values(id=1, email="bench@example.net"))
+        conn.execute(
+            post_table.insert(),
+            [
+                {"body": f"Post number {i}", "user_id": 1, "like_count": i % 50}
+                for i in range(POSTS)
+            ],
+        )
+
+
+post_list_adapter = TypeAdapter(list[UserPostWithLikes])
+
+
+def response_model_path(rows) -> bytes:
+    posts = post_list_adapter.validate_python(rows, from_attributes=True)
+    return JSONResponse(jsonable_encoder(posts)).body
+
+
+def fast_path(rows) -> bytes:
+    return orjson.dumps(rows_to_dicts(rows))
+
+
+def measure(serialize, rows) -> float:
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        serialize(rows)
+    return (time.perf_counter() - start) / ROUNDS * 1000
+
+
+async def main():
+    seed()
+    await database.connect()
+    rows = await database.fetch_all(select_post_and_likes)
+    await database.disconnect()
+
+    assert orjson.loads(fast_path(rows)) == orjson.loads(response_model_path(rows))
+    for name, serialize in [
+        ("response_model", response_model_path),
+        ("orjson fast path", fast_path),
+    ]:
+        print(f"{name:>18}: {measure(serialize, rows):7.2f}ms per {POSTS} posts")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
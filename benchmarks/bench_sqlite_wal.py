@@ -0,0 +1,89 @@
+"""Read and write throughput of SQLite with and without the WAL pragmas.
+
+Run with `python -m benchmarks.bench_sqlite_wal`. Concurrent tasks mix reads
+of the latest posts with post inserts against a throwaway database, once with
+the default SQLITE_* settings (WAL, synchronous=NORMAL) and once with SQLite's
+own defaults (rollback journal, synchronous=FULL). Under the rollback journal
+every commit locks out readers and waits for a full fsync.
+"""
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+os.environ["ENV_STATE"] = "test"
+os.environ["TEST_DATABASE_URL"] = f"sqlite:///{tempfile.mkdtemp()}/bench_wal.db"
+os.environ["TEST_DB_FORCE_ROLL_BACK"] = "false"
+
+import databases  # noqa: E402
+import sqlalchemy  # noqa: E402
+from storeapi.config import config  # noqa: E402
+from storeapi.database import metadata, post_table, user_table  # noqa: E402
+from storeapi.db_pool import configure_sqlite_engine, monitor_pool  # noqa: E402
+
+CONCURRENCY = 20
+DURATION_SECONDS = 3
+WRITE_RATIO = 0.2
+SEED_POSTS = 1000
+
+
+def create_database(url: str):
+    engine = sqlalchemy.create_engine(url)
+    configure_sqlite_engine(engine)
+    metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(user_table.insert().values(id=1, email="bench@example.net"))
+        conn.execute(
+            post_table.insert(),
+            [{"body": f"Post {i}", "user_id": 1} for i in range(SEED_POSTS)],
+        )
+    engine.dispose()
+
+
+async def run(url: str) -> tuple[float, float]:
+    database = databases.Database(url)
+    monitor_pool(database, max_size=CONCURRENCY)
+    await database.connect()
+    reads = writes = 0
+    latest = post_table.select().order_by(post_table.c.id.desc()).limit(20)
+    deadline = time.perf_counter() + DURATION_SECONDS
+
+    async def worker():
+        nonlocal reads, writes
+        # Keep one connection per task: aiosqlite would otherwise open a new
+        # one for every query, which costs more than the locking measured here
+        async with database.connection() as connection:
+            while time.perf_counter() < deadline:
+                if random.random() < WRITE_RATIO:
+                    async with connection.transaction():
+                        await connection.execute(
+                            post_table.insert().values(body="New post", user_id=1)
+                        )
+                    writes += 1
+                else:
+                    await connection.fetch_all(latest)
+                    reads += 1
+
+    await asyncio.gather(*(worker() for _ in range(CONCURRENCY)))
+    await database.disconnect()
+    return reads / DURATION_SECONDS, writes / DURATION_SECONDS
+
+
+async def main():
+    directory = tempfile.mkdtemp()
+    modes = {
+        "rollback journal, FULL": {"SQLITE_WAL": False, "SQLITE_SYNCHRONOUS": "FULL"},
+        "WAL, NORMAL": {"SQLITE_WAL": True, "SQLITE_SYNCHRONOUS": "NORMAL"},
+    }
+    for number, (name, settings) in enumerate(modes.items()):
+        for key, value in settings.items():
+            setattr(config, key, value)
+        url = f"sqlite:///{directory}/mode{number}.db"
+        create_database(url)
+        reads, writes = await run(url)
+        print(f"{name:>24}: {reads:8.0f} reads/s {writes:7.0f} writes/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
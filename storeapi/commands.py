@@ -0,0 +1,79 @@
+"""Maintenance commands.
+
+Run them with `python -m storeapi.commands <command>`, e.g.
+
+    python -m storeapi.commands reconcile_like_counts
+"""
+import asyncio
+import logging
+import sys
+
+import sqlalchemy
+from databases import Database
+from storeapi.database import database, engine, like_table, metadata, post_table
+from storeapi.query_logging import log_query
+
+logger = logging.getLogger(__name__)
+
+
+def add_like_count_column():
+    """Add posts.like_count to databases created before it existed."""
+    columns = sqlalchemy.inspect(engine).get_columns("posts")
+    if "like_count" not in {column["name"] for column in columns}:
+        logger.info("Adding like_count column to posts")
+        with engine.begin() as connection:
+            connection.execute(
+                sqlalchemy.text(
+                    "ALTER TABLE posts ADD COLUMN like_count INTEGER NOT NULL DEFAULT 0"
+                )
+            )
+
+
+def create_indexes():
+    """Create indexes missing from databases created before they were defined.
+
+    Building the unique index on likes fails if a user has liked a post more
+    than once; those duplicate rows have to be removed first.
+    """
+    for table in metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
+async def reconcile_like_counts(database: Database):
+    """Recompute every post's like_count from the likes table."""
+    likes = (
+        sqlalchemy.select(sqlalchemy.func.count(like_table.c.id))
+        .where(like_table.c.post_id == post_table.c.id)
+        .scalar_subquery()
+    )
+    query = post_table.update().values(like_count=likes)
+
+    with log_query(logger, query):
+        await database.execute(query)
+
+
+async def _reconcile_like_counts():
+    add_like_count_column()
+    create_indexes()
+    await database.connect()
+    try:
+        await reconcile_like_counts(database)
+    finally:
+        await database.disconnect()
+
+
+async def _create_indexes():
+    create_indexes()
+
+
+commands = {
+    "create_indexes": _create_indexes,
+    "reconcile_like_counts": _reconcile_like_counts,
+}
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in commands:
+        sys.exit(f"Usage: python -m storeapi.commands {{{','.join(commands)}}}")
+    asyncio.run(commands[sys.argv[1]]())
@@ -1,7 +1,7 @@
 # Most of this taken from Redowan Delowar's post on configurations with Pydantic
 # https://rednafi.github.io/digressions/python/2020/06/03/python-configs.html
 from functools import lru_cache
-from typing import Optional
+from typing import Literal, Optional
 
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
@@ -17,13 +17,96 @@ class BaseConfig(BaseSettings):
 class GlobalConfig(BaseConfig):
     DATABASE_URL: Optional[str] = None
     DB_FORCE_ROLL_BACK: bool = False
+    # Connection pool of the app's database. At most DB_POOL_MAX_SIZE queries
+    # run at once; the rest wait up to DB_POOL_ACQUIRE_TIMEOUT_SECONDS.
+    DB_POOL_MIN_SIZE: int = 1
+    DB_POOL_MAX_SIZE: int = 10
+    DB_POOL_ACQUIRE_TIMEOUT_SECONDS: float = 30
+    DB_STATEMENT_TIMEOUT_SECONDS: float = 30
+    DB_STATEMENT_CACHE_SIZE: int = 100
+    # Read replicas of DATABASE_URL, as a JSON list, for the read endpoints.
+    # Selection is "round_robin" or "least_busy". A user's reads go to the
+    # primary for DB_REPLICA_STICKY_SECONDS after they write, on every worker
+    # through a cookie, so they see their own writes despite replication
+    # lag. A replica that fails is skipped for DB_REPLICA_RETRY_SECONDS.
+    DATABASE_REPLICA_URLS: list[str] = []
+    DB_REPLICA_SELECTION: Literal["round_robin", "least_busy"] = "round_robin"
+    DB_REPLICA_STICKY_SECONDS: float = 10
+    DB_REPLICA_RETRY_SECONDS: float = 30
+    # SQLite tuning. The journal mode is set on the database file at startup;
+    # the others on every connection. WAL lets readers carry on while a write
+    # is in progress; synchronous=NORMAL is durable in WAL mode except for
+    # the last transactions before a power loss. Memory-mapped reads share
+    # the OS page cache between connections; the page cache of cache_size
+    # belongs to one connection, and aiosqlite opens a new connection on
+    # every acquire, so it only helps within a single checkout.
+    SQLITE_WAL: bool = True
+    SQLITE_SYNCHRONOUS: Literal["OFF", "NORMAL", "FULL", "EXTRA"] = "NORMAL"
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
+    SQLITE_MMAP_SIZE: int = 256 * 1024 * 1024
+    SQLITE_CACHE_SIZE_KB: int = 64 * 1024
     MAILGUN_DOMAIN: Optional[str] = None
     MAILGUN_API_KEY: Optional[str] = None
     LOGTAIL_API_KEY: Optional[str] = None
+    # Log records are queued and written by a background thread. When the
+    # queue is full, "drop_newest" drops the new record, "drop_oldest" the
+    # oldest queued one, and "block" makes the logging call wait up to
+    # LOG_QUEUE_BLOCK_SECONDS before dropping it.
+    LOG_QUEUE_MAX_SIZE: int = 10_000
+    LOG_QUEUE_FULL_POLICY: Literal["drop_newest", "drop_oldest", "block"] = (
+        "drop_newest"
+    )
+    LOG_QUEUE_BLOCK_SECONDS: float = 0.1
     B2_KEY_ID: Optional[str] = None
     B2_APPLICATION_KEY: Optional[str] = None
     B2_BUCKET_NAME: Optional[str] = None
+    # Uploads bigger than one part go to B2 as large files, in parts of this
+    # size (B2's minimum is 5MB). Each upload buffers at most
+    # B2_PART_SIZE * (B2_UPLOAD_CONCURRENCY + 1) bytes in memory.
+    B2_PART_SIZE: int = 5 * 1024 * 1024
+    B2_UPLOAD_CONCURRENCY: int = 4
+    B2_UPLOAD_THREADS: int = 16
+    # How many files of a batch upload are sent to B2 at the same time
+    B2_BATCH_UPLOAD_CONCURRENCY: int = 4
+    # Largest part accepted by resumable uploads, which stream each part to B2
+    B2_MAX_PART_SIZE: int = 100 * 1024 * 1024
+    # Resumable uploads left untouched this long expire; every cleanup
+    # interval, their B2 large files are cancelled and their rows deleted
+    UPLOAD_SESSION_TTL_SECONDS: float = 24 * 60 * 60
+    UPLOAD_SESSION_CLEANUP_INTERVAL_SECONDS: float = 60 * 60
+    # B2 authorization tokens last 24 hours; renew them well before that
+    B2_AUTH_REFRESH_SECONDS: float = 12 * 60 * 60
     DEEPAI_API_KEY: Optional[str] = None
+    PASSWORD_HASH_WORKERS: int = 4
+    USER_CACHE_MAX_SIZE: int = 1024
+    USER_CACHE_TTL_SECONDS: int = 60
+    # Cached GET /post and GET /post/{id} responses. Writes invalidate them in
+    # the process that made them; other processes catch up within the TTL.
+    RESPONSE_CACHE_ENABLED: bool = True
+    RESPONSE_CACHE_MAX_SIZE: int = 4096
+    RESPONSE_CACHE_TTL_SECONDS: float = 10
+    # Send each request's database and external call timings to the client
+    # in a Server-Timing header; they are logged either way
+    SERVER_TIMING_ENABLED: bool = True
+    # Outbound HTTP clients; HTTP_2 needs the h2 package (httpx[http2])
+    HTTP_2: bool = False
+    HTTP_MAX_CONNECTIONS_PER_HOST: int = 20
+    HTTP_MAX_KEEPALIVE_CONNECTIONS_PER_HOST: int = 10
+    HTTP_KEEPALIVE_EXPIRY_SECONDS: float = 30
+    HTTP_CONNECT_TIMEOUT_SECONDS: float = 5
+    HTTP_TIMEOUT_SECONDS: float = 10
+    EMAIL_BATCH_SIZE: int = 1000  # Mailgun's limit of recipients per request
+    EMAIL_FLUSH_INTERVAL_SECONDS: float = 2
+    EMAIL_QUEUE_MAX_SIZE: int = 10_000
+    EMAIL_MAX_RETRIES: int = 3
+    # Run a job worker inside each app process; workers can also be run on
+    # their own with `python -m storeapi.jobs`
+    JOB_WORKER_ENABLED: bool = True
+    JOB_WORKER_CONCURRENCY: int = 4
+    JOB_POLL_INTERVAL_SECONDS: float = 1
+    JOB_VISIBILITY_TIMEOUT_SECONDS: float = 120
+    JOB_MAX_ATTEMPTS: int = 5
+    JOB_RETRY_BASE_DELAY_SECONDS: float = 10
 
 
 class DevConfig(GlobalConfig):
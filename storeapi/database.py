@@ -1,7 +1,15 @@
 import databases
 import sqlalchemy
+from sqlalchemy.dialects import postgresql, sqlite
 
 from storeapi.config import config
+from storeapi.db_pool import (
+    configure_sqlite_engine,
+    database_options,
+    engine_options,
+    monitor_pool,
+)
+from storeapi.replicas import ReplicaRouter
 
 metadata = sqlalchemy.MetaData()
 
@@ -10,8 +18,17 @@ post_table = sqlalchemy.Table(
     metadata,
     sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
     sqlalchemy.Column("body", sqlalchemy.String),
-    sqlalchemy.Column("user_id", sqlalchemy.ForeignKey("users.id"), nullable=False),
+    sqlalchemy.Column(
+        "user_id", sqlalchemy.ForeignKey("users.id"), nullable=False, index=True
+    ),
     sqlalchemy.Column("image_url", sqlalchemy.String),
+    # Kept in step with the likes table by like_post, so reads don't need to
+    # aggregate likes. `python -m storeapi.commands reconcile_like_counts`
+    # recomputes it from the likes table.
+    sqlalchemy.Column(
+        "like_count", sqlalchemy.Integer, nullable=False, server_default="0"
+    ),
+    sqlalchemy.Index("ix_posts_like_count_id", "like_count", "id"),
 )
 
 user_table = sqlalchemy.Table(
@@ -29,7 +46,9 @@ comment_table = sqlalchemy.Table(
     metadata,
     sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
     sqlalchemy.Column("body", sqlalchemy.String),
-    sqlalchemy.Column("post_id", sqlalchemy.ForeignKey("posts.id"), nullable=False),
+    sqlalchemy.Column(
+        "post_id", sqlalchemy.ForeignKey("posts.id"), nullable=False, index=True
+    ),
     sqlalchemy.Column("user_id", sqlalchemy.ForeignKey("users.id"), nullable=False)
 )
 
@@ -38,14 +57,127 @@ like_table = sqlalchemy.Table(
     metadata,
     sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
     sqlalchemy.Column("post_id", sqlalchemy.ForeignKey("posts.id"), nullable=False),
-    sqlalchemy.Column("user_id", sqlalchemy.ForeignKey("users.id"), nullable=False)
+    sqlalchemy.Column(
+        "user_id", sqlalchemy.ForeignKey("users.id"), nullable=False, index=True
+    ),
+    # Also serves lookups by post_id alone, as it is the leading column
+    sqlalchemy.Index("ix_likes_post_id_user_id", "post_id", "user_id", unique=True),
+)
+
+# Durable background jobs, claimed and run by storeapi.jobs workers
+job_table = sqlalchemy.Table(
+    "jobs",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("name", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("payload", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("status", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("attempts", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("max_attempts", sqlalchemy.Integer, nullable=False),
+    # Unix time after which a queued job may run, or a running job counts as
+    # abandoned and may be claimed again
+    sqlalchemy.Column("visible_at", sqlalchemy.Float, nullable=False),
+    sqlalchemy.Column("locked_by", sqlalchemy.String),
+    sqlalchemy.Column("last_error", sqlalchemy.String),
+    sqlalchemy.Column("created_at", sqlalchemy.Float, nullable=False),
+    sqlalchemy.Column("updated_at", sqlalchemy.Float, nullable=False),
+    sqlalchemy.Index("ix_jobs_status_visible_at", "status", "visible_at"),
+)
+
+# Files already in B2, by the SHA-256 of their content, so that uploading the
+# same file again can reuse them
+upload_table = sqlalchemy.Table(
+    "uploads",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column("content_hash", sqlalchemy.String, nullable=False, unique=True),
+    sqlalchemy.Column("size", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("file_id", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("file_url", sqlalchemy.String, nullable=False),
+)
+
+# Resumable uploads: each session is a B2 large file that clients send part by
+# part, possibly through different workers
+upload_session_table = sqlalchemy.Table(
+    "upload_sessions",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.String, primary_key=True),
+    sqlalchemy.Column("user_id", sqlalchemy.ForeignKey("users.id"), nullable=False),
+    sqlalchemy.Column("file_name", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("content_type", sqlalchemy.String),
+    sqlalchemy.Column("large_file_id", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("status", sqlalchemy.String, nullable=False),
+    sqlalchemy.Column("file_url", sqlalchemy.String),
+    sqlalchemy.Column("created_at", sqlalchemy.Float, nullable=False),
+    sqlalchemy.Column("updated_at", sqlalchemy.Float, nullable=False),
 )
 
+upload_part_table = sqlalchemy.Table(
+    "upload_parts",
+    metadata,
+    sqlalchemy.Column("id", sqlalchemy.Integer, primary_key=True),
+    sqlalchemy.Column(
+        "session_id", sqlalchemy.ForeignKey("upload_sessions.id"), nullable=False
+    ),
+    sqlalchemy.Column("part_number", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("size", sqlalchemy.Integer, nullable=False),
+    sqlalchemy.Column("sha1", sqlalchemy.String, nullable=False),
+    sqlalchemy.Index(
+        "ix_upload_parts_session_id_part_number",
+        "session_id",
+        "part_number",
+        unique=True,
+    ),
+)
+
+# Inserts that support ON CONFLICT DO NOTHING, by database dialect. The app
+# also relies on RETURNING, so these are the only databases it runs on.
+DIALECT_INSERTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+
+
+def check_dialect(url: str):
+    dialect = databases.DatabaseURL(url).dialect
+    if dialect not in DIALECT_INSERTS:
+        raise ValueError(
+            f"Unsupported database '{dialect}': use SQLite or PostgreSQL,"
+            " which support INSERT ... ON CONFLICT DO NOTHING and RETURNING"
+        )
+
+
+for url in [config.DATABASE_URL, *config.DATABASE_REPLICA_URLS]:
+    check_dialect(url)
+
 engine = sqlalchemy.create_engine(
-    config.DATABASE_URL, connect_args={"check_same_thread": False}
+    config.DATABASE_URL, **engine_options(config.DATABASE_URL)
 )
+if engine.dialect.name == "sqlite":
+    configure_sqlite_engine(engine)
 
 metadata.create_all(engine)
 database = databases.Database(
-    config.DATABASE_URL, force_rollback=config.DB_FORCE_ROLL_BACK
+    config.DATABASE_URL,
+    force_rollback=config.DB_FORCE_ROLL_BACK,
+    **database_options(config.DATABASE_URL),
 )
+database_pool = monitor_pool(database)
+replicas = [
+    databases.Database(url, **database_options(url))
+    for url in config.DATABASE_REPLICA_URLS
+]
+for replica in replicas:
+    monitor_pool(replica, name="replica")
+# Use for queries that may read slightly stale data
+read_database = ReplicaRouter(
+    database,
+    replicas,
+    selection=config.DB_REPLICA_SELECTION,
+    sticky_seconds=config.DB_REPLICA_STICKY_SECONDS,
+    retry_seconds=config.DB_REPLICA_RETRY_SECONDS,
+)
+
+
+def insert_ignoring_conflicts(table: sqlalchemy.Table, index_elements: list[str]):
+    """An INSERT into `table` that skips rows clashing with the unique index
+    on `index_elements`, whichever database DATABASE_URL points at."""
+    insert = DIALECT_INSERTS[database.url.dialect]
+    return insert(table).on_conflict_do_nothing(index_elements=index_elements)
@@ -0,0 +1,248 @@
+"""Connection pool settings and monitoring for the app's databases.
+
+`databases` and SQLAlchemy take different, driver-specific options for the
+same pool settings; `database_options` and `engine_options` translate the
+DB_POOL_* and DB_STATEMENT_* settings for whichever backend DATABASE_URL
+points at.
+
+`MonitoredBackend` caps the number of connections checked out at once,
+whatever the driver (aiosqlite has no pool and would open a connection per
+task), times out waits for a connection, and reports the db_pool_* metrics
+of its pool name ("primary" or "replica"). For SQLite it also applies the per-connection
+SQLITE_* pragmas to each new connection. Queries are timed into the current
+request's timings.
+"""
+import asyncio
+import logging
+import time
+from typing import Any, Awaitable, Callable, Optional
+
+import aiosqlite
+import sqlalchemy
+from databases import DatabaseURL
+from databases.interfaces import ConnectionBackend, DatabaseBackend
+from storeapi.config import config
+from storeapi.metrics import (
+    db_pool_acquire_seconds,
+    db_pool_acquired,
+    db_pool_connections_in_use,
+    db_pool_connections_max,
+    db_pool_timeouts,
+    db_pool_waiting,
+)
+from storeapi.request_timing import timed_db_query
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeoutError(Exception):
+    pass
+
+
+# Called with the driver's connection each time one is acquired
+OnAcquire = Callable[[Any], Awaitable]
+
+
+def database_options(url: str) -> dict:
+    """Options for `databases.Database`, which passes them to the driver."""
+    dialect = DatabaseURL(url).dialect
+    if dialect == "postgresql":
+        # asyncpg
+        timeout_ms = int(config.DB_STATEMENT_TIMEOUT_SECONDS * 1000)
+        return {
+            "min_size": config.DB_POOL_MIN_SIZE,
+            "max_size": config.DB_POOL_MAX_SIZE,
+            "statement_cache_size": config.DB_STATEMENT_CACHE_SIZE,
+            "server_settings": {"statement_timeout": str(timeout_ms)},
+        }
+    return {}
+
+
+def engine_options(url: str) -> dict:
+    """Options for the synchronous `sqlalchemy.create_engine`."""
+    dialect = DatabaseURL(url).dialect
+    if dialect == "sqlite":
+        return {"connect_args": {"check_same_thread": False}}
+
+    options: dict[str, Any] = {
+        "pool_size": config.DB_POOL_MAX_SIZE,
+        "max_overflow": 0,
+        "pool_timeout": config.DB_POOL_ACQUIRE_TIMEOUT_SECONDS,
+        "pool_pre_ping": True,
+    }
+    if dialect == "postgresql":
+        timeout_ms = int(config.DB_STATEMENT_TIMEOUT_SECONDS * 1000)
+        options["connect_args"] = {"options": f"-c statement_timeout={timeout_ms}"}
+    return options
+
+
+def sqlite_pragmas() -> list[str]:
+    """Pragmas that only last as long as the connection."""
+    return [
+        f"PRAGMA synchronous = {config.SQLITE_SYNCHRONOUS}",
+        f"PRAGMA busy_timeout = {config.SQLITE_BUSY_TIMEOUT_MS:d}",
+        f"PRAGMA mmap_size = {config.SQLITE_MMAP_SIZE:d}",
+        # A negative cache_size is in KiB rather than pages
+        f"PRAGMA cache_size = -{config.SQLITE_CACHE_SIZE_KB:d}",
+    ]
+
+
+def configure_sqlite_engine(engine: sqlalchemy.engine.Engine):
+    """Apply the pragmas to every connection the synchronous engine opens, and
+    set the journal mode, which is stored in the database file, once."""
+
+    @sqlalchemy.event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma in sqlite_pragmas():
+            cursor.execute(pragma)
+        cursor.close()
+
+    journal_mode = "WAL" if config.SQLITE_WAL else "DELETE"
+    with engine.connect() as connection:
+        connection.exec_driver_sql(f"PRAGMA journal_mode = {journal_mode}")
+
+
+async def set_sqlite_pragmas(connection: aiosqlite.Connection):
+    for pragma in sqlite_pragmas():
+        await connection.execute(pragma)
+
+
+class PoolStats:
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.in_use = 0
+        self.waiting = 0
+        self.acquired = 0
+        self.timeouts = 0
+
+
+class MonitoredConnection:
+    """Delegates to the driver's connection, counting it while it's acquired
+    and timing the queries run on it."""
+
+    def __init__(self, backend: "MonitoredBackend", connection: ConnectionBackend):
+        self._backend = backend
+        self._connection = connection
+
+    async def acquire(self):
+        await self._backend.checkout()
+        try:
+            await self._connection.acquire()
+            if self._backend.on_acquire is not None:
+                await self._backend.on_acquire(self._connection.raw_connection)
+        except BaseException:
+            self._backend.checkin()
+            raise
+
+    async def release(self):
+        try:
+            await self._connection.release()
+        finally:
+            self._backend.checkin()
+
+    async def fetch_all(self, query):
+        with timed_db_query():
+            return await self._connection.fetch_all(query)
+
+    async def fetch_one(self, query):
+        with timed_db_query():
+            return await self._connection.fetch_one(query)
+
+    async def fetch_val(self, query, column: Any = 0):
+        with timed_db_query():
+            return await self._connection.fetch_val(query, column)
+
+    async def execute(self, query):
+        with timed_db_query():
+            return await self._connection.execute(query)
+
+    async def execute_many(self, queries: list):
+        with timed_db_query(len(queries)):
+            await self._connection.execute_many(queries)
+
+    async def iterate(self, query):
+        with timed_db_query():
+            async for record in self._connection.iterate(query):
+                yield record
+
+    def __getattr__(self, name: str):
+        return getattr(self._connection, name)
+
+
+class MonitoredBackend:
+    """Wraps a `databases` backend; everything but connecting is delegated."""
+
+    def __init__(
+        self,
+        backend: DatabaseBackend,
+        max_size: int,
+        acquire_timeout: float,
+        on_acquire: Optional[OnAcquire] = None,
+        name: str = "primary",
+    ):
+        self._backend = backend
+        self.name = name
+        self.acquire_timeout = acquire_timeout
+        self.on_acquire = on_acquire
+        self.stats = PoolStats(max_size)
+        db_pool_connections_max.labels(name).inc(max_size)
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    async def connect(self):
+        # Created here so that it belongs to the running event loop
+        self._slots = asyncio.Semaphore(self.stats.max_size)
+        await self._backend.connect()
+
+    async def disconnect(self):
+        await self._backend.disconnect()
+
+    def connection(self) -> ConnectionBackend:
+        return MonitoredConnection(self, self._backend.connection())
+
+    async def checkout(self):
+        start = time.perf_counter()
+        self.stats.waiting += 1
+        db_pool_waiting.labels(self.name).inc()
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.acquire_timeout)
+        except asyncio.TimeoutError:
+            self.stats.timeouts += 1
+            db_pool_timeouts.labels(self.name).inc()
+            logger.warning(
+                f"Timed out after {self.acquire_timeout}s waiting for one of"
+                f" {self.stats.max_size} database connections"
+            )
+            raise PoolTimeoutError("Timed out waiting for a database connection")
+        finally:
+            self.stats.waiting -= 1
+            db_pool_waiting.labels(self.name).dec()
+        db_pool_acquire_seconds.labels(self.name).observe(time.perf_counter() - start)
+        self.stats.in_use += 1
+        self.stats.acquired += 1
+        db_pool_connections_in_use.labels(self.name).inc()
+        db_pool_acquired.labels(self.name).inc()
+
+    def checkin(self):
+        self.stats.in_use -= 1
+        db_pool_connections_in_use.labels(self.name).dec()
+        self._slots.release()
+
+    def __getattr__(self, name: str):
+        return getattr(self._backend, name)
+
+
+def monitor_pool(
+    database,
+    max_size: int = config.DB_POOL_MAX_SIZE,
+    acquire_timeout: float = config.DB_POOL_ACQUIRE_TIMEOUT_SECONDS,
+    name: str = "primary",
+) -> MonitoredBackend:
+    """Route `database`'s connections through a MonitoredBackend."""
+    # aiosqlite opens a new connection every time one is acquired
+    on_acquire = set_sqlite_pragmas if database.url.dialect == "sqlite" else None
+    backend = MonitoredBackend(
+        database._backend, max_size, acquire_timeout, on_acquire, name
+    )
+    database._backend = backend
+    return backend
@@ -0,0 +1,190 @@
+import asyncio
+import heapq
+import logging
+import random
+import re
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+from storeapi.metrics import email_outbox_queue_depth
+
+logger = logging.getLogger(__name__)
+
+RECIPIENT_VARIABLE = re.compile(r"%recipient\.(\w+)%")
+
+
+@dataclass(frozen=True)
+class Email:
+    """An email whose body may use Mailgun recipient variables.
+
+    `%recipient.name%` in the body is replaced by `variables["name"]`, so that
+    emails sharing a subject and body can go out in a single batch request.
+    """
+
+    to: str
+    subject: str
+    body: str
+    variables: dict = field(default_factory=dict, hash=False)
+
+    def render(self) -> str:
+        return RECIPIENT_VARIABLE.sub(
+            lambda match: str(self.variables.get(match.group(1), match.group(0))),
+            self.body,
+        )
+
+
+SendBatch = Callable[[dict[str, dict], str, str], Awaitable]
+
+
+@dataclass(order=True)
+class RetryBatch:
+    """A batch that failed to send, due for another attempt at `not_before`."""
+
+    not_before: float
+    attempt: int
+    recipients: dict[str, dict] = field(compare=False)
+    subject: str = field(compare=False)
+    body: str = field(compare=False)
+
+
+class EmailOutbox:
+    """Coalesces emails and sends them in batches from a background task.
+
+    A batch is flushed once it holds `max_batch_size` emails or `flush_interval`
+    seconds after its first email arrived, whichever comes first. Emails with
+    the same subject and body go out in one `send_batch(recipients, subject,
+    body)` call, where `recipients` maps each address to its variables.
+
+    `put` waits while `max_queue_size` emails are queued, which pushes back on
+    producers when the email API can't keep up. A failed batch is set aside
+    to be retried after an exponential backoff with jitter while the loop
+    carries on with new emails; after `max_retries` retries it is dropped and
+    logged. `stop` waits for the pending retries too.
+    """
+
+    def __init__(
+        self,
+        send_batch: SendBatch,
+        max_batch_size: int = 1000,
+        flush_interval: float = 2.0,
+        max_queue_size: int = 10_000,
+        max_retries: int = 3,
+        retry_base_delay: float = 1.0,
+    ):
+        self.send_batch = send_batch
+        self.max_batch_size = max_batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self._queue: asyncio.Queue[Optional[Email]] = asyncio.Queue(max_queue_size)
+        # Failed batches, ordered by when they may be sent again
+        self._retries: list[RetryBatch] = []
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        if not self.running:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Send everything still queued, then stop the background task."""
+        if self.running:
+            await self._queue.put(None)
+            await self._task
+        self._task = None
+
+    async def put(self, email: Email):
+        await self._queue.put(email)
+        email_outbox_queue_depth.inc()
+
+    async def _next_email(self, timeout: Optional[float]) -> Optional[Email]:
+        """The next queued email, or None once stopping; times out like
+        `asyncio.wait_for`."""
+        email = await asyncio.wait_for(self._queue.get(), timeout)
+        if email is not None:
+            email_outbox_queue_depth.dec()
+        return email
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            await self._send_due_retries()
+            try:
+                email = await self._next_email(self._retry_wait())
+            except asyncio.TimeoutError:
+                continue
+            if email is None:
+                break
+
+            batch = [email]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.max_batch_size:
+                try:
+                    email = await self._next_email(deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                if email is None:
+                    stopping = True
+                    break
+                batch.append(email)
+
+            await self.flush(batch)
+
+        while self._retries:
+            await asyncio.sleep(self._retry_wait())
+            await self._send_due_retries()
+
+    def _retry_wait(self) -> Optional[float]:
+        """Seconds until the next retry is due, or None if there is none."""
+        if not self._retries:
+            return None
+        return max(0, self._retries[0].not_before - asyncio.get_running_loop().time())
+
+    async def _send_due_retries(self):
+        now = asyncio.get_running_loop().time()
+        while self._retries and self._retries[0].not_before <= now:
+            retry = heapq.heappop(self._retries)
+            await self._send(retry.recipients, retry.subject, retry.body, retry.attempt)
+
+    async def flush(self, emails: list[Email]):
+        groups: dict[tuple[str, str], list[dict[str, dict]]] = {}
+        for email in emails:
+            batches = groups.setdefault((email.subject, email.body), [{}])
+            # Each address appears once per request, so start a new batch for
+            # repeated recipients as well as for full ones
+            if email.to in batches[-1] or len(batches[-1]) >= self.max_batch_size:
+                batches.append({})
+            batches[-1][email.to] = email.variables
+
+        for (subject, body), batches in groups.items():
+            for recipients in batches:
+                await self._send(recipients, subject, body)
+
+    async def _send(
+        self, recipients: dict[str, dict], subject: str, body: str, attempt: int = 0
+    ):
+        """Send a batch once, setting it aside for a retry if that fails."""
+        try:
+            return await self.send_batch(recipients, subject, body)
+        except Exception as e:
+            if attempt == self.max_retries:
+                logger.error(
+                    f"Giving up on email '{subject[:20]}' to"
+                    f" {len(recipients)} recipients: {e}"
+                )
+                return
+            delay = self.retry_base_delay * 2**attempt * random.uniform(0.5, 1.5)
+            logger.warning(f"Email batch failed, retrying in {delay:.2f}s: {e}")
+            not_before = asyncio.get_running_loop().time() + delay
+            heapq.heappush(
+                self._retries,
+                RetryBatch(not_before, attempt + 1, recipients, subject, body),
+            )
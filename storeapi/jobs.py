@@ -0,0 +1,311 @@
+"""A durable job queue stored in the `jobs` table.
+
+Jobs survive restarts, and any number of worker processes can share the
+queue: claiming a job is a single atomic UPDATE, after which the job stays
+invisible to other workers for a visibility timeout. A worker that dies
+mid-job therefore only delays it; once the timeout passes, another worker
+claims it again. Failed jobs are retried with exponential backoff until they
+run out of attempts, so handlers must be safe to run more than once.
+
+Run a standalone worker with `python -m storeapi.jobs`.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import socket
+import time
+import uuid
+from enum import Enum
+from typing import Awaitable, Callable, Optional
+
+import sqlalchemy
+from databases import Database
+from storeapi.config import config
+from storeapi.database import job_table
+from storeapi.query_logging import log_query
+from storeapi.tasks import (
+    generate_and_add_to_post,
+    send_image_generation_failed_email,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class JobStatus(str, Enum):
+    queued = "queued"
+    running = "running"
+    succeeded = "succeeded"
+    failed = "failed"
+
+
+# Handlers are called with the job's payload as keyword arguments, plus the
+# database the job was read from
+handlers: dict[str, Callable[..., Awaitable]] = {
+    "generate_and_add_to_post": generate_and_add_to_post,
+}
+
+# Called like the handlers once a job has failed for good
+failure_handlers: dict[str, Callable[..., Awaitable]] = {
+    "generate_and_add_to_post": send_image_generation_failed_email,
+}
+
+
+def now() -> float:
+    return time.time()
+
+
+async def enqueue_job(
+    database: Database, name: str, payload: dict, max_attempts: Optional[int] = None
+) -> int:
+    if name not in handlers:
+        raise ValueError(f"No handler for job '{name}'")
+
+    timestamp = now()
+    query = job_table.insert().values(
+        name=name,
+        payload=json.dumps(payload),
+        status=JobStatus.queued.value,
+        attempts=0,
+        max_attempts=max_attempts or config.JOB_MAX_ATTEMPTS,
+        visible_at=timestamp,
+        created_at=timestamp,
+        updated_at=timestamp,
+    )
+
+    with log_query(logger, query):
+        return await database.execute(query)
+
+
+async def get_job(database: Database, job_id: int):
+    query = job_table.select().where(job_table.c.id == job_id)
+
+    with log_query(logger, query):
+        return await database.fetch_one(query)
+
+
+async def count_jobs(database: Database) -> dict[str, int]:
+    """Number of jobs in each status that has any."""
+    query = sqlalchemy.select(
+        job_table.c.status, sqlalchemy.func.count(job_table.c.id).label("jobs")
+    ).group_by(job_table.c.status)
+
+    with log_query(logger, query):
+        rows = await database.fetch_all(query)
+    return {row.status: row.jobs for row in rows}
+
+
+async def claim_job(database: Database, worker_id: str, visibility_timeout: float):
+    """Atomically take the oldest runnable job, or return None if there isn't one.
+
+    Runnable jobs are queued jobs whose retry delay has passed, and running
+    jobs whose visibility timeout expired because their worker went away.
+    """
+    timestamp = now()
+    runnable = (
+        job_table.c.status.in_([JobStatus.queued.value, JobStatus.running.value])
+        & (job_table.c.visible_at <= timestamp)
+        & (job_table.c.attempts < job_table.c.max_attempts)
+    )
+    oldest = (
+        sqlalchemy.select(job_table.c.id)
+        .where(runnable)
+        .order_by(job_table.c.id)
+        .limit(1)
+        .scalar_subquery()
+    )
+    # Repeating `runnable` makes the UPDATE a no-op if another worker claimed
+    # the same job first
+    query = (
+        job_table.update()
+        .where((job_table.c.id == oldest) & runnable)
+        .values(
+            status=JobStatus.running.value,
+            attempts=job_table.c.attempts + 1,
+            locked_by=worker_id,
+            visible_at=timestamp + visibility_timeout,
+            updated_at=timestamp,
+        )
+        .returning(*job_table.c)
+    )
+
+    with log_query(logger, query):
+        return await database.fetch_one(query)
+
+
+async def finish_job(database: Database, job, status: JobStatus, **values):
+    """Record the outcome of a job, unless another worker has since claimed it."""
+    query = (
+        job_table.update()
+        .where(
+            (job_table.c.id == job.id)
+            & (job_table.c.locked_by == job.locked_by)
+            & (job_table.c.attempts == job.attempts)
+        )
+        .values(status=status.value, updated_at=now(), **values)
+    )
+
+    with log_query(logger, query):
+        await database.execute(query)
+
+
+async def fail_abandoned_jobs(database: Database) -> list:
+    """Fail running jobs that timed out on their last attempt, and return them."""
+    query = (
+        job_table.update()
+        .where(
+            (job_table.c.status == JobStatus.running.value)
+            & (job_table.c.visible_at <= now())
+            & (job_table.c.attempts >= job_table.c.max_attempts)
+        )
+        .values(
+            status=JobStatus.failed.value,
+            last_error="Timed out",
+            updated_at=now(),
+        )
+        .returning(*job_table.c)
+    )
+
+    with log_query(logger, query):
+        return await database.fetch_all(query)
+
+
+class JobWorker:
+    """Claims jobs from the queue and runs up to `concurrency` of them at once."""
+
+    def __init__(
+        self,
+        database: Database,
+        concurrency: int = config.JOB_WORKER_CONCURRENCY,
+        poll_interval: float = config.JOB_POLL_INTERVAL_SECONDS,
+        visibility_timeout: float = config.JOB_VISIBILITY_TIMEOUT_SECONDS,
+        retry_base_delay: float = config.JOB_RETRY_BASE_DELAY_SECONDS,
+    ):
+        self.database = database
+        self.poll_interval = poll_interval
+        self.visibility_timeout = visibility_timeout
+        self.retry_base_delay = retry_base_delay
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self._slots = asyncio.Semaphore(concurrency)
+        self._running: set[asyncio.Task] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run_forever())
+
+    async def stop(self):
+        """Stop claiming jobs and wait for the ones in progress to finish."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await asyncio.gather(*self._running, return_exceptions=True)
+
+    async def run_forever(self):
+        logger.info(f"Job worker {self.worker_id} started")
+        while True:
+            await self._slots.acquire()
+            try:
+                job = await claim_job(
+                    self.database, self.worker_id, self.visibility_timeout
+                )
+                if job is None:
+                    await self.fail_abandoned_jobs()
+            except Exception:
+                logger.exception("Could not claim a job")
+                job = None
+
+            if job is None:
+                self._slots.release()
+                await asyncio.sleep(self.poll_interval)
+                continue
+
+            task = asyncio.create_task(self._run_and_release(job))
+            self._running.add(task)
+            task.add_done_callback(self._running.discard)
+
+    async def run_pending(self) -> int:
+        """Run queued jobs one at a time until none are runnable; for tests and
+        scripts. Returns how many jobs were run."""
+        count = 0
+        while job := await claim_job(
+            self.database, self.worker_id, self.visibility_timeout
+        ):
+            await self.run_job(job)
+            count += 1
+        return count
+
+    async def _run_and_release(self, job):
+        try:
+            await self.run_job(job)
+        finally:
+            self._slots.release()
+
+    async def run_job(self, job):
+        logger.info(f"Running job {job.id} ({job.name}), attempt {job.attempts}")
+        try:
+            await handlers[job.name](database=self.database, **json.loads(job.payload))
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+            if job.attempts >= job.max_attempts:
+                logger.error(f"Job {job.id} failed for good: {error}")
+                await finish_job(self.database, job, JobStatus.failed, last_error=error)
+                await self.run_failure_handler(job)
+            else:
+                delay = self.retry_base_delay * 2 ** (job.attempts - 1)
+                delay *= random.uniform(0.5, 1.5)
+                logger.warning(
+                    f"Job {job.id} failed, retrying in {delay:.0f}s: {error}"
+                )
+                await finish_job(
+                    self.database,
+                    job,
+                    JobStatus.queued,
+                    last_error=error,
+                    visible_at=now() + delay,
+                )
+        else:
+            await finish_job(self.database, job, JobStatus.succeeded)
+
+    async def fail_abandoned_jobs(self):
+        for job in await fail_abandoned_jobs(self.database):
+            logger.error(f"Job {job.id} failed for good: Timed out")
+            await self.run_failure_handler(job)
+
+    async def run_failure_handler(self, job):
+        failure_handler = failure_handlers.get(job.name)
+        if failure_handler is None:
+            return
+        try:
+            await failure_handler(database=self.database, **json.loads(job.payload))
+        except Exception:
+            logger.exception(f"Failure handler of job {job.id} failed")
+
+
+async def _main():
+    from storeapi.database import database
+    from storeapi.logging_conf import configure_logging, shutdown_logging
+    from storeapi.metrics import mark_process_dead
+    from storeapi.response_cache import response_cache
+    from storeapi.tasks import email_outbox, http_clients
+
+    configure_logging()
+    # This process serves no responses, so its cache is never read; API
+    # processes pick up changes made by jobs once their cached responses expire
+    response_cache.enabled = False
+    await database.connect()
+    email_outbox.start()
+    try:
+        await JobWorker(database).run_forever()
+    finally:
+        await email_outbox.stop()
+        await http_clients.aclose()
+        await database.disconnect()
+        shutdown_logging()
+        mark_process_dead()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -1,5 +1,8 @@
+import hashlib
+import io
 import logging
 from functools import lru_cache
+from typing import BinaryIO, Optional
 
 import b2sdk.v2 as b2
 from storeapi.config import config
@@ -22,14 +25,73 @@ def b2_get_bucket(api: b2.B2Api):
     return api.get_bucket_by_name(config.B2_BUCKET_NAME)
 
 
-def b2_upload_file(local_file: str, file_name: str):
-    api = b2_api()
-    logger.debug(f"Uploading {local_file} to B2 as {file_name}")
-    uploaded_file = b2_get_bucket(api).upload_local_file(
-        local_file=local_file, file_name=file_name
-    )
-    download_url = api.get_download_url_for_fileid(uploaded_file.id_)
-    logger.debug(
-        f"Uploaded {local_file} to B2 successfully and got download URL {download_url}"
-    )
-    return download_url
+class B2Storage:
+    """The bucket operations we need for streaming uploads.
+
+    They are synchronous b2sdk calls, so run them in a thread. Tests swap this
+    for a fake with the same methods.
+    """
+
+    def __init__(self, api: b2.B2Api):
+        self.api = api
+        self.bucket = b2_get_bucket(api)
+
+    def authorize(self):
+        """Get a fresh account authorization token."""
+        self.api.authorize_account(
+            "production", config.B2_KEY_ID, config.B2_APPLICATION_KEY
+        )
+
+    def upload_bytes(
+        self, data: bytes, file_name: str, content_type: Optional[str]
+    ) -> str:
+        uploaded_file = self.bucket.upload_bytes(
+            data, file_name, content_type=content_type or "b2/x-auto"
+        )
+        return uploaded_file.id_
+
+    def start_large_file(self, file_name: str, content_type: Optional[str]) -> str:
+        response = self.api.session.start_large_file(
+            self.bucket.id_, file_name, content_type or "b2/x-auto", {}
+        )
+        return response["fileId"]
+
+    def upload_part(self, file_id: str, part_number: int, data: bytes) -> str:
+        sha1 = hashlib.sha1(data).hexdigest()
+        self.api.session.upload_part(
+            file_id, part_number, len(data), sha1, io.BytesIO(data)
+        )
+        return sha1
+
+    def upload_part_stream(
+        self, file_id: str, part_number: int, size: int, stream: BinaryIO
+    ) -> str:
+        """Upload a part of `size` bytes read from `stream` as it is sent.
+
+        The SHA1 is computed on the way and sent after the data, so the part
+        is never held in memory as a whole.
+        """
+        hashing_stream = b2.StreamWithHash(stream, stream_length=size)
+        self.api.session.upload_part(
+            file_id,
+            part_number,
+            hashing_stream.length,
+            "hex_digits_at_end",
+            hashing_stream,
+        )
+        return hashing_stream.hash
+
+    def finish_large_file(self, file_id: str, part_sha1s: list[str]) -> str:
+        response = self.api.session.finish_large_file(file_id, part_sha1s)
+        return response["fileId"]
+
+    def cancel_large_file(self, file_id: str):
+        self.api.session.cancel_large_file(file_id)
+
+    def download_url(self, file_id: str) -> str:
+        return self.api.get_download_url_for_fileid(file_id)
+
+
+@lru_cache()
+def b2_storage() -> B2Storage:
+    return B2Storage(b2_api())
@@ -0,0 +1,178 @@
+import asyncio
+import io
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Optional
+
+from storeapi.config import config
+from storeapi.libs.b2 import B2Storage, b2_storage
+from storeapi.metrics import b2_call_seconds
+from storeapi.request_timing import timed_external_call
+
+logger = logging.getLogger(__name__)
+
+# Longest a B2 thread waits for the next chunk of a streamed part
+CHUNK_TIMEOUT_SECONDS = 60
+
+
+class AsyncIteratorReader(io.RawIOBase):
+    """A blocking file object reading from an async iterator of chunks.
+
+    For b2sdk calls, which run in a thread: each read that runs out of data
+    fetches the next chunk from the event loop, so only one chunk is held at
+    a time. b2sdk rewinds request bodies before sending them, so seeking to
+    where the reader already is works; going back to data that was already
+    read doesn't.
+    """
+
+    def __init__(self, chunks: AsyncIterator[bytes], loop: asyncio.AbstractEventLoop):
+        self._chunks = chunks
+        self._loop = loop
+        self._pending = b""
+        self._done = False
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        target = offset if whence == io.SEEK_SET else self._position + offset
+        if whence == io.SEEK_END or target != self._position:
+            raise io.UnsupportedOperation(
+                f"Cannot seek a streamed part to {offset} (whence {whence}) after"
+                f" reading {self._position} bytes"
+            )
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        while not self._pending and not self._done:
+            future = asyncio.run_coroutine_threadsafe(
+                anext(self._chunks, None), self._loop
+            )
+            chunk = future.result(CHUNK_TIMEOUT_SECONDS)
+            if chunk is None:
+                self._done = True
+            else:
+                self._pending = chunk
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        self._position += size
+        return size
+
+
+class AsyncB2Storage:
+    """Async facade over B2Storage for use from request handlers.
+
+    b2sdk is synchronous, so every call runs in an executor dedicated to B2,
+    where slow uploads can't starve other users of the default executor.
+    `start` authorizes up front (the app calls it on startup) and keeps the
+    authorization fresh in the background, so no request pays for it. The
+    duration of each call goes to the b2_call_duration_seconds metric.
+    """
+
+    def __init__(
+        self,
+        create_storage: Callable[[], B2Storage],
+        max_workers: int = config.B2_UPLOAD_THREADS,
+        refresh_interval: float = config.B2_AUTH_REFRESH_SECONDS,
+    ):
+        self.create_storage = create_storage
+        self.refresh_interval = refresh_interval
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="b2"
+        )
+        self._storage: Optional[B2Storage] = None
+        self._starting: Optional[asyncio.Task] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        await self._get_storage()
+        if self._refresh_task is None:
+            self._refresh_task = asyncio.create_task(self._refresh_authorization())
+
+    async def stop(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            await asyncio.gather(self._refresh_task, return_exceptions=True)
+            self._refresh_task = None
+
+    async def upload_bytes(self, data: bytes, file_name: str, content_type) -> str:
+        return await self._call("upload_bytes", data, file_name, content_type)
+
+    async def start_large_file(self, file_name: str, content_type) -> str:
+        return await self._call("start_large_file", file_name, content_type)
+
+    async def upload_part(self, file_id: str, part_number: int, data: bytes) -> str:
+        return await self._call("upload_part", file_id, part_number, data)
+
+    async def upload_part_stream(
+        self, file_id: str, part_number: int, size: int, chunks: AsyncIterator[bytes]
+    ) -> str:
+        """Upload a part of `size` bytes while its chunks arrive."""
+        # Buffered, as b2sdk takes a short read for the end of the stream
+        stream = io.BufferedReader(
+            AsyncIteratorReader(chunks, asyncio.get_running_loop())
+        )
+        return await self._call(
+            "upload_part_stream", file_id, part_number, size, stream
+        )
+
+    async def finish_large_file(self, file_id: str, part_sha1s: list[str]) -> str:
+        return await self._call("finish_large_file", file_id, part_sha1s)
+
+    async def cancel_large_file(self, file_id: str):
+        return await self._call("cancel_large_file", file_id)
+
+    async def download_url(self, file_id: str) -> str:
+        return await self._call("download_url", file_id)
+
+    async def _run(self, operation: str, func, *args):
+        def timed():
+            start = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                b2_call_seconds.labels(operation).observe(time.perf_counter() - start)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, timed)
+
+    async def _call(self, operation: str, *args):
+        with timed_external_call("b2"):
+            storage = await self._get_storage()
+            return await self._run(operation, getattr(storage, operation), *args)
+
+    async def _get_storage(self) -> B2Storage:
+        # Authorize once, even if several requests arrive before it completes
+        if self._storage is None:
+            if self._starting is None:
+                logger.info("Authorizing B2 account")
+                self._starting = asyncio.ensure_future(
+                    self._run("authorize", self.create_storage)
+                )
+            try:
+                self._storage = await asyncio.shield(self._starting)
+            except Exception:
+                self._starting = None
+                raise
+        return self._storage
+
+    async def _refresh_authorization(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self._run("authorize", self._storage.authorize)
+                logger.info("Refreshed B2 authorization")
+            except Exception:
+                logger.exception("Could not refresh B2 authorization")
+
+
+b2_client = AsyncB2Storage(b2_storage)
@@ -0,0 +1,129 @@
+import asyncio
+import hashlib
+import logging
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Optional, Protocol
+
+from storeapi.config import config
+from storeapi.libs.b2.aio import AsyncB2Storage
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class AsyncReadable(Protocol):
+    async def read(self, size: int = -1) -> bytes: ...
+
+
+@dataclass
+class StoredFile:
+    file_url: str
+    content_hash: str
+    size: int
+    # None when an identical file was already stored and nothing was uploaded
+    file_id: Optional[str]
+
+    @property
+    def duplicate(self) -> bool:
+        return self.file_id is None
+
+
+# Given the SHA-256 hex digest of a file, return the URL of an identical file
+# that is already stored, if any
+FindDuplicate = Callable[[str], Awaitable[Optional[str]]]
+
+
+async def stream_upload(
+    file: AsyncReadable,
+    file_name: str,
+    content_type: Optional[str],
+    storage: AsyncB2Storage,
+    part_size: Optional[int] = None,
+    concurrency: Optional[int] = None,
+    find_duplicate: Optional[FindDuplicate] = None,
+) -> StoredFile:
+    """Upload `file` to B2 while it is being read.
+
+    Files that fit in a single part are uploaded in one go. Anything bigger
+    becomes a B2 large file: each part starts uploading as soon as it has been
+    read, with up to `concurrency` parts in flight. Reading waits for
+    a free slot, so memory use stays bounded however large the file is.
+
+    The content is hashed as it streams through. If `find_duplicate` knows
+    the hash, the file is not stored again: small files are never sent, and
+    a large file, whose hash is only known once all its parts are sent, is
+    cancelled instead of finished.
+    """
+    part_size = part_size or config.B2_PART_SIZE
+    concurrency = concurrency or config.B2_UPLOAD_CONCURRENCY
+    slots = asyncio.Semaphore(concurrency)
+    uploads: list[asyncio.Task] = []
+    buffer = bytearray()
+    large_file_id = None
+    content_hash = hashlib.sha256()
+    size = 0
+
+    async def upload_part(part_number: int, data: bytes) -> str:
+        try:
+            return await storage.upload_part(large_file_id, part_number, data)
+        finally:
+            slots.release()
+
+    async def submit_part(data: bytes):
+        await slots.acquire()
+        uploads.append(asyncio.create_task(upload_part(len(uploads) + 1, data)))
+        # Surface failed parts early instead of reading the rest of the file
+        for upload in uploads:
+            if upload.done() and not upload.cancelled() and upload.exception():
+                raise upload.exception()
+
+    async def find_duplicate_url() -> Optional[str]:
+        if find_duplicate is None:
+            return None
+        file_url = await find_duplicate(content_hash.hexdigest())
+        if file_url is not None:
+            logger.debug(f"{file_name} is already stored at {file_url}")
+        return file_url
+
+    try:
+        while chunk := await file.read(CHUNK_SIZE):
+            buffer += chunk
+            content_hash.update(chunk)
+            size += len(chunk)
+            # Only emit a part once more data follows it, so the last part is
+            # never empty and a large file always has at least two parts
+            while len(buffer) > part_size:
+                if large_file_id is None:
+                    large_file_id = await storage.start_large_file(
+                        file_name, content_type
+                    )
+                    logger.debug(f"Started B2 large file {large_file_id}")
+                await submit_part(bytes(buffer[:part_size]))
+                del buffer[:part_size]
+
+        if large_file_id is None:
+            duplicate_url = await find_duplicate_url()
+            if duplicate_url is not None:
+                return StoredFile(duplicate_url, content_hash.hexdigest(), size, None)
+            file_id = await storage.upload_bytes(bytes(buffer), file_name, content_type)
+        else:
+            await submit_part(bytes(buffer))
+            part_sha1s = await asyncio.gather(*uploads)
+            duplicate_url = await find_duplicate_url()
+            if duplicate_url is not None:
+                cancelled, large_file_id = large_file_id, None
+                await storage.cancel_large_file(cancelled)
+                return StoredFile(duplicate_url, content_hash.hexdigest(), size, None)
+            file_id = await storage.finish_large_file(large_file_id, part_sha1s)
+            logger.debug(f"Finished B2 large file {file_id} in {len(uploads)} parts")
+    except BaseException:
+        for upload in uploads:
+            upload.cancel()
+        await asyncio.gather(*uploads, return_exceptions=True)
+        if large_file_id is not None:
+            await storage.cancel_large_file(large_file_id)
+        raise
+
+    file_url = await storage.download_url(file_id)
+    return StoredFile(file_url, content_hash.hexdigest(), size, file_id)
@@ -1,7 +1,13 @@
+import atexit
 import logging
+import queue
+import threading
 from logging.config import dictConfig
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
 
 from storeapi.config import DevConfig, ProdConfig, config
+from storeapi.metrics import log_queue_size, log_records_dropped
 
 
 def obfuscated(email: str, obfuscated_length: int) -> str:
@@ -21,12 +27,161 @@ class EmailObfuscationFilter(logging.Filter):
         return True
 
 
+class DroppingQueueHandler(QueueHandler):
+    """Queues records for a QueueListener, without ever blocking for long.
+
+    Filters run here, in the thread that logs, so that context such as the
+    request's correlation id is captured. When the queue is full, records
+    are dropped according to `policy` and counted in `dropped`, and in the
+    log_records_dropped_total metric.
+    """
+
+    def __init__(
+        self,
+        queue: queue.Queue,
+        route: str,
+        policy: str = "drop_newest",
+        block_seconds: float = 0.1,
+    ):
+        super().__init__(queue)
+        self.route = route
+        self.policy = policy
+        self.block_seconds = block_seconds
+        self.dropped = 0
+        self._dropped_lock = threading.Lock()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = super().prepare(record)
+        record.log_route = self.route
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            if self.policy == "block":
+                self.queue.put(record, timeout=self.block_seconds)
+            else:
+                self.queue.put_nowait(record)
+            log_queue_size.set(self.queue.qsize())
+            return
+        except queue.Full:
+            pass
+
+        if self.policy == "drop_oldest":
+            try:
+                self.queue.get_nowait()
+                self.queue.put_nowait(record)
+            except (queue.Empty, queue.Full):
+                pass
+        with self._dropped_lock:
+            self.dropped += 1
+        log_records_dropped.inc()
+
+
+class RoutingHandler(logging.Handler):
+    """Hands each record to the handlers of the logger that queued it."""
+
+    def __init__(self, routes: dict[str, list[logging.Handler]]):
+        super().__init__()
+        self.routes = routes
+
+    def handle(self, record: logging.LogRecord) -> bool:
+        for handler in self.routes.get(record.log_route, []):
+            if record.levelno >= handler.level:
+                handler.handle(record)
+        return True
+
+
+class LogListener(QueueListener):
+    def dequeue(self, block: bool) -> logging.LogRecord:
+        record = super().dequeue(block)
+        log_queue_size.set(self.queue.qsize())
+        return record
+
+    def enqueue_sentinel(self):
+        # The queue may be full; the listener thread is draining it
+        self.queue.put(self._sentinel)
+
+
+class LogPipeline:
+    """Moves the handlers of the configured loggers onto a background thread.
+
+    Each logger gets a DroppingQueueHandler in place of its handlers, and one
+    QueueListener thread feeds every record to the handlers of the logger it
+    came from.
+    """
+
+    def __init__(self, logger_names: list[str]):
+        self.queue: queue.Queue = queue.Queue(config.LOG_QUEUE_MAX_SIZE)
+        self.queue_handlers: list[DroppingQueueHandler] = []
+        loggers = [logging.getLogger(name) for name in logger_names]
+        # Loggers can share handlers, so note every handler's filters before
+        # moving any of them; filters must see the logging thread's context
+        handler_filters = {
+            handler: handler.filters
+            for logger in loggers
+            for handler in logger.handlers
+        }
+        routes = {}
+        for logger in loggers:
+            queue_handler = DroppingQueueHandler(
+                self.queue,
+                route=logger.name,
+                policy=config.LOG_QUEUE_FULL_POLICY,
+                block_seconds=config.LOG_QUEUE_BLOCK_SECONDS,
+            )
+            for handler in logger.handlers:
+                for filter in handler_filters[handler]:
+                    if filter not in queue_handler.filters:
+                        queue_handler.addFilter(filter)
+            routes[logger.name] = logger.handlers
+            logger.handlers = [queue_handler]
+            self.queue_handlers.append(queue_handler)
+        for handler in handler_filters:
+            handler.filters = []
+        self.routes = routes
+        self.listener = LogListener(self.queue, RoutingHandler(routes))
+
+    @property
+    def dropped(self) -> int:
+        return sum(handler.dropped for handler in self.queue_handlers)
+
+    def start(self):
+        self.listener.start()
+
+    def stop(self):
+        """Write out the queued records and stop the background thread."""
+        self.listener.stop()
+        for handlers in self.routes.values():
+            for handler in handlers:
+                handler.flush()
+
+
+# Loggers whose handlers write from the log thread. uvicorn.access logs every
+# request, so it gets its own queue rather than relying on propagation.
+PIPELINE_LOGGERS = ["uvicorn", "uvicorn.access", "storeapi", "databases", "aiosqlite"]
+
+log_pipeline: Optional[LogPipeline] = None
+
+
+def shutdown_logging():
+    global log_pipeline
+    if log_pipeline is not None:
+        log_pipeline.stop()
+        log_pipeline = None
+
+
+atexit.register(shutdown_logging)
+
+
 handlers = ["default", "rotating_file"]
 if isinstance(config, ProdConfig):
     handlers = ["default", "rotating_file", "logtail"]
 
 
 def configure_logging() -> None:
+    global log_pipeline
+    shutdown_logging()
+
     dictConfig(
         {
             "version": 1,
@@ -81,6 +236,11 @@ def configure_logging() -> None:
             },
             "loggers": {
                 "uvicorn": {"handlers": ["default", "rotating_file"], "level": "INFO"},
+                "uvicorn.access": {
+                    "handlers": ["default", "rotating_file"],
+                    "level": "INFO",
+                    "propagate": False
+                },
                 "storeapi": {
                     "handlers": handlers,
                     "level": "DEBUG" if isinstance(config, DevConfig) else "INFO",
@@ -90,4 +250,6 @@ def configure_logging() -> None:
                 "aiosqlite": {"handlers": ["default"], "level": "WARNING"}
             }
         }
-    )
\ No newline at end of file
+    )
+    log_pipeline = LogPipeline(PIPELINE_LOGGERS)
+    log_pipeline.start()
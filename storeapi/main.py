@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from contextlib import asynccontextmanager
 
@@ -5,11 +6,21 @@ from asgi_correlation_id import CorrelationIdMiddleware
 from fastapi import FastAPI, HTTPException
 from fastapi.exception_handlers import http_exception_handler
 
-from storeapi.database import database
-from storeapi.logging_conf import configure_logging
+from storeapi.config import config
+from storeapi.database import database, read_database
+from storeapi.jobs import JobWorker
+from storeapi.libs.b2.aio import b2_client
+from storeapi.logging_conf import configure_logging, shutdown_logging
+from storeapi.metrics import mark_process_dead
+from storeapi.replicas import ReadYourWritesMiddleware
+from storeapi.request_timing import TimingMiddleware
+from storeapi.routers.job import router as job_router
+from storeapi.routers.metrics import router as metrics_router
 from storeapi.routers.post import router as post_router
+from storeapi.routers.upload import expire_upload_sessions_regularly
 from storeapi.routers.upload import router as upload_router
 from storeapi.routers.user import router as user_router
+from storeapi.tasks import email_outbox, http_clients
 
 logger = logging.getLogger(__name__)
 
@@ -18,13 +29,36 @@ logger = logging.getLogger(__name__)
 async def lifespan(app: FastAPI):
     configure_logging()
     await database.connect()
+    await read_database.connect()
+    email_outbox.start()
+    job_worker = JobWorker(database)
+    if config.JOB_WORKER_ENABLED:
+        job_worker.start()
+    if config.B2_KEY_ID:
+        await b2_client.start()
+    upload_cleanup = asyncio.create_task(expire_upload_sessions_regularly())
     yield
+    upload_cleanup.cancel()
+    await asyncio.gather(upload_cleanup, return_exceptions=True)
+    await b2_client.stop()
+    await job_worker.stop()
+    await email_outbox.stop()
+    await http_clients.aclose()
+    await read_database.disconnect()
     await database.disconnect()
+    shutdown_logging()
+    mark_process_dead()
 
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(ReadYourWritesMiddleware, router=read_database)
+# The last middleware added runs first, so timings are logged with the
+# correlation id
+app.add_middleware(TimingMiddleware)
 app.add_middleware(CorrelationIdMiddleware)
 
+app.include_router(job_router)
+app.include_router(metrics_router)
 app.include_router(post_router)
 app.include_router(upload_router)
 app.include_router(user_router)
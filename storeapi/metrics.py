@@ -0,0 +1,139 @@
+"""The app's Prometheus metrics, served by GET /metrics.
+
+Metrics are updated where things happen, from any thread. Under several
+uvicorn workers each process has its own values: point
+PROMETHEUS_MULTIPROC_DIR at an empty directory before starting the server,
+and every process keeps its metrics in files there, which /metrics adds up.
+Each process calls `mark_process_dead` as it exits, so its live gauges are
+dropped; its counters and histograms are kept, so totals never go down.
+"""
+import os
+
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Upper bounds, in seconds, of the latency histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+http_requests = Counter(
+    "http_requests",
+    "HTTP requests handled, by route template and status code.",
+    ["method", "route", "status"],
+)
+http_request_seconds = Histogram(
+    "http_request_duration_seconds",
+    "Time until the HTTP response was sent, by route template.",
+    ["method", "route"],
+    buckets=DEFAULT_BUCKETS,
+)
+http_requests_in_progress = Gauge(
+    "http_requests_in_progress",
+    "HTTP requests being handled.",
+    multiprocess_mode="livesum",
+)
+external_call_seconds = Histogram(
+    "external_call_duration_seconds",
+    "Duration of calls to external services (b2, mailgun, deepai).",
+    ["target"],
+    buckets=DEFAULT_BUCKETS,
+)
+b2_call_seconds = Histogram(
+    "b2_call_duration_seconds",
+    "Duration of B2 calls, by operation.",
+    ["operation"],
+    buckets=DEFAULT_BUCKETS,
+)
+
+db_pool_connections_max = Gauge(
+    "db_pool_connections_max",
+    "Database connections that may be in use at once.",
+    ["pool"],
+    multiprocess_mode="livesum",
+)
+db_pool_connections_in_use = Gauge(
+    "db_pool_connections_in_use",
+    "Database connections in use.",
+    ["pool"],
+    multiprocess_mode="livesum",
+)
+db_pool_waiting = Gauge(
+    "db_pool_waiting",
+    "Tasks waiting for a database connection.",
+    ["pool"],
+    multiprocess_mode="livesum",
+)
+db_pool_acquired = Counter(
+    "db_pool_acquired", "Database connections handed out.", ["pool"]
+)
+db_pool_timeouts = Counter(
+    "db_pool_timeouts", "Waits for a database connection that timed out.", ["pool"]
+)
+db_pool_acquire_seconds = Histogram(
+    "db_pool_acquire_duration_seconds",
+    "Time spent waiting for a database connection.",
+    ["pool"],
+    buckets=DEFAULT_BUCKETS,
+)
+
+# The jobs table is shared, so it is counted when scraped rather than summed
+# across processes
+job_queue_depth = Gauge(
+    "job_queue_depth",
+    "Background jobs by status.",
+    ["status"],
+    multiprocess_mode="mostrecent",
+)
+email_outbox_queue_depth = Gauge(
+    "email_outbox_queue_depth",
+    "Emails waiting to be sent.",
+    multiprocess_mode="livesum",
+)
+password_hash_queue_depth = Gauge(
+    "password_hash_queue_depth",
+    "bcrypt calls waiting for a thread.",
+    multiprocess_mode="livesum",
+)
+password_hash_wait_seconds = Histogram(
+    "password_hash_wait_seconds",
+    "Time bcrypt calls waited for a thread.",
+    buckets=DEFAULT_BUCKETS,
+)
+log_queue_size = Gauge(
+    "log_queue_size",
+    "Log records waiting to be written.",
+    multiprocess_mode="livesum",
+)
+log_records_dropped = Counter(
+    "log_records_dropped", "Log records dropped because the log queue was full."
+)
+
+cache_hits = Counter("cache_hits", "Lookups that found a cached value.", ["cache"])
+cache_misses = Counter("cache_misses", "Lookups that found no cached value.", ["cache"])
+
+
+def multiprocess_dir_set() -> bool:
+    return "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+
+def latest_metrics() -> bytes:
+    """The metrics of this process, or of every process in multiprocess
+    mode, in the Prometheus text format."""
+    if not multiprocess_dir_set():
+        return generate_latest(REGISTRY)
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry)
+
+
+def mark_process_dead():
+    """Drop this process's live gauges; call it when the process exits."""
+    if multiprocess_dir_set():
+        multiprocess.mark_process_dead(os.getpid())
@@ -0,0 +1,14 @@
+from typing import Optional
+
+from pydantic import BaseModel, ConfigDict
+
+
+class Job(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: int
+    name: str
+    status: str
+    attempts: int
+    max_attempts: int
+    last_error: Optional[str] = None
@@ -1,3 +1,4 @@
+from enum import Enum
 from typing import Optional
 
 from pydantic import BaseModel, ConfigDict
@@ -45,3 +46,18 @@ class PostLikeIn(BaseModel):
 class PostLike(PostLikeIn):
     id: int
     user_id: int
+
+
+class BatchItemStatus(str, Enum):
+    created = "created"
+    post_not_found = "post_not_found"
+    already_liked = "already_liked"
+
+
+class BatchItemResult(BaseModel):
+    post_id: int
+    status: BatchItemStatus
+
+
+class BatchResults(BaseModel):
+    results: list[BatchItemResult]
@@ -0,0 +1,26 @@
+from typing import Optional
+
+from pydantic import BaseModel, ConfigDict
+
+
+class UploadSessionIn(BaseModel):
+    file_name: str
+    content_type: Optional[str] = None
+
+
+class UploadPart(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+    part_number: int
+    size: int
+    sha1: str
+
+
+class UploadSession(UploadSessionIn):
+    model_config = ConfigDict(from_attributes=True)
+
+    id: str
+    status: str
+    part_size: int
+    parts: list[UploadPart] = []
+    file_url: Optional[str] = None
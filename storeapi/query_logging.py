@@ -0,0 +1,48 @@
+import logging
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from sqlalchemy.sql import ClauseElement
+from storeapi.cache import TTLCache
+
+# Compiled SQL keyed by statement shape. Bound values aren't part of the
+# SQL text, so every request with the same query shape shares an entry.
+# Entries never go stale, only the least recently used ones are evicted.
+_compiled_sql = TTLCache(maxsize=512, ttl=float("inf"), name="sql_text")
+
+
+def compiled_sql(query: ClauseElement) -> str:
+    """Return the SQL text of `query`, compiling each statement shape once."""
+    cache_key = query._generate_cache_key()
+    if cache_key is None:
+        return str(query)
+
+    sql = _compiled_sql.get(cache_key.key)
+    if sql is None:
+        sql = str(query)
+        _compiled_sql.set(cache_key.key, sql)
+    return sql
+
+
+@contextmanager
+def log_query(logger: logging.Logger, query: ClauseElement) -> Iterator[None]:
+    """Log `query` and how long the block that runs it took, at DEBUG level.
+
+    Nothing is compiled or timed unless the logger is enabled for DEBUG.
+    """
+    if not logger.isEnabledFor(logging.DEBUG):
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration_ms = (time.perf_counter() - start) * 1000
+        logger.debug(
+            "%s [%.2f ms]",
+            compiled_sql(query),
+            duration_ms,
+            extra={"duration_ms": round(duration_ms, 3)},
+        )
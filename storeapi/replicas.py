@@ -0,0 +1,191 @@
+"""Routing of read-only queries to read replicas.
+
+Reads go to a replica picked round-robin or by fewest queries in flight. If
+the replica fails, the query is retried on the primary and the replica sits
+out for a while. Users who just wrote something read from the primary for
+a few seconds, so replication lag never hides their own writes.
+
+Each worker process remembers its own recent writers, and
+`ReadYourWritesMiddleware` also gives a client that wrote a cookie with the
+time of the write, so its next requests read from the primary whichever
+worker serves them, and whether or not they are logged in.
+"""
+import itertools
+import logging
+import math
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Optional
+
+from databases import Database
+from fastapi import Request
+from storeapi.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# Cookie holding the time, in seconds since the epoch, of the client's last
+# write
+LAST_WRITE_COOKIE = "last_write"
+
+
+@dataclass
+class RequestWrites:
+    # When the client last wrote, from its cookie
+    last_write: Optional[float] = None
+    wrote: bool = False
+
+
+_request_writes: ContextVar[Optional[RequestWrites]] = ContextVar(
+    "request_writes", default=None
+)
+
+
+def last_write_from_cookie(scope) -> Optional[float]:
+    try:
+        return float(Request(scope).cookies[LAST_WRITE_COOKIE])
+    except (KeyError, ValueError):
+        return None
+
+
+class ReplicaRouter:
+    def __init__(
+        self,
+        primary: Database,
+        replicas: list[Database],
+        selection: str = "round_robin",
+        sticky_seconds: float = 10,
+        retry_seconds: float = 30,
+        max_sticky_users: int = 10_000,
+    ):
+        self.primary = primary
+        self.replicas = replicas
+        self.selection = selection
+        self.sticky_seconds = sticky_seconds
+        self.retry_seconds = retry_seconds
+        self._recent_writers = TTLCache(maxsize=max_sticky_users, ttl=sticky_seconds)
+        self._in_flight = [0] * len(replicas)
+        self._down_until = [0.0] * len(replicas)
+        self._turns = itertools.count()
+
+    async def connect(self):
+        for index, replica in enumerate(self.replicas):
+            try:
+                await replica.connect()
+            except Exception:
+                logger.exception(f"Could not connect to read replica {index}")
+                self._mark_down(index)
+
+    async def disconnect(self):
+        for replica in self.replicas:
+            if replica.is_connected:
+                await replica.disconnect()
+
+    def record_write(self, email: Optional[str]):
+        """Send the reads of `email`, and of the client of the request being
+        handled, to the primary for a while."""
+        if not self.replicas:
+            return
+        if email is not None:
+            self._recent_writers.set(email, True)
+        writes = _request_writes.get()
+        if writes is not None:
+            writes.wrote = True
+
+    def is_sticky(self, email: Optional[str]) -> bool:
+        """Whether `email`, or the client of the request being handled, wrote
+        recently, so must read from the primary."""
+        if email is not None and self._recent_writers.get(email):
+            return True
+        writes = _request_writes.get()
+        return (
+            writes is not None
+            and writes.last_write is not None
+            and time.time() - writes.last_write < self.sticky_seconds
+        )
+
+    def last_write_cookie(self) -> str:
+        """A Set-Cookie header value recording a write made now."""
+        return (
+            f"{LAST_WRITE_COOKIE}={time.time():.3f}; "
+            f"Max-Age={math.ceil(self.sticky_seconds)}; Path=/; HttpOnly; "
+            "SameSite=Lax"
+        )
+
+    def choose_replica(self, email: Optional[str] = None) -> Optional[int]:
+        """Index of the replica to read from, or None to use the primary."""
+        if not self.replicas or self.is_sticky(email):
+            return None
+
+        now = time.monotonic()
+        available = [
+            index
+            for index in range(len(self.replicas))
+            if self._down_until[index] <= now
+        ]
+        if not available:
+            return None
+        if self.selection == "least_busy":
+            return min(available, key=lambda index: self._in_flight[index])
+        return available[next(self._turns) % len(available)]
+
+    async def fetch_all(self, query, email: Optional[str] = None) -> list:
+        return await self._read("fetch_all", query, email)
+
+    async def fetch_one(self, query, email: Optional[str] = None):
+        return await self._read("fetch_one", query, email)
+
+    async def fetch_val(self, query, email: Optional[str] = None) -> Any:
+        return await self._read("fetch_val", query, email)
+
+    async def _read(self, method: str, query, email: Optional[str]):
+        index = self.choose_replica(email)
+        if index is None:
+            return await getattr(self.primary, method)(query)
+
+        self._in_flight[index] += 1
+        try:
+            return await getattr(self.replicas[index], method)(query)
+        except Exception:
+            logger.exception(f"Read replica {index} failed, reading from primary")
+            self._mark_down(index)
+        finally:
+            self._in_flight[index] -= 1
+
+        return await getattr(self.primary, method)(query)
+
+    def _mark_down(self, index: int):
+        self._down_until[index] = time.monotonic() + self.retry_seconds
+
+
+class ReadYourWritesMiddleware:
+    """Carries `router`'s read-your-writes stickiness across worker processes
+    in a cookie.
+
+    A plain ASGI middleware, so the endpoint runs in the context where the
+    request's writes are tracked.
+    """
+
+    def __init__(self, app, router: ReplicaRouter):
+        self.app = app
+        self.router = router
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        writes = RequestWrites(last_write=last_write_from_cookie(scope))
+        token = _request_writes.set(writes)
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and writes.wrote:
+                headers = list(message.get("headers", []))
+                cookie = self.router.last_write_cookie()
+                headers.append((b"set-cookie", cookie.encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_cookie)
+        finally:
+            _request_writes.reset(token)
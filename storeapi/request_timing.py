@@ -0,0 +1,169 @@
+"""Where each request spends its time.
+
+`TimingMiddleware` gives every HTTP request a `RequestTimings`, which the
+code that talks to the database and to external services (B2, Mailgun,
+DeepAI) adds to through `timed_db_query` and `timed_external_call`. When the
+response starts, the timings so far are sent in a Server-Timing header; once
+it has been sent, they are logged with the route template, and with the
+correlation id by the logging filters. Request counts and latencies, and
+the latency of external calls, also go to the Prometheus metrics.
+"""
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Iterator, Optional
+
+from storeapi.config import config
+from storeapi.metrics import (
+    external_call_seconds,
+    http_request_seconds,
+    http_requests,
+    http_requests_in_progress,
+)
+
+logger = logging.getLogger(__name__)
+
+# Route label of requests that matched no route, so that arbitrary paths
+# don't each become a time series
+UNMATCHED_ROUTE = "unmatched"
+
+
+@dataclass
+class RequestTimings:
+    start: float = field(default_factory=time.perf_counter)
+    db_queries: int = 0
+    db_seconds: float = 0.0
+    # Seconds spent waiting on each external service
+    external_seconds: dict[str, float] = field(default_factory=dict)
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.start
+
+    def server_timing(self) -> str:
+        """The timings as a Server-Timing header value, in milliseconds."""
+        metrics = [
+            f'db;dur={self.db_seconds * 1000:.2f};desc="{self.db_queries} queries"'
+        ]
+        for target, seconds in self.external_seconds.items():
+            metrics.append(f"{target};dur={seconds * 1000:.2f}")
+        metrics.append(f"total;dur={self.elapsed() * 1000:.2f}")
+        return ", ".join(metrics)
+
+    def log_fields(self) -> dict:
+        return {
+            "duration_ms": round(self.elapsed() * 1000, 3),
+            "db_queries": self.db_queries,
+            "db_ms": round(self.db_seconds * 1000, 3),
+            "external_ms": {
+                target: round(seconds * 1000, 3)
+                for target, seconds in self.external_seconds.items()
+            },
+        }
+
+
+_timings: ContextVar[Optional[RequestTimings]] = ContextVar(
+    "request_timings", default=None
+)
+
+
+def current_timings() -> Optional[RequestTimings]:
+    """The timings of the request being handled, if any."""
+    return _timings.get()
+
+
+@contextmanager
+def timed_db_query(count: int = 1) -> Iterator[None]:
+    """Add the duration of the block and `count` queries to the request."""
+    timings = _timings.get()
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.db_queries += count
+        timings.db_seconds += time.perf_counter() - start
+
+
+@contextmanager
+def timed_external_call(target: str) -> Iterator[None]:
+    """Record the duration of the block as a call to `target`, and add it to
+    the request's time spent on `target`."""
+    timings = _timings.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        external_call_seconds.labels(target).observe(seconds)
+        if timings is not None:
+            timings.external_seconds[target] = (
+                timings.external_seconds.get(target, 0.0) + seconds
+            )
+
+
+class TimingMiddleware:
+    """Times each HTTP request; add it inside CorrelationIdMiddleware.
+
+    A plain ASGI middleware, so the endpoint runs in the context where the
+    timings were set, and streamed responses aren't buffered.
+    """
+
+    def __init__(self, app, server_timing: bool = config.SERVER_TIMING_ENABLED):
+        self.app = app
+        self.server_timing = server_timing
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        timings = RequestTimings()
+        token = _timings.set(timings)
+        http_requests_in_progress.inc()
+        status_code = 500
+        # Taken when the response is complete, before any background tasks
+        log_fields: Optional[dict] = None
+
+        async def send_with_timings(message):
+            nonlocal status_code, log_fields
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if self.server_timing:
+                    headers = list(message.get("headers", []))
+                    headers.append(
+                        (b"server-timing", timings.server_timing().encode("latin-1"))
+                    )
+                    message = {**message, "headers": headers}
+            elif message["type"] == "http.response.body" and not message.get(
+                "more_body", False
+            ):
+                log_fields = timings.log_fields()
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            _timings.reset(token)
+            http_requests_in_progress.dec()
+            route = scope.get("route")
+            route_path = route.path if route is not None else None
+            method = scope["method"]
+            log_fields = log_fields or timings.log_fields()
+            route_label = route_path or UNMATCHED_ROUTE
+            http_requests.labels(method, route_label, str(status_code)).inc()
+            http_request_seconds.labels(method, route_label).observe(
+                log_fields["duration_ms"] / 1000
+            )
+            logger.info(
+                f"{method} {route_path or scope['path']} {status_code}",
+                extra={
+                    "method": method,
+                    "route": route_path,
+                    "status_code": status_code,
+                    **log_fields,
+                },
+            )
@@ -0,0 +1,170 @@
+"""Caching of whole GET responses, invalidated through generation counters.
+
+Every cache key includes the current generation of the scopes it depends on,
+e.g. `posts` for post listings or `post:12` for one post's page. Invalidating
+a scope bumps its generation, so later reads miss without anyone having to
+find and delete the old entries, which simply age out. Because generations
+are read before the response is built, a response built from data that was
+changed meanwhile is stored under a generation nobody asks for any more.
+
+Responses get an ETag, so clients that send If-None-Match get a 304.
+"""
+import hashlib
+import itertools
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import Awaitable, Callable, Optional, Protocol
+
+from fastapi import Request, Response
+from storeapi.cache import TTLCache
+from storeapi.config import config
+from storeapi.metrics import cache_hits, cache_misses
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    body: bytes
+    headers: dict = field(default_factory=dict)
+
+    @cached_property
+    def etag(self) -> str:
+        return f'"{hashlib.blake2b(self.body, digest_size=16).hexdigest()}"'
+
+    def to_response(self, request: Request) -> Response:
+        etag = self.etag
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        return Response(
+            self.body,
+            media_type="application/json",
+            headers={**self.headers, "ETag": etag},
+        )
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+class CacheBackend(Protocol):
+    """Where cached responses and generations live.
+
+    A backend shared between processes (e.g. Redis, with INCR for
+    generations) makes invalidation immediate everywhere. A backend that
+    evicts generations must never hand out a generation number again, or
+    responses cached under it would be served after an invalidation.
+    """
+
+    async def get(self, key: str) -> Optional[CachedResponse]: ...
+
+    async def set(self, key: str, value: CachedResponse, ttl: float): ...
+
+    async def get_generation(self, scope: str) -> int: ...
+
+    async def incr_generation(self, scope: str) -> int: ...
+
+    async def clear(self): ...
+
+
+class InMemoryBackend:
+    """A per-process backend; other processes only see writes after the TTL."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.responses = TTLCache(maxsize=maxsize, ttl=ttl)
+        # One per scope, evicted like responses. Each new generation comes from
+        # a single counter, so a scope that is evicted and comes back never
+        # reuses an old number.
+        self.generations = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._next_generation = itertools.count(1)
+
+    async def get(self, key: str) -> Optional[CachedResponse]:
+        return self.responses.get(key)
+
+    async def set(self, key: str, value: CachedResponse, ttl: float):
+        self.responses.set(key, value, ttl=ttl)
+
+    async def get_generation(self, scope: str) -> int:
+        generation = self.generations.get(scope)
+        if generation is None:
+            generation = await self.incr_generation(scope)
+        return generation
+
+    async def incr_generation(self, scope: str) -> int:
+        generation = next(self._next_generation)
+        self.generations.set(scope, generation)
+        return generation
+
+    async def clear(self):
+        self.responses.clear()
+        self.generations.clear()
+
+
+Render = Callable[[], Awaitable[tuple[bytes, dict]]]
+
+
+class ResponseCache:
+    def __init__(self, backend: CacheBackend, ttl: float, enabled: bool = True):
+        self.backend = backend
+        self.ttl = ttl
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    async def respond(
+        self,
+        request: Request,
+        scopes: list[str],
+        params: tuple,
+        render: Render,
+        fresh: bool = False,
+    ) -> Response:
+        """Answer from the cache, or with `render()`'s body and headers.
+
+        `scopes` are what the response depends on and `params` whatever
+        else tells responses apart, like the page asked for. A `fresh`
+        response is always rendered, and replaces the cached one.
+        """
+        if not self.enabled:
+            return CachedResponse(*await render()).to_response(request)
+
+        generations = [await self.backend.get_generation(scope) for scope in scopes]
+        key = repr((request.url.path, tuple(zip(scopes, generations)), params))
+        cached = None if fresh else await self.backend.get(key)
+        if not fresh:
+            if cached is None:
+                self.misses += 1
+                cache_misses.labels("response").inc()
+            else:
+                self.hits += 1
+                cache_hits.labels("response").inc()
+        if cached is None:
+            cached = CachedResponse(*await render())
+            await self.backend.set(key, cached, self.ttl)
+
+        return cached.to_response(request)
+
+    async def invalidate(self, *scopes: str):
+        if not self.enabled:
+            return
+        for scope in scopes:
+            await self.backend.incr_generation(scope)
+
+    async def clear(self):
+        await self.backend.clear()
+
+
+response_cache = ResponseCache(
+    InMemoryBackend(
+        maxsize=config.RESPONSE_CACHE_MAX_SIZE, ttl=config.RESPONSE_CACHE_TTL_SECONDS
+    ),
+    ttl=config.RESPONSE_CACHE_TTL_SECONDS,
+    enabled=config.RESPONSE_CACHE_ENABLED,
+)
+
+POSTS_SCOPE = "posts"
+
+
+def post_scope(post_id: int) -> str:
+    return f"post:{post_id}"
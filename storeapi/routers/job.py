@@ -0,0 +1,28 @@
+import json
+import logging
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, HTTPException
+from storeapi.database import database
+from storeapi.jobs import get_job
+from storeapi.models.job import Job
+from storeapi.models.user import User
+from storeapi.security import get_current_user
+
+router = APIRouter()
+
+logger = logging.getLogger(__name__)
+
+
+@router.get("/job/{job_id}", response_model=Job)
+async def get_job_status(
+    job_id: int, current_user: Annotated[User, Depends(get_current_user)]
+):
+    logger.info(f"Getting status of job {job_id}")
+
+    job = await get_job(database, job_id)
+    # Users may only see their own jobs
+    if not job or json.loads(job.payload).get("email") != current_user.email:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return job
@@ -0,0 +1,26 @@
+import asyncio
+import logging
+
+from fastapi import APIRouter, Response
+from prometheus_client import CONTENT_TYPE_LATEST
+from storeapi.database import database
+from storeapi.jobs import JobStatus, count_jobs
+from storeapi.metrics import job_queue_depth, latest_metrics
+
+router = APIRouter()
+
+logger = logging.getLogger(__name__)
+
+
+async def update_job_metrics():
+    counts = await count_jobs(database)
+    for status in JobStatus:
+        job_queue_depth.labels(status.value).set(counts.get(status.value, 0))
+
+
+@router.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    await update_job_metrics()
+    # Reads the files of every process in multiprocess mode
+    body = await asyncio.to_thread(latest_metrics)
+    return Response(body, media_type=CONTENT_TYPE_LATEST)
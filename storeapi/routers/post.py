@@ -1,11 +1,33 @@
+import csv
+import io
 import logging
 from enum import Enum
-from typing import Annotated
+from typing import Annotated, AsyncIterator, MutableMapping, Optional
 
+import orjson
 import sqlalchemy
-from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request
-from storeapi.database import comment_table, database, like_table, post_table
+from fastapi import (
+    APIRouter,
+    Body,
+    Depends,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+)
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from storeapi.database import (
+    comment_table,
+    database,
+    insert_ignoring_conflicts,
+    like_table,
+    post_table,
+    read_database,
+)
+from storeapi.jobs import enqueue_job
 from storeapi.models.post import (
+    BatchItemStatus,
+    BatchResults,
     Comment,
     CommentIn,
     PostLike,
@@ -16,35 +38,91 @@ from storeapi.models.post import (
     UserPostWithLikes,
 )
 from storeapi.models.user import User
-from storeapi.security import get_current_user
-from storeapi.tasks import generate_and_add_to_post
+from storeapi.pagination import (
+    NEXT_CURSOR_HEADER,
+    decode_cursor,
+    encode_cursor,
+    invalid_cursor_exception,
+)
+from storeapi.query_logging import log_query
+from storeapi.response_cache import POSTS_SCOPE, post_scope, response_cache
+from storeapi.security import get_current_user, get_optional_user_email
 
 router = APIRouter()
 
 logger = logging.getLogger(__name__)
 
-select_post_and_likes = (
-    sqlalchemy.select(post_table, sqlalchemy.func.count(like_table.c.id).label("likes"))
-    .select_from(post_table.outerjoin(like_table))
-    .group_by(post_table.c.id)
+JOB_ID_HEADER = "X-Job-Id"
+
+# Most items a client may send to the batch write endpoints at once
+MAX_BATCH_ITEMS = 500
+
+# Read endpoints turn rows into JSON directly instead of validating each one
+# through the response model, which is only kept for the OpenAPI schema. The
+# columns they select must therefore match the models' fields.
+POST_FIELDS = tuple(UserPostWithLikes.model_fields)
+
+select_post_and_likes = sqlalchemy.select(
+    post_table.c.id,
+    post_table.c.body,
+    post_table.c.user_id,
+    post_table.c.image_url,
+    post_table.c.like_count.label("likes"),
 )
 
 
+def rows_to_dicts(rows: list) -> list[dict]:
+    """Map rows to dicts far faster than looking up each column by name.
+
+    Rows are read as plain tuples, skipping result processing: fine for the
+    integer and string columns served here, not for e.g. dates or booleans.
+    """
+    if not rows:
+        return []
+    # Column names can be str subclasses, which orjson refuses as keys
+    keys = tuple(str(key) for key in rows[0]._mapping.keys())
+    return [dict(zip(keys, row._mapping)) for row in rows]
+
+
+def post_to_dict(row) -> dict:
+    return {field: row[field] for field in POST_FIELDS}
+
+
 async def find_post(post_id: int):
     logger.info(f"Finding post with id {post_id}")
 
     query = post_table.select().where(post_table.c.id == post_id)
 
-    logger.debug(query)
+    with log_query(logger, query):
+        return await database.fetch_one(query)
+
+
+async def find_existing_post_ids(post_ids: set[int]) -> set[int]:
+    query = sqlalchemy.select(post_table.c.id).where(post_table.c.id.in_(post_ids))
+
+    with log_query(logger, query):
+        return {row.id for row in await database.fetch_all(query)}
+
 
-    return await database.fetch_one(query)
+def insert_new_likes(values: list[dict]):
+    """Insert likes, skipping those the users already have; the query returns
+    the id and post_id of each like it inserted.
+
+    Relies on the unique index on (post_id, user_id), so two requests liking
+    the same post at once can't both insert.
+    """
+    return (
+        insert_ignoring_conflicts(like_table, ["post_id", "user_id"])
+        .values(values)
+        .returning(like_table.c.id, like_table.c.post_id)
+    )
 
 
 @router.post("/post", response_model=UserPost, status_code=201)
 async def create_post(
     post: UserPostIn,
-    background_tasks: BackgroundTasks,
     request: Request,
+    response: Response,
     current_user: Annotated[User, Depends(get_current_user)],
     prompt: str = None,
 ):
@@ -53,18 +131,25 @@ async def create_post(
     data = {**post.model_dump(), "user_id": current_user.id}
     query = post_table.insert().values(data)
 
-    logger.debug(query)
-
-    last_record_id = await database.execute(query)
-    if prompt:
-        background_tasks.add_task(
-            generate_and_add_to_post,
-            current_user.email,
-            last_record_id,
-            request.url_for("get_post_with_comments", post_id=last_record_id),
-            database,
-            prompt,
-        )
+    async with database.transaction():
+        with log_query(logger, query):
+            last_record_id = await database.execute(query)
+        if prompt:
+            post_url = request.url_for("get_post_with_comments", post_id=last_record_id)
+            job_id = await enqueue_job(
+                database,
+                "generate_and_add_to_post",
+                {
+                    "email": current_user.email,
+                    "post_id": last_record_id,
+                    "post_url": str(post_url),
+                    "prompt": prompt,
+                },
+            )
+            response.headers[JOB_ID_HEADER] = str(job_id)
+
+    read_database.record_write(current_user.email)
+    await response_cache.invalidate(POSTS_SCOPE)
     return {**data, "id": last_record_id}
 
 
@@ -75,7 +160,13 @@ class PostSorting(str, Enum):
 
 
 @router.get("/post", response_model=list[UserPostWithLikes])
-async def get_all_posts(sorting: PostSorting = PostSorting.new):
+async def get_all_posts(
+    request: Request,
+    email: Annotated[Optional[str], Depends(get_optional_user_email)],
+    sorting: PostSorting = PostSorting.new,
+    limit: Annotated[int, Query(ge=1, le=100)] = 20,
+    cursor: Optional[str] = None,
+):
     logger.info("Getting all posts")
 
     if sorting == PostSorting.new:
@@ -83,11 +174,145 @@ async def get_all_posts(sorting: PostSorting = PostSorting.new):
     elif sorting == PostSorting.old:
         query = select_post_and_likes.order_by(post_table.c.id.asc())
     elif sorting == PostSorting.most_likes:
-        query = select_post_and_likes.order_by(sqlalchemy.desc("likes"))
+        query = select_post_and_likes.order_by(
+            post_table.c.like_count.desc(), post_table.c.id.desc()
+        )
+
+    if cursor:
+        query = apply_post_cursor(query, sorting, decode_cursor(cursor))
+
+    # Fetch one extra row so we know whether there is a next page
+    query = query.limit(limit + 1)
+
+    async def render():
+        with log_query(logger, query):
+            posts = await read_database.fetch_all(query, email)
+        headers = {}
+        if len(posts) > limit:
+            posts = posts[:limit]
+            headers[NEXT_CURSOR_HEADER] = post_cursor(posts[-1], sorting)
+
+        return orjson.dumps(rows_to_dicts(posts)), headers
+
+    return await response_cache.respond(
+        request,
+        [POSTS_SCOPE],
+        (sorting.value, limit, cursor),
+        render,
+        fresh=read_database.is_sticky(email),
+    )
+
+
+def post_cursor(post, sorting: PostSorting) -> str:
+    data = {"sorting": sorting.value, "id": post.id}
+    if sorting == PostSorting.most_likes:
+        data["likes"] = post.likes
+    return encode_cursor(data)
+
+
+def apply_post_cursor(query, sorting: PostSorting, data: dict):
+    """Continue a listing after the post the cursor points at.
+
+    Every ordering ends in `post_table.c.id`, so the cursor position is unique
+    even when several posts share the same number of likes.
+    """
+    if data.get("sorting") != sorting.value or not isinstance(data.get("id"), int):
+        raise invalid_cursor_exception()
+
+    if sorting == PostSorting.new:
+        return query.where(post_table.c.id < data["id"])
+    if sorting == PostSorting.old:
+        return query.where(post_table.c.id > data["id"])
+
+    if not isinstance(data.get("likes"), int):
+        raise invalid_cursor_exception()
+    return query.where(
+        sqlalchemy.or_(
+            post_table.c.like_count < data["likes"],
+            sqlalchemy.and_(
+                post_table.c.like_count == data["likes"],
+                post_table.c.id < data["id"],
+            ),
+        )
+    )
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+EXPORT_MEDIA_TYPES = {
+    ExportFormat.ndjson: "application/x-ndjson",
+    ExportFormat.csv: "text/csv",
+}
+EXPORT_COLUMNS = tuple(
+    str(column.name) for column in select_post_and_likes.selected_columns
+)
+# Rows are written out in batches, which saves a send per row
+EXPORT_BATCH_ROWS = 500
+
+
+async def export_posts(query, format: ExportFormat) -> AsyncIterator[bytes]:
+    """Encode rows as they are read from the cursor, one batch at a time."""
+    if format == ExportFormat.csv:
+        text = io.StringIO()
+        writer = csv.writer(text)
+        writer.writerow(EXPORT_COLUMNS)
+
+        def encode_batch(batch: list) -> bytes:
+            writer.writerows(batch)
+            data = text.getvalue().encode()
+            text.seek(0)
+            text.truncate()
+            return data
+
+    else:
+
+        def encode_batch(batch: list) -> bytes:
+            return b"".join(
+                orjson.dumps(dict(zip(EXPORT_COLUMNS, row))) + b"\n" for row in batch
+            )
+
+    batch = []
+    # Timed until the last row is read, including time spent sending batches
+    with log_query(logger, query):
+        async for row in database.iterate(query):
+            batch.append(tuple(row._mapping))
+            if len(batch) >= EXPORT_BATCH_ROWS:
+                yield encode_batch(batch)
+                batch = []
+    # Also sends the CSV header when there are no rows
+    yield encode_batch(batch)
+
+
+@router.get("/post/export")
+async def export_all_posts(
+    format: ExportFormat = ExportFormat.ndjson,
+    user_id: Optional[int] = None,
+    min_id: Optional[int] = None,
+    max_id: Optional[int] = None,
+):
+    """Stream every post, oldest first, optionally by one user or in an id range.
+
+    Rows are read through a cursor and sent as they come, so memory use
+    doesn't grow with the number of posts.
+    """
+    logger.info("Exporting posts")
 
-    logger.debug(query)
+    query = select_post_and_likes.order_by(post_table.c.id)
+    if user_id is not None:
+        query = query.where(post_table.c.user_id == user_id)
+    if min_id is not None:
+        query = query.where(post_table.c.id >= min_id)
+    if max_id is not None:
+        query = query.where(post_table.c.id <= max_id)
 
-    return await database.fetch_all(query)
+    return StreamingResponse(
+        export_posts(query, format),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="posts.{format.value}"'},
+    )
 
 
 @router.post("/comment", response_model=Comment, status_code=201)
@@ -103,39 +328,127 @@ async def create_comment(
     data = {**comment.model_dump(), "user_id": current_user.id}
     query = comment_table.insert().values(data)
 
-    logger.debug(query)
-
-    last_record_id = await database.execute(query)
+    with log_query(logger, query):
+        last_record_id = await database.execute(query)
+    read_database.record_write(current_user.email)
+    await response_cache.invalidate(post_scope(comment.post_id))
     return {**data, "id": last_record_id}
 
 
+def comment_cursor_id(post_id: int, cursor: Optional[str]) -> Optional[int]:
+    if not cursor:
+        return None
+    data = decode_cursor(cursor)
+    if data.get("post_id") != post_id or not isinstance(data.get("id"), int):
+        raise invalid_cursor_exception()
+    return data["id"]
+
+
+def select_comments_page(post_id: int, limit: int, cursor: Optional[str]):
+    query = comment_table.select().where(comment_table.c.post_id == post_id)
+    if (after_id := comment_cursor_id(post_id, cursor)) is not None:
+        query = query.where(comment_table.c.id > after_id)
+
+    # Fetch one extra row so we know whether there is a next page
+    return query.order_by(comment_table.c.id).limit(limit + 1)
+
+
+def paginate_comments(comments: list, limit: int, headers: MutableMapping) -> list:
+    if len(comments) > limit:
+        comments = comments[:limit]
+        last = comments[-1]
+        headers[NEXT_CURSOR_HEADER] = encode_cursor(
+            {"post_id": last["post_id"], "id": last["id"]}
+        )
+    return comments
+
+
 @router.get("/post/{post_id}/comment", response_model=list[Comment])
-async def get_comments_on_post(post_id: int):
+async def get_comments_on_post(
+    post_id: int,
+    email: Annotated[Optional[str], Depends(get_optional_user_email)],
+    limit: Annotated[int, Query(ge=1, le=100)] = 50,
+    cursor: Optional[str] = None,
+):
     logger.info("Getting comments on post")
 
-    query = comment_table.select().where(comment_table.c.post_id == post_id)
+    query = select_comments_page(post_id, limit, cursor)
 
-    logger.debug(query)
+    with log_query(logger, query):
+        comments = await read_database.fetch_all(query, email)
+    headers = {}
+    comments = paginate_comments(rows_to_dicts(comments), limit, headers)
+    return ORJSONResponse(comments, headers=headers)
 
-    return await database.fetch_all(query)
 
+def select_post_with_comments(post_id: int, limit: int, cursor: Optional[str]):
+    """Select the post and a page of its comments in a single query.
 
-@router.get("/post/{post_id}", response_model=UserPostWithComments)
-async def get_post_with_comments(post_id: int):
-    logger.info("Getting post and its comments")
+    The post's columns are repeated on every comment row of the outer join;
+    a post without (more) comments comes back as one row with NULL comment
+    columns.
+    """
+    on_clause = comment_table.c.post_id == post_table.c.id
+    if (after_id := comment_cursor_id(post_id, cursor)) is not None:
+        on_clause &= comment_table.c.id > after_id
 
-    query = select_post_and_likes.where(post_table.c.id == post_id)
+    return (
+        select_post_and_likes.add_columns(
+            comment_table.c.id.label("comment_id"),
+            comment_table.c.body.label("comment_body"),
+            comment_table.c.user_id.label("comment_user_id"),
+        )
+        .select_from(post_table.outerjoin(comment_table, on_clause))
+        .where(post_table.c.id == post_id)
+        .order_by(comment_table.c.id)
+        # Fetch one extra row so we know whether there is a next page
+        .limit(limit + 1)
+    )
 
-    logger.debug(query)
 
-    post = await database.fetch_one(query)
-    if not post:
-        raise HTTPException(status_code=404, detail="Post not found")
+@router.get("/post/{post_id}", response_model=UserPostWithComments)
+async def get_post_with_comments(
+    post_id: int,
+    request: Request,
+    email: Annotated[Optional[str], Depends(get_optional_user_email)],
+    comment_limit: Annotated[int, Query(ge=1, le=100)] = 50,
+    comment_cursor: Optional[str] = None,
+):
+    logger.info("Getting post and its comments")
 
-    return {
-        "post": post,
-        "comments": await get_comments_on_post(post_id),
-    }
+    query = select_post_with_comments(post_id, comment_limit, comment_cursor)
+
+    async def render():
+        with log_query(logger, query):
+            rows = await read_database.fetch_all(query, email)
+        if not rows:
+            raise HTTPException(status_code=404, detail="Post not found")
+
+        post = rows[0]
+        comments = [
+            {
+                "id": row.comment_id,
+                "body": row.comment_body,
+                "post_id": post.id,
+                "user_id": row.comment_user_id,
+            }
+            for row in rows
+            if row.comment_id is not None
+        ]
+        headers = {}
+        page = {
+            "post": post_to_dict(post),
+            "comments": paginate_comments(comments, comment_limit, headers),
+        }
+        return orjson.dumps(page), headers
+
+    return await response_cache.respond(
+        request,
+        [post_scope(post_id)],
+        (comment_limit, comment_cursor),
+        render,
+        fresh=read_database.is_sticky(email),
+    )
 
 
 @router.post("/like", response_model=PostLike, status_code=201)
@@ -149,9 +462,126 @@ async def like_post(
         raise HTTPException(status_code=404, detail="Post not found")
 
     data = {**like.model_dump(), "user_id": current_user.id}
-    query = like_table.insert().values(data)
+    query = insert_new_likes([data])
+    count_query = (
+        post_table.update()
+        .where(post_table.c.id == like.post_id)
+        .values(like_count=post_table.c.like_count + 1)
+    )
+
+    async with database.transaction():
+        with log_query(logger, query):
+            inserted = await database.fetch_one(query)
+        if inserted is None:
+            raise HTTPException(status_code=409, detail="Post already liked")
+        with log_query(logger, count_query):
+            await database.execute(count_query)
+
+    read_database.record_write(current_user.email)
+    await response_cache.invalidate(POSTS_SCOPE, post_scope(like.post_id))
+    return {**data, "id": inserted.id}
+
+
+@router.post("/comment/batch", response_model=BatchResults)
+async def create_comments(
+    comments: Annotated[list[CommentIn], Body(max_length=MAX_BATCH_ITEMS)],
+    current_user: Annotated[User, Depends(get_current_user)],
+):
+    """Create many comments at once, reporting what happened to each one.
+
+    Comments on posts that don't exist are skipped; the others are inserted
+    together.
+    """
+    logger.info(f"Creating {len(comments)} comments")
+
+    existing = await find_existing_post_ids({comment.post_id for comment in comments})
+    values = [
+        {**comment.model_dump(), "user_id": current_user.id}
+        for comment in comments
+        if comment.post_id in existing
+    ]
+
+    if values:
+        query = comment_table.insert()
+
+        async with database.transaction():
+            with log_query(logger, query):
+                await database.execute_many(query, values)
+
+        read_database.record_write(current_user.email)
+        await response_cache.invalidate(
+            *(post_scope(post_id) for post_id in {value["post_id"] for value in values})
+        )
 
-    logger.debug(query)
+    return {
+        "results": [
+            {
+                "post_id": comment.post_id,
+                "status": (
+                    BatchItemStatus.created
+                    if comment.post_id in existing
+                    else BatchItemStatus.post_not_found
+                ),
+            }
+            for comment in comments
+        ]
+    }
 
-    last_record_id = await database.execute(query)
-    return {**data, "id": last_record_id}
+
+@router.post("/like/batch", response_model=BatchResults)
+async def like_posts(
+    likes: Annotated[list[PostLikeIn], Body(max_length=MAX_BATCH_ITEMS)],
+    current_user: Annotated[User, Depends(get_current_user)],
+):
+    """Like many posts at once, reporting what happened to each like.
+
+    Likes of missing posts are skipped and the others inserted together.
+    Likes the user already had, found by the insert itself, and repeats
+    within the batch are reported as already liked.
+    """
+    logger.info(f"Liking {len(likes)} posts")
+
+    existing = await find_existing_post_ids({like.post_id for like in likes})
+    # Posts to try liking, each once however often the batch repeats it
+    new_post_ids = {like.post_id for like in likes} & existing
+    inserted = set()
+
+    if new_post_ids:
+        query = insert_new_likes(
+            [
+                {"post_id": post_id, "user_id": current_user.id}
+                for post_id in sorted(new_post_ids)
+            ]
+        )
+
+        async with database.transaction():
+            with log_query(logger, query):
+                inserted = {row.post_id for row in await database.fetch_all(query)}
+            if inserted:
+                # Each post gains at most one like, as a user likes a post only once
+                count_query = (
+                    post_table.update()
+                    .where(post_table.c.id.in_(inserted))
+                    .values(like_count=post_table.c.like_count + 1)
+                )
+                with log_query(logger, count_query):
+                    await database.execute(count_query)
+
+    if inserted:
+        read_database.record_write(current_user.email)
+        await response_cache.invalidate(
+            POSTS_SCOPE, *(post_scope(post_id) for post_id in inserted)
+        )
+
+    results, reported = [], set()
+    for like in likes:
+        if like.post_id not in existing:
+            status = BatchItemStatus.post_not_found
+        elif like.post_id in inserted and like.post_id not in reported:
+            status = BatchItemStatus.created
+            reported.add(like.post_id)
+        else:
+            status = BatchItemStatus.already_liked
+        results.append({"post_id": like.post_id, "status": status})
+
+    return {"results": results}
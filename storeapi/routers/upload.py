@@ -1,32 +1,475 @@
+import asyncio
 import logging
-import tempfile
+import time
+import uuid
+from enum import Enum
+from typing import Annotated, AsyncIterator, Optional
 
-import aiofiles
-from fastapi import APIRouter, HTTPException, UploadFile, status
-from storeapi.libs.b2 import b2_upload_file
+import sqlalchemy
+from fastapi import (
+    APIRouter,
+    Depends,
+    HTTPException,
+    Path,
+    Request,
+    Response,
+    UploadFile,
+    status,
+)
+from storeapi.config import config
+from storeapi.database import (
+    database,
+    insert_ignoring_conflicts,
+    upload_part_table,
+    upload_session_table,
+    upload_table,
+)
+from storeapi.libs.b2.aio import b2_client
+from storeapi.libs.b2.streaming import StoredFile, stream_upload
+from storeapi.models.upload import UploadPart, UploadSession, UploadSessionIn
+from storeapi.models.user import User
+from storeapi.query_logging import log_query
+from storeapi.security import get_current_user
 
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
 
-CHUNK_SIZE = 1024 * 1024
+
+async def find_upload_url(content_hash: str) -> Optional[str]:
+    query = sqlalchemy.select(upload_table.c.file_url).where(
+        upload_table.c.content_hash == content_hash
+    )
+
+    with log_query(logger, query):
+        return await database.fetch_val(query)
+
+
+async def record_upload(stored_file: StoredFile):
+    query = (
+        insert_ignoring_conflicts(upload_table, ["content_hash"])
+        .values(
+            content_hash=stored_file.content_hash,
+            size=stored_file.size,
+            file_id=stored_file.file_id,
+            file_url=stored_file.file_url,
+        )
+        .returning(upload_table.c.id)
+    )
+
+    with log_query(logger, query):
+        upload_id = await database.fetch_val(query)
+    if upload_id is None:
+        # An identical file finished uploading at the same time; the file is
+        # stored either way, only one of the copies gets reused
+        logger.warning(f"Could not record upload of {stored_file.content_hash}")
+
+
+async def upload_to_b2(file: UploadFile) -> str:
+    """Upload `file` unless an identical one is already stored; return its URL."""
+    logger.info(f"Streaming uploaded file {file.filename} to B2")
+    stored_file = await stream_upload(
+        file,
+        file.filename,
+        file.content_type,
+        b2_client,
+        find_duplicate=find_upload_url,
+    )
+    if stored_file.duplicate:
+        logger.info(f"{file.filename} was already uploaded")
+    else:
+        await record_upload(stored_file)
+
+    return stored_file.file_url
 
 
 @router.post("/upload", status_code=201)
 async def upload_file(file: UploadFile):
     try:
-        with tempfile.NamedTemporaryFile() as temp_file:
-            filename = temp_file.name
-            logger.info(f"Saving uploaded file temporarily to {filename}")
-            async with aiofiles.open(filename, "wb") as f:
-                while chunk := await file.read(CHUNK_SIZE):
-                    await f.write(chunk)
-
-            file_url = b2_upload_file(local_file=filename, file_name=file.filename)
+        file_url = await upload_to_b2(file)
     except Exception:
+        logger.exception(f"Error uploading {file.filename}")
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="There was an error uploading the file",
         )
 
     return {"detail": f"Successfuly uploaded {file.filename}", "file_url": file_url}
+
+
+@router.post("/upload/batch", status_code=201)
+async def upload_files(files: list[UploadFile], response: Response):
+    """Upload several files to B2 at once, returning one result per file.
+
+    Answers 207 if some of the files could not be uploaded; their results
+    carry an error instead of a file_url.
+    """
+    slots = asyncio.Semaphore(config.B2_BATCH_UPLOAD_CONCURRENCY)
+
+    async def upload(file: UploadFile) -> dict:
+        async with slots:
+            try:
+                file_url = await upload_to_b2(file)
+            except Exception:
+                logger.exception(f"Error uploading {file.filename}")
+                return {
+                    "filename": file.filename,
+                    "error": "There was an error uploading the file",
+                }
+            return {"filename": file.filename, "file_url": file_url}
+
+    results = await asyncio.gather(*(upload(file) for file in files))
+    if any("error" in result for result in results):
+        response.status_code = status.HTTP_207_MULTI_STATUS
+
+    return {"results": results}
+
+
+# Resumable uploads: create a session, PUT its parts (retrying or resuming
+# any that failed, in any order and through any worker), then finish it. A
+# session is a B2 large file; its state lives in the database. Open sessions
+# expire UPLOAD_SESSION_TTL_SECONDS after their last part, and
+# `expire_upload_sessions` cancels their large files.
+
+
+class UploadSessionStatus(str, Enum):
+    open = "open"
+    finishing = "finishing"
+    finished = "finished"
+    cancelled = "cancelled"
+
+
+async def find_upload_session(session_id: str, user_id: int):
+    query = upload_session_table.select().where(
+        (upload_session_table.c.id == session_id)
+        & (upload_session_table.c.user_id == user_id)
+    )
+
+    with log_query(logger, query):
+        session = await database.fetch_one(query)
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload session not found")
+    return session
+
+
+async def find_upload_parts(session_id: str):
+    query = (
+        upload_part_table.select()
+        .where(upload_part_table.c.session_id == session_id)
+        .order_by(upload_part_table.c.part_number)
+    )
+
+    with log_query(logger, query):
+        return await database.fetch_all(query)
+
+
+def upload_session_expired(session) -> bool:
+    return session.updated_at < time.time() - config.UPLOAD_SESSION_TTL_SECONDS
+
+
+async def find_open_upload_session(session_id: str, user_id: int):
+    session = await find_upload_session(session_id, user_id)
+    if session.status != UploadSessionStatus.open.value:
+        raise HTTPException(
+            status_code=409, detail=f"Upload session is {session.status}"
+        )
+    if upload_session_expired(session):
+        raise HTTPException(status_code=410, detail="Upload session expired")
+    return session
+
+
+async def set_upload_session_status(
+    session_id: str,
+    from_status: UploadSessionStatus,
+    to_status: UploadSessionStatus,
+    **values,
+) -> bool:
+    """Move a session to `to_status` if it is still in `from_status`."""
+    values = {"updated_at": time.time(), **values}
+    query = (
+        upload_session_table.update()
+        .where(
+            (upload_session_table.c.id == session_id)
+            & (upload_session_table.c.status == from_status.value)
+        )
+        .values(status=to_status.value, **values)
+        .returning(upload_session_table.c.id)
+    )
+
+    with log_query(logger, query):
+        return await database.fetch_one(query) is not None
+
+
+async def upload_session_response(session) -> dict:
+    return {
+        **session._mapping,
+        "part_size": config.B2_PART_SIZE,
+        "parts": await find_upload_parts(session.id),
+    }
+
+
+def part_size(request: Request) -> int:
+    """The size of the part being sent, which B2 needs before the data."""
+    try:
+        size = int(request.headers["content-length"])
+    except (KeyError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_411_LENGTH_REQUIRED,
+            detail="Send parts with a Content-Length",
+        )
+    if size > config.B2_MAX_PART_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Parts may be at most {config.B2_MAX_PART_SIZE} bytes",
+        )
+    if size <= 0:
+        raise HTTPException(status_code=400, detail="Part is empty")
+    return size
+
+
+async def read_part(request: Request, size: int) -> AsyncIterator[bytes]:
+    """Yield the part's chunks, checking they add up to `size` bytes."""
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > size:
+            break
+        yield chunk
+    if received != size:
+        raise HTTPException(
+            status_code=400, detail="Part does not match its Content-Length"
+        )
+
+
+def find_http_exception(error: Optional[BaseException]) -> Optional[HTTPException]:
+    while error is not None and not isinstance(error, HTTPException):
+        error = error.__cause__ or error.__context__
+    return error
+
+
+@router.post("/upload/sessions", status_code=201, response_model=UploadSession)
+async def create_upload_session(
+    upload: UploadSessionIn, current_user: Annotated[User, Depends(get_current_user)]
+):
+    logger.info(f"Creating upload session for {upload.file_name}")
+
+    large_file_id = await b2_client.start_large_file(
+        upload.file_name, upload.content_type
+    )
+    timestamp = time.time()
+    session_id = uuid.uuid4().hex
+    query = upload_session_table.insert().values(
+        id=session_id,
+        user_id=current_user.id,
+        file_name=upload.file_name,
+        content_type=upload.content_type,
+        large_file_id=large_file_id,
+        status=UploadSessionStatus.open.value,
+        created_at=timestamp,
+        updated_at=timestamp,
+    )
+
+    with log_query(logger, query):
+        await database.execute(query)
+
+    session = await find_upload_session(session_id, current_user.id)
+    return await upload_session_response(session)
+
+
+@router.get("/upload/sessions/{session_id}", response_model=UploadSession)
+async def get_upload_session(
+    session_id: str, current_user: Annotated[User, Depends(get_current_user)]
+):
+    """Show which parts arrived, so that a client can resume the upload."""
+    session = await find_upload_session(session_id, current_user.id)
+    return await upload_session_response(session)
+
+
+@router.put(
+    "/upload/sessions/{session_id}/parts/{part_number}", response_model=UploadPart
+)
+async def upload_part(
+    session_id: str,
+    part_number: Annotated[int, Path(ge=1, le=10_000)],
+    request: Request,
+    current_user: Annotated[User, Depends(get_current_user)],
+):
+    """Upload one part of the file; sending a part again replaces it."""
+    session = await find_open_upload_session(session_id, current_user.id)
+    size = part_size(request)
+
+    logger.info(f"Uploading part {part_number} of session {session_id}")
+
+    try:
+        sha1 = await b2_client.upload_part_stream(
+            session.large_file_id, part_number, size, read_part(request, size)
+        )
+    except Exception as e:
+        # Errors reading the request reach us wrapped by b2sdk
+        if body_error := find_http_exception(e):
+            raise body_error
+        logger.exception(f"Error uploading part {part_number} of {session_id}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="There was an error uploading the part",
+        )
+
+    part = {"part_number": part_number, "size": size, "sha1": sha1}
+    delete_query = upload_part_table.delete().where(
+        (upload_part_table.c.session_id == session_id)
+        & (upload_part_table.c.part_number == part_number)
+    )
+    insert_query = upload_part_table.insert().values(session_id=session_id, **part)
+    # Each part keeps the session from expiring
+    touch_query = (
+        upload_session_table.update()
+        .where(upload_session_table.c.id == session_id)
+        .values(updated_at=time.time())
+    )
+
+    async with database.transaction():
+        with log_query(logger, delete_query):
+            await database.execute(delete_query)
+        with log_query(logger, insert_query):
+            await database.execute(insert_query)
+        with log_query(logger, touch_query):
+            await database.execute(touch_query)
+
+    return part
+
+
+@router.post("/upload/sessions/{session_id}/finish", status_code=201)
+async def finish_upload_session(
+    session_id: str, current_user: Annotated[User, Depends(get_current_user)]
+):
+    session = await find_open_upload_session(session_id, current_user.id)
+    parts = await find_upload_parts(session_id)
+
+    numbers = [part.part_number for part in parts]
+    if len(parts) < 2 or numbers != list(range(1, len(parts) + 1)):
+        raise HTTPException(
+            status_code=400,
+            detail="Upload parts 1 to N, with N of at least 2, before finishing",
+        )
+    if any(part.size < config.B2_PART_SIZE for part in parts[:-1]):
+        raise HTTPException(
+            status_code=400,
+            detail=f"All parts but the last need at least {config.B2_PART_SIZE} bytes",
+        )
+
+    # Claiming the session keeps two finish calls from both reaching B2
+    if not await set_upload_session_status(
+        session_id, UploadSessionStatus.open, UploadSessionStatus.finishing
+    ):
+        raise HTTPException(status_code=409, detail="Upload session is not open")
+
+    logger.info(f"Finishing upload session {session_id} with {len(parts)} parts")
+
+    try:
+        file_id = await b2_client.finish_large_file(
+            session.large_file_id, [part.sha1 for part in parts]
+        )
+        file_url = await b2_client.download_url(file_id)
+    except Exception:
+        logger.exception(f"Error finishing upload session {session_id}")
+        await set_upload_session_status(
+            session_id, UploadSessionStatus.finishing, UploadSessionStatus.open
+        )
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="There was an error uploading the file",
+        )
+
+    await set_upload_session_status(
+        session_id,
+        UploadSessionStatus.finishing,
+        UploadSessionStatus.finished,
+        file_url=file_url,
+    )
+
+    return {
+        "detail": f"Successfuly uploaded {session.file_name}",
+        "file_url": file_url,
+    }
+
+
+@router.delete("/upload/sessions/{session_id}", status_code=204)
+async def cancel_upload_session(
+    session_id: str, current_user: Annotated[User, Depends(get_current_user)]
+):
+    session = await find_open_upload_session(session_id, current_user.id)
+    if not await set_upload_session_status(
+        session_id, UploadSessionStatus.open, UploadSessionStatus.cancelled
+    ):
+        raise HTTPException(status_code=409, detail="Upload session is not open")
+
+    logger.info(f"Cancelling upload session {session_id}")
+
+    await b2_client.cancel_large_file(session.large_file_id)
+
+
+async def delete_upload_session(session_id: str):
+    parts_query = upload_part_table.delete().where(
+        upload_part_table.c.session_id == session_id
+    )
+    session_query = upload_session_table.delete().where(
+        upload_session_table.c.id == session_id
+    )
+
+    async with database.transaction():
+        with log_query(logger, parts_query):
+            await database.execute(parts_query)
+        with log_query(logger, session_query):
+            await database.execute(session_query)
+
+
+async def expire_upload_sessions() -> int:
+    """Cancel the B2 large files of expired sessions and delete their rows.
+
+    Returns how many sessions were removed. A session whose large file could
+    not be cancelled is reopened, unchanged, to be tried again next time.
+    """
+    cutoff = time.time() - config.UPLOAD_SESSION_TTL_SECONDS
+    query = upload_session_table.select().where(
+        (upload_session_table.c.status == UploadSessionStatus.open.value)
+        & (upload_session_table.c.updated_at < cutoff)
+    )
+
+    with log_query(logger, query):
+        sessions = await database.fetch_all(query)
+
+    removed = 0
+    for session in sessions:
+        # Another process may be expiring the same session
+        if not await set_upload_session_status(
+            session.id, UploadSessionStatus.open, UploadSessionStatus.cancelled
+        ):
+            continue
+        try:
+            await b2_client.cancel_large_file(session.large_file_id)
+        except Exception:
+            logger.exception(f"Could not cancel expired upload session {session.id}")
+            await set_upload_session_status(
+                session.id,
+                UploadSessionStatus.cancelled,
+                UploadSessionStatus.open,
+                updated_at=session.updated_at,
+            )
+            continue
+        await delete_upload_session(session.id)
+        removed += 1
+
+    if removed:
+        logger.info(f"Removed {removed} expired upload sessions")
+    return removed
+
+
+async def expire_upload_sessions_regularly(
+    interval: float = config.UPLOAD_SESSION_CLEANUP_INTERVAL_SECONDS,
+):
+    while True:
+        try:
+            await expire_upload_sessions()
+        except Exception:
+            logger.exception("Could not expire upload sessions")
+        await asyncio.sleep(interval)
@@ -2,15 +2,17 @@ import logging
 
 from fastapi import APIRouter, BackgroundTasks, HTTPException, Request, status
 from storeapi import tasks
-from storeapi.database import database, user_table
+from storeapi.database import database, read_database, user_table
 from storeapi.models.user import UserIn
+from storeapi.query_logging import log_query
 from storeapi.security import (
     authenticate_user,
     create_access_token,
     create_confirmation_token,
-    get_password_hash,
     get_subject_for_token_type,
     get_user,
+    hash_password,
+    invalidate_user,
 )
 
 logger = logging.getLogger(__name__)
@@ -19,17 +21,18 @@ router = APIRouter()
 
 @router.post("/register", status_code=201)
 async def register(user: UserIn, background_tasks: BackgroundTasks, request: Request):
-    if await get_user(user.email):
+    if await get_user(user.email, use_primary=True):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="A user with that email already exists",
         )
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await hash_password(user.password)
     query = user_table.insert().values(email=user.email, password=hashed_password)
 
-    logger.debug(query)
-
-    await database.execute(query)
+    with log_query(logger, query):
+        await database.execute(query)
+    invalidate_user(user.email)
+    read_database.record_write(user.email)
 
     logger.debug("Submitting background task to send email")
 
@@ -57,7 +60,8 @@ async def confirm_email(token: str):
         user_table.update().where(user_table.c.email == email).values(confirmed=True)
     )
 
-    logger.debug(query)
-
-    await database.execute(query)
+    with log_query(logger, query):
+        await database.execute(query)
+    invalidate_user(email)
+    read_database.record_write(email)
     return {"detail": "User confirmed"}
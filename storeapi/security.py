@@ -1,20 +1,41 @@
+import asyncio
 import datetime
 import logging
-from typing import Annotated, Literal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Annotated, Literal, Optional
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import ExpiredSignatureError, JWTError, jwt
 from passlib.context import CryptContext
-from storeapi.database import database, user_table
+from storeapi.cache import TTLCache
+from storeapi.config import config
+from storeapi.database import database, read_database, user_table
+from storeapi.metrics import password_hash_queue_depth, password_hash_wait_seconds
 
 logger = logging.getLogger(__name__)
 
 SECRET_KEY = "9b73f2a1bdd7ae163444473d29a6885ffa22ab26117068f72a5a56a74d12d1fc"
 ALGORITHM = "HS256"
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token", auto_error=False)
 pwd_context = CryptContext(schemes=["bcrypt"])
 
+# Decoded tokens keyed by the token, and user rows keyed by email (the token's
+# subject), so authenticated requests don't decode and query every time.
+token_cache = TTLCache(
+    maxsize=config.USER_CACHE_MAX_SIZE,
+    ttl=config.USER_CACHE_TTL_SECONDS,
+    name="token",
+)
+user_cache = TTLCache(
+    maxsize=config.USER_CACHE_MAX_SIZE,
+    ttl=config.USER_CACHE_TTL_SECONDS,
+    name="user",
+)
+
 
 def create_credentials_exception(detail: str) -> HTTPException:
     return HTTPException(
@@ -52,9 +73,11 @@ def create_confirmation_token(email: str):
     return encoded_jwt
 
 
-def get_subject_for_token_type(
-    token: str, type: Literal["access", "confirmation"]
-) -> str:
+def decode_token(token: str) -> dict:
+    payload = token_cache.get(token)
+    if payload is not None:
+        return payload
+
     try:
         payload = jwt.decode(token, key=SECRET_KEY, algorithms=[ALGORITHM])
     except ExpiredSignatureError as e:
@@ -62,6 +85,17 @@ def get_subject_for_token_type(
     except JWTError as e:
         raise create_credentials_exception("Invalid token") from e
 
+    # Never keep a token cached past its expiry
+    expires_in = payload["exp"] - time.time() if "exp" in payload else None
+    token_cache.set(token, payload, ttl=expires_in)
+    return payload
+
+
+def get_subject_for_token_type(
+    token: str, type: Literal["access", "confirmation"]
+) -> str:
+    payload = decode_token(token)
+
     email = payload.get("sub")
     if email is None:
         raise create_credentials_exception("Token is missing 'sub' field")
@@ -83,29 +117,119 @@ def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
 
-async def get_user(email: str):
+class PasswordHashPool:
+    """Runs bcrypt off the event loop, in a bounded pool of threads.
+
+    bcrypt releases the GIL, so up to `max_workers` hashes run in parallel
+    while the event loop keeps serving other requests. Calls beyond that wait
+    in the executor's queue; `queue_depth` is how many are currently waiting.
+    It goes to the password_hash_* metrics, along with how long calls waited.
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.queue_depth = 0
+        self.last_wait_seconds = 0.0
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="password-hash"
+        )
+
+    async def run(self, func, *args):
+        submitted_at = time.perf_counter()
+        queued = True
+
+        def leave_queue():
+            nonlocal queued
+            with self._lock:
+                if queued:
+                    queued = False
+                    self.queue_depth -= 1
+                    password_hash_queue_depth.dec()
+
+        def call():
+            leave_queue()
+            self.last_wait_seconds = time.perf_counter() - submitted_at
+            password_hash_wait_seconds.observe(self.last_wait_seconds)
+            return func(*args)
+
+        with self._lock:
+            self.queue_depth += 1
+            password_hash_queue_depth.inc()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                self._executor, call
+            )
+        finally:
+            # A call cancelled while waiting never starts, so never leaves the
+            # queue on its own
+            leave_queue()
+
+
+password_hash_pool = PasswordHashPool(config.PASSWORD_HASH_WORKERS)
+
+
+async def hash_password(password: str) -> str:
+    return await password_hash_pool.run(get_password_hash, password)
+
+
+async def check_password(plain_password: str, hashed_password: str) -> bool:
+    return await password_hash_pool.run(
+        verify_password, plain_password, hashed_password
+    )
+
+
+async def get_user(email: str, use_primary: bool = False):
     logger.debug("Fetching user from the database", extra={"email": email})
     query = user_table.select().where(user_table.c.email == email)
-    result = await database.fetch_one(query)
+    if use_primary:
+        result = await database.fetch_one(query)
+    else:
+        result = await read_database.fetch_one(query, email)
     if result:
         return result
 
 
 async def authenticate_user(email: str, password: str):
     logger.debug("Authenticating user", extra={"email": email})
-    user = await get_user(email)
+    # The primary, so a user can log in right after registering or confirming
+    user = await get_user(email, use_primary=True)
     if not user:
         raise create_credentials_exception("Invalid email or password")
-    if not verify_password(password, user.password):
+    if not await check_password(password, user.password):
         raise create_credentials_exception("Invalid email or password")
     if not user.confirmed:
         raise create_credentials_exception("User has not confirmed email")
     return user
 
 
+async def get_optional_user_email(
+    token: Annotated[Optional[str], Depends(optional_oauth2_scheme)],
+) -> Optional[str]:
+    """The email of the user sending a valid access token, if there is one.
+
+    Lets public endpoints send a user's reads to the primary database after
+    they wrote something.
+    """
+    if token is None:
+        return None
+    try:
+        return get_subject_for_token_type(token, "access")
+    except HTTPException:
+        return None
+
+
+def invalidate_user(email: str):
+    """Drop a user's cached row; call it whenever the user row changes."""
+    user_cache.delete(email)
+
+
 async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]):
     email = get_subject_for_token_type(token, "access")
-    user = await get_user(email=email)
+    user = user_cache.get(email)
     if user is None:
-        raise create_credentials_exception("Could not find user for this token")
+        user = await get_user(email=email, use_primary=True)
+        if user is None:
+            raise create_credentials_exception("Could not find user for this token")
+        user_cache.set(email, user)
     return user
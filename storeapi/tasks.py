@@ -1,24 +1,79 @@
+import json
 import logging
 from json import JSONDecodeError
+from typing import Optional
 
 import httpx
+import sqlalchemy
 from databases import Database
 from storeapi.config import config
 from storeapi.database import post_table
+from storeapi.email_outbox import Email, EmailOutbox
+from storeapi.query_logging import log_query
+from storeapi.request_timing import timed_external_call
+from storeapi.response_cache import POSTS_SCOPE, post_scope, response_cache
 
 logger = logging.getLogger(__name__)
 
 
+MAILGUN_API_URL = "https://api.mailgun.net"
+DEEPAI_API_URL = "https://api.deepai.org"
+
+
 class APIResponseError(Exception):
     pass
 
 
-async def send_simple_email(to: str, subject: str, body: str):
+def create_http_client(base_url: str) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=base_url,
+        http2=config.HTTP_2,
+        limits=httpx.Limits(
+            max_connections=config.HTTP_MAX_CONNECTIONS_PER_HOST,
+            max_keepalive_connections=config.HTTP_MAX_KEEPALIVE_CONNECTIONS_PER_HOST,
+            keepalive_expiry=config.HTTP_KEEPALIVE_EXPIRY_SECONDS,
+        ),
+        timeout=httpx.Timeout(
+            config.HTTP_TIMEOUT_SECONDS, connect=config.HTTP_CONNECT_TIMEOUT_SECONDS
+        ),
+    )
+
+
+class HTTPClientPool:
+    """Long-lived HTTP clients, one per upstream host.
+
+    Reusing a client keeps its connections alive between calls, so we only pay
+    for the TCP and TLS handshakes once per connection instead of per request.
+    Each host gets its own client so that its connection limits apply per host.
+    The app's lifespan closes the clients on shutdown.
+    """
+
+    def __init__(self):
+        self._clients: dict[str, httpx.AsyncClient] = {}
+
+    def get(self, base_url: str) -> httpx.AsyncClient:
+        if base_url not in self._clients:
+            self._clients[base_url] = create_http_client(base_url)
+        return self._clients[base_url]
+
+    async def aclose(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+
+
+http_clients = HTTPClientPool()
+
+
+async def send_simple_email(
+    to: str, subject: str, body: str, client: Optional[httpx.AsyncClient] = None
+):
     logger.debug(f"Sending email to '{to[:3]}' with subject '{subject[:20]}'")
-    async with httpx.AsyncClient() as client:
-        try:
+    client = client or http_clients.get(MAILGUN_API_URL)
+    try:
+        with timed_external_call("mailgun"):
             response = await client.post(
-                f"https://api.mailgun.net/v3/{config.MAILGUN_DOMAIN}/messages",
+                f"/v3/{config.MAILGUN_DOMAIN}/messages",
                 auth=("api", config.MAILGUN_API_KEY),
                 data={
                     "from": f"Jose Salvatierra <mailgun@{config.MAILGUN_DOMAIN}>",
@@ -27,48 +82,108 @@ async def send_simple_email(to: str, subject: str, body: str):
                     "text": body,
                 },
             )
-            response.raise_for_status()
+        response.raise_for_status()
+
+        logger.debug(response.content)
+
+        return response
+    except httpx.HTTPStatusError as err:
+        raise APIResponseError(
+            f"API request failed with status code {err.response.status_code}"
+        ) from err
+
+
+async def send_batch_email(
+    recipients: dict[str, dict],
+    subject: str,
+    body: str,
+    client: Optional[httpx.AsyncClient] = None,
+):
+    """Send one email to many recipients in a single Mailgun request.
+
+    Mailgun sends every recipient a separate copy, replacing `%recipient.name%`
+    in the body with that recipient's variables.
+    """
+    logger.debug(f"Sending email with subject '{subject[:20]}' to {len(recipients)}")
+    client = client or http_clients.get(MAILGUN_API_URL)
+    try:
+        with timed_external_call("mailgun"):
+            response = await client.post(
+                f"/v3/{config.MAILGUN_DOMAIN}/messages",
+                auth=("api", config.MAILGUN_API_KEY),
+                data={
+                    "from": f"Jose Salvatierra <mailgun@{config.MAILGUN_DOMAIN}>",
+                    "to": list(recipients),
+                    "subject": subject,
+                    "text": body,
+                    "recipient-variables": json.dumps(recipients),
+                },
+            )
+        response.raise_for_status()
+
+        logger.debug(response.content)
+
+        return response
+    except httpx.HTTPStatusError as err:
+        raise APIResponseError(
+            f"API request failed with status code {err.response.status_code}"
+        ) from err
+
 
-            logger.debug(response.content)
+email_outbox = EmailOutbox(
+    send_batch_email,
+    max_batch_size=config.EMAIL_BATCH_SIZE,
+    flush_interval=config.EMAIL_FLUSH_INTERVAL_SECONDS,
+    max_queue_size=config.EMAIL_QUEUE_MAX_SIZE,
+    max_retries=config.EMAIL_MAX_RETRIES,
+)
 
-            return response
-        except httpx.HTTPStatusError as err:
-            raise APIResponseError(
-                f"API request failed with status code {err.response.status_code}"
-            ) from err
+
+async def send_email(email: Email):
+    """Queue the email for batched delivery, or send it now if the outbox isn't
+    running (e.g. outside the app's lifespan)."""
+    if email_outbox.running:
+        return await email_outbox.put(email)
+    return await send_simple_email(email.to, email.subject, email.render())
 
 
 async def send_user_registration_email(email: str, confirmation_url: str):
-    return await send_simple_email(
-        email,
-        "Successfully signed up",
-        (
-            f"Hi {email}! You have successfully signed up to the Stores REST API."
-            " Please confirm your email by clicking on the"
-            f" following link: {confirmation_url}"
-        ),
+    return await send_email(
+        Email(
+            to=email,
+            subject="Successfully signed up",
+            body=(
+                "Hi %recipient.email%! You have successfully signed up to the"
+                " Stores REST API. Please confirm your email by clicking on the"
+                " following link: %recipient.confirmation_url%"
+            ),
+            variables={"email": email, "confirmation_url": str(confirmation_url)},
+        )
     )
 
 
-async def _generate_cute_creature_api(prompt: str):
+async def _generate_cute_creature_api(
+    prompt: str, client: Optional[httpx.AsyncClient] = None
+):
     logger.debug("Generating cute creature")
-    async with httpx.AsyncClient() as client:
-        try:
+    client = client or http_clients.get(DEEPAI_API_URL)
+    try:
+        with timed_external_call("deepai"):
             response = await client.post(
-                "https://api.deepai.org/api/cute-creature-generator",
+                "/api/cute-creature-generator",
                 data={"text": prompt},
                 headers={"api-key": config.DEEPAI_API_KEY},
                 timeout=60,
             )
-            logger.debug(response)
-            response.raise_for_status()
-            return response.json()
-        except httpx.HTTPStatusError as err:
-            raise APIResponseError(
-                f"API request failed with status code {err.response.status_code}"
-            ) from err
-        except (JSONDecodeError, TypeError) as err:
-            raise APIResponseError("API response parsing failed") from err
+        logger.debug(response)
+        response.raise_for_status()
+        return response.json()
+    except httpx.HTTPStatusError as err:
+        raise APIResponseError(
+            f"API request failed with status code {err.response.status_code}"
+        ) from err
+    except (JSONDecodeError, TypeError) as err:
+        raise APIResponseError("API response parsing failed") from err
 
 
 async def generate_and_add_to_post(
@@ -78,17 +193,20 @@ async def generate_and_add_to_post(
     database: Database,
     prompt: str = "A blue british shorthair cat is sitting on a couch",
 ):
-    try:
-        response = await _generate_cute_creature_api(prompt)
-    except APIResponseError:
-        return await send_simple_email(
-            email,
-            "Error generating image",
-            (
-                f"Hi {email}! Unfortunately there was an error generating an image"
-                "for your post."
-            ),
-        )
+    """Generate an image for the post and email its author once it's added.
+
+    Runs as a job, which is retried when this raises, so a post that already
+    has an image is left alone: a retry after the image was added neither
+    generates it nor sends the email again.
+    """
+    query = sqlalchemy.select(post_table.c.image_url).where(post_table.c.id == post_id)
+
+    with log_query(logger, query):
+        if await database.fetch_val(query):
+            logger.info(f"Post {post_id} already has an image")
+            return
+
+    response = await _generate_cute_creature_api(prompt)
 
     logger.debug("Connecting to database to update post")
 
@@ -98,18 +216,37 @@ async def generate_and_add_to_post(
         .values(image_url=response["output_url"])
     )
 
-    logger.debug(query)
-
-    await database.execute(query)
+    with log_query(logger, query):
+        await database.execute(query)
+    await response_cache.invalidate(POSTS_SCOPE, post_scope(post_id))
 
     logger.debug("Database connection in background task closed")
 
-    await send_simple_email(
-        email,
-        "Image generation completed",
-        (
-            f"Hi {email}! Your image has been generated and added to your post."
-            f" Please click on the following link to view it: {post_url}"
-        ),
+    await send_email(
+        Email(
+            to=email,
+            subject="Image generation completed",
+            body=(
+                "Hi %recipient.email%! Your image has been generated and added to"
+                " your post. Please click on the following link to view it:"
+                " %recipient.post_url%"
+            ),
+            variables={"email": email, "post_url": str(post_url)},
+        )
     )
     return response
+
+
+async def send_image_generation_failed_email(email: str, **job_payload):
+    """Tell the author that generate_and_add_to_post ran out of attempts."""
+    return await send_email(
+        Email(
+            to=email,
+            subject="Error generating image",
+            body=(
+                "Hi %recipient.email%! Unfortunately there was an error"
+                " generating an image for your post."
+            ),
+            variables={"email": email},
+        )
+    )
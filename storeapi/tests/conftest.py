@@ -1,4 +1,8 @@
+import hashlib
+import itertools
 import os
+import threading
+import time
 from typing import AsyncGenerator, Generator
 from unittest.mock import AsyncMock, Mock
 
@@ -8,7 +12,10 @@ from httpx import AsyncClient, Request, Response
 
 os.environ["ENV_STATE"] = "test"
 from storeapi.database import database, user_table  # noqa: E402
+from storeapi.libs.b2.aio import AsyncB2Storage  # noqa: E402
 from storeapi.main import app  # noqa: E402
+from storeapi.response_cache import response_cache  # noqa: E402
+from storeapi.security import token_cache, user_cache  # noqa: E402
 
 
 @pytest.fixture(scope="session")
@@ -28,6 +35,15 @@ async def db() -> AsyncGenerator:
     await database.disconnect()
 
 
+@pytest.fixture(autouse=True)
+async def clear_caches():
+    """The database is rolled back after every test, so caches must be too."""
+    yield
+    token_cache.clear()
+    user_cache.clear()
+    await response_cache.clear()
+
+
 @pytest.fixture()
 async def async_client(client) -> AsyncGenerator:
     async with AsyncClient(app=app, base_url=client.base_url) as ac:
@@ -67,11 +83,101 @@ def mock_httpx_client(mocker):
     Fixture to mock the HTTPX client so that we never make any
     real HTTP requests (especially important when registering users).
     """
-    mocked_client = mocker.patch("storeapi.tasks.httpx.AsyncClient")
-
     mocked_async_client = Mock()
     response = Response(status_code=200, content="", request=Request("POST", "//"))
     mocked_async_client.post = AsyncMock(return_value=response)
-    mocked_client.return_value.__aenter__.return_value = mocked_async_client
+    mocker.patch("storeapi.tasks.http_clients.get", return_value=mocked_async_client)
 
     return mocked_async_client
+
+
+class FakeB2Storage:
+    """An in-memory stand-in for storeapi.libs.b2.B2Storage."""
+
+    def __init__(self):
+        self.files: dict[str, bytes] = {}
+        self.large_files: dict[str, dict[int, bytes]] = {}
+        self.cancelled: list[str] = []
+        self.fail_part = None
+        self.fail_file_name = None
+        self.upload_delay = 0.0
+        self.files_in_flight = 0
+        self.max_files_in_flight = 0
+        self.authorizations = 0
+        self.parts_in_flight = 0
+        self.max_parts_in_flight = 0
+        self._lock = threading.Lock()
+        self._large_file_numbers = itertools.count(1)
+
+    def authorize(self):
+        self.authorizations += 1
+
+    def upload_bytes(self, data: bytes, file_name: str, content_type) -> str:
+        with self._lock:
+            self.files_in_flight += 1
+            self.max_files_in_flight = max(
+                self.max_files_in_flight, self.files_in_flight
+            )
+        try:
+            time.sleep(self.upload_delay)
+            if file_name == self.fail_file_name:
+                raise RuntimeError("Upload failed")
+            with self._lock:
+                file_id = f"file-{len(self.files) + 1}"
+                self.files[file_id] = data
+            return file_id
+        finally:
+            with self._lock:
+                self.files_in_flight -= 1
+
+    def start_large_file(self, file_name: str, content_type) -> str:
+        file_id = f"large-{next(self._large_file_numbers)}"
+        self.large_files[file_id] = {}
+        return file_id
+
+    def upload_part(self, file_id: str, part_number: int, data: bytes) -> str:
+        with self._lock:
+            self.parts_in_flight += 1
+            self.max_parts_in_flight = max(
+                self.max_parts_in_flight, self.parts_in_flight
+            )
+        try:
+            if part_number == self.fail_part:
+                raise RuntimeError("Part upload failed")
+            self.large_files[file_id][part_number] = data
+            return hashlib.sha1(data).hexdigest()
+        finally:
+            with self._lock:
+                self.parts_in_flight -= 1
+
+    def upload_part_stream(
+        self, file_id: str, part_number: int, size: int, stream
+    ) -> str:
+        data = stream.read()
+        assert len(data) == size
+        return self.upload_part(file_id, part_number, data)
+
+    def finish_large_file(self, file_id: str, part_sha1s: list[str]) -> str:
+        parts = self.large_files.pop(file_id)
+        assert len(parts) >= 2, "B2 large files need at least two parts"
+        assert part_sha1s == [
+            hashlib.sha1(parts[number]).hexdigest() for number in sorted(parts)
+        ]
+        self.files[file_id] = b"".join(parts[number] for number in sorted(parts))
+        return file_id
+
+    def cancel_large_file(self, file_id: str):
+        self.large_files.pop(file_id)
+        self.cancelled.append(file_id)
+
+    def download_url(self, file_id: str) -> str:
+        return f"https://fakeurl.com/{file_id}"
+
+
+@pytest.fixture()
+async def fake_b2_storage(mocker) -> AsyncGenerator[FakeB2Storage, None]:
+    storage = FakeB2Storage()
+    client = AsyncB2Storage(lambda: storage)
+    mocker.patch("storeapi.routers.upload.b2_client", client)
+    yield storage
+    await client.stop()
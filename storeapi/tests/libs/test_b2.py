@@ -0,0 +1,222 @@
+import asyncio
+import email.utils
+import hashlib
+import io
+import json
+
+import b2sdk.v2 as b2sdk
+import pytest
+from prometheus_client import REGISTRY
+from storeapi.libs.b2 import B2Storage
+from storeapi.libs.b2.aio import AsyncB2Storage, AsyncIteratorReader
+from storeapi.tests.conftest import FakeB2Storage
+
+
+def b2_calls(operation: str) -> float:
+    labels = {"operation": operation}
+    return REGISTRY.get_sample_value("b2_call_duration_seconds_count", labels) or 0
+
+
+@pytest.mark.anyio
+async def test_start_authorizes_once():
+    created = []
+
+    def create_storage():
+        created.append(FakeB2Storage())
+        return created[-1]
+
+    b2 = AsyncB2Storage(create_storage)
+    authorizations = b2_calls("authorize")
+    await asyncio.gather(b2.start(), b2.upload_bytes(b"data", "a.txt", None))
+    await b2.stop()
+
+    assert len(created) == 1
+    assert b2_calls("authorize") == authorizations + 1
+
+
+@pytest.mark.anyio
+async def test_calls_start_lazily():
+    storage = FakeB2Storage()
+    b2 = AsyncB2Storage(lambda: storage)
+
+    file_id = await b2.upload_bytes(b"data", "a.txt", "text/plain")
+
+    assert storage.files == {file_id: b"data"}
+    assert await b2.download_url(file_id) == f"https://fakeurl.com/{file_id}"
+
+
+@pytest.mark.anyio
+async def test_failed_authorization_is_retried():
+    attempts = []
+
+    def create_storage():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RuntimeError("B2 is down")
+        return FakeB2Storage()
+
+    b2 = AsyncB2Storage(create_storage)
+    with pytest.raises(RuntimeError):
+        await b2.start()
+    await b2.start()
+    await b2.stop()
+
+    assert len(attempts) == 2
+
+
+@pytest.mark.anyio
+async def test_records_latency_per_operation():
+    b2 = AsyncB2Storage(FakeB2Storage)
+    operations = ["start_large_file", "upload_part", "cancel_large_file"]
+    before = {operation: b2_calls(operation) for operation in operations}
+
+    file_id = await b2.start_large_file("big.bin", None)
+    await b2.upload_part(file_id, 1, b"a")
+    await b2.upload_part(file_id, 2, b"b")
+    await b2.cancel_large_file(file_id)
+
+    calls = {
+        operation: b2_calls(operation) - before[operation] for operation in operations
+    }
+    assert calls == {"start_large_file": 1, "upload_part": 2, "cancel_large_file": 1}
+
+
+@pytest.mark.anyio
+async def test_refreshes_authorization_in_background():
+    storage = FakeB2Storage()
+    b2 = AsyncB2Storage(lambda: storage, refresh_interval=0.01)
+
+    await b2.start()
+    await asyncio.sleep(0.1)
+    await b2.stop()
+
+    assert storage.authorizations >= 2
+
+
+@pytest.mark.anyio
+async def test_failed_refresh_keeps_refreshing(mocker):
+    storage = FakeB2Storage()
+    mocker.patch.object(storage, "authorize", side_effect=RuntimeError("Down"))
+    b2 = AsyncB2Storage(lambda: storage, refresh_interval=0.01)
+
+    await b2.start()
+    await asyncio.sleep(0.1)
+    await b2.stop()
+
+    assert storage.authorize.call_count >= 2
+
+
+@pytest.mark.anyio
+async def test_async_iterator_reader_reads_chunks_from_a_thread():
+    async def chunks():
+        yield b"ab"
+        yield b""
+        yield b"cde"
+
+    stream = io.BufferedReader(
+        AsyncIteratorReader(chunks(), asyncio.get_running_loop())
+    )
+
+    assert await asyncio.to_thread(stream.read, 4) == b"abcd"
+    assert await asyncio.to_thread(stream.read) == b"e"
+
+
+@pytest.mark.anyio
+async def test_async_iterator_reader_only_seeks_to_where_it_is():
+    async def chunks():
+        yield b"abc"
+
+    reader = AsyncIteratorReader(chunks(), asyncio.get_running_loop())
+
+    assert reader.seek(0) == 0
+    assert await asyncio.to_thread(reader.read, 2) == b"ab"
+    assert reader.seek(0, io.SEEK_CUR) == 2
+    with pytest.raises(io.UnsupportedOperation):
+        reader.seek(0)
+
+
+class B2Response:
+    def __init__(self, body: dict):
+        self.status_code = 200
+        self.reason = "OK"
+        self.headers = {"Date": email.utils.formatdate(usegmt=True)}
+        self.content = json.dumps(body).encode()
+
+    @property
+    def text(self) -> str:
+        return self.content.decode()
+
+    def json(self) -> dict:
+        return json.loads(self.content)
+
+    def close(self):
+        pass
+
+
+class B2Session:
+    """Answers b2sdk's HTTP requests like B2 does, reading bodies like
+    requests does."""
+
+    def __init__(self):
+        self.uploaded_parts: list[tuple[dict, bytes]] = []
+
+    def request(self, method, url, headers, data=None, **kwargs):
+        endpoint = url.rsplit("/", 1)[-1]
+        if endpoint == "b2_authorize_account":
+            storage_api = {
+                "apiUrl": "https://api.example.com",
+                "downloadUrl": "https://download.example.com",
+                "s3ApiUrl": "https://s3.example.com",
+                "absoluteMinimumPartSize": 5,
+                "recommendedPartSize": 100,
+                "bucketId": None,
+                "bucketName": None,
+                "capabilities": ["all"],
+                "namePrefix": None,
+            }
+            return B2Response(
+                {
+                    "accountId": "account",
+                    "authorizationToken": "token",
+                    "apiInfo": {"storageApi": storage_api},
+                }
+            )
+        if endpoint == "b2_get_upload_part_url":
+            return B2Response(
+                {
+                    "fileId": "file",
+                    "uploadUrl": "https://upload.example.com/part",
+                    "authorizationToken": "upload-token",
+                }
+            )
+        if endpoint == "part":
+            body = b"".join(iter(lambda: data.read(8192), b""))
+            self.uploaded_parts.append((headers, body))
+            return B2Response({"partNumber": 1, "contentSha1": body[-40:].decode()})
+        raise AssertionError(f"Unexpected B2 request {method} {url}")
+
+
+@pytest.mark.anyio
+async def test_upload_part_stream_through_b2sdk():
+    session = B2Session()
+    api = b2sdk.B2Api(b2sdk.InMemoryAccountInfo())
+    api.session.raw_api.b2_http.session = session
+    api.authorize_account("production", "key-id", "key")
+    # Skips looking up the bucket, which this upload doesn't use
+    storage = B2Storage.__new__(B2Storage)
+    storage.api = api
+
+    async def chunks():
+        yield b"hello "
+        yield b""
+        yield b"world"
+
+    stream = io.BufferedReader(
+        AsyncIteratorReader(chunks(), asyncio.get_running_loop())
+    )
+    sha1 = await asyncio.to_thread(storage.upload_part_stream, "file", 1, 11, stream)
+
+    assert sha1 == hashlib.sha1(b"hello world").hexdigest()
+    [(headers, body)] = session.uploaded_parts
+    assert headers["X-Bz-Content-Sha1"] == "hex_digits_at_end"
+    assert body == b"hello world" + sha1.encode()
@@ -0,0 +1,53 @@
+import pytest
+from httpx import AsyncClient
+from storeapi.database import database
+from storeapi.jobs import enqueue_job
+
+
+@pytest.mark.anyio
+async def test_get_job_status(
+    async_client: AsyncClient, confirmed_user: dict, logged_in_token: str
+):
+    job_id = await enqueue_job(
+        database,
+        "generate_and_add_to_post",
+        {"email": confirmed_user["email"], "post_id": 1, "post_url": "", "prompt": ""},
+    )
+
+    response = await async_client.get(
+        f"/job/{job_id}", headers={"Authorization": f"Bearer {logged_in_token}"}
+    )
+
+    assert response.status_code == 200
+    assert {
+        "id": job_id,
+        "name": "generate_and_add_to_post",
+        "status": "queued",
+        "attempts": 0,
+    }.items() <= response.json().items()
+
+
+@pytest.mark.anyio
+async def test_get_job_status_of_other_user(
+    async_client: AsyncClient, logged_in_token: str
+):
+    job_id = await enqueue_job(
+        database,
+        "generate_and_add_to_post",
+        {"email": "other@example.net", "post_id": 1, "post_url": "", "prompt": ""},
+    )
+
+    response = await async_client.get(
+        f"/job/{job_id}", headers={"Authorization": f"Bearer {logged_in_token}"}
+    )
+
+    assert response.status_code == 404
+
+
+@pytest.mark.anyio
+async def test_get_missing_job_status(async_client: AsyncClient, logged_in_token: str):
+    response = await async_client.get(
+        "/job/1", headers={"Authorization": f"Bearer {logged_in_token}"}
+    )
+
+    assert response.status_code == 404
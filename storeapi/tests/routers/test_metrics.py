@@ -0,0 +1,30 @@
+import pytest
+from httpx import AsyncClient
+from prometheus_client import CONTENT_TYPE_LATEST
+from storeapi.database import database
+from storeapi.jobs import enqueue_job
+
+
+@pytest.mark.anyio
+async def test_get_metrics(async_client: AsyncClient):
+    await async_client.get("/post")
+    await enqueue_job(database, "generate_and_add_to_post", {})
+
+    response = await async_client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == CONTENT_TYPE_LATEST
+    assert (
+        'http_requests_total{method="GET",route="/post",status="200"}' in response.text
+    )
+    assert 'job_queue_depth{status="queued"} 1.0' in response.text
+    assert 'job_queue_depth{status="failed"} 0.0' in response.text
+    assert 'cache_misses_total{cache="response"}' in response.text
+    for name in (
+        "http_request_duration_seconds_bucket",
+        "db_pool_connections_in_use",
+        "email_outbox_queue_depth",
+        "password_hash_wait_seconds_count",
+        "log_records_dropped_total",
+    ):
+        assert f"\n{name}" in response.text
@@ -1,7 +1,17 @@
+import csv
+import io
+import json
+
 import pytest
 from httpx import AsyncClient
 
 from storeapi import security
+from storeapi.database import database, like_table, post_table
+from storeapi.jobs import JobWorker
+from storeapi.models.post import UserPostWithLikes
+from storeapi.replicas import ReplicaRouter
+from storeapi.routers import post as post_router
+from storeapi.routers.post import ExportFormat, export_posts, select_post_and_likes
 
 
 async def create_post(
@@ -111,6 +121,51 @@ async def test_like_post(
     assert response.status_code == 201
 
 
+@pytest.mark.anyio
+async def test_like_post_twice(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    await like_post(created_post["id"], async_client, logged_in_token)
+    response = await async_client.post(
+        "/like",
+        json={"post_id": created_post["id"]},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert response.status_code == 409
+
+    response = await async_client.get(f"/post/{created_post['id']}")
+    assert response.json()["post"]["likes"] == 1
+
+
+@pytest.mark.anyio
+async def test_like_post_liked_meanwhile(
+    async_client: AsyncClient,
+    created_post: dict,
+    registered_user: dict,
+    logged_in_token: str,
+    mocker,
+):
+    find_post = post_router.find_post
+
+    async def find_post_then_like(post_id: int):
+        # Another request's like lands between the lookup and the insert
+        post = await find_post(post_id)
+        await database.execute(
+            like_table.insert().values(post_id=post_id, user_id=registered_user["id"])
+        )
+        return post
+
+    mocker.patch.object(post_router, "find_post", side_effect=find_post_then_like)
+
+    response = await async_client.post(
+        "/like",
+        json={"post_id": created_post["id"]},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert response.status_code == 409
+
+
 @pytest.mark.anyio
 async def test_create_post_with_prompt(
     async_client: AsyncClient, logged_in_token: str, mock_generate_cute_creature_api
@@ -126,6 +181,11 @@ async def test_create_post_with_prompt(
         "body": "Test Post",
         "image_url": None,
     }.items() <= response.json().items()
+    # Image generation is queued rather than run as part of the request
+    assert "X-Job-Id" in response.headers
+    mock_generate_cute_creature_api.assert_not_called()
+
+    assert await JobWorker(database).run_pending() == 1
     mock_generate_cute_creature_api.assert_called()
 
 
@@ -177,6 +237,57 @@ async def test_get_all_posts_sort_likes(
     assert post_ids == expected_order
 
 
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "sorting, expected_order",
+    [
+        ("new", [3, 2, 1]),
+        ("old", [1, 2, 3]),
+        ("most_likes", [2, 3, 1]),
+    ],
+)
+async def test_get_all_posts_paginated(
+    async_client: AsyncClient,
+    logged_in_token: str,
+    sorting: str,
+    expected_order: list[int],
+):
+    for body in ("Test Post 1", "Test Post 2", "Test Post 3"):
+        await create_post(body, async_client, logged_in_token)
+    await like_post(2, async_client, logged_in_token)
+
+    post_ids = []
+    params = {"sorting": sorting, "limit": 2}
+    while True:
+        response = await async_client.get("/post", params=params)
+        assert response.status_code == 200
+        post_ids += [post["id"] for post in response.json()]
+        if "X-Next-Cursor" not in response.headers:
+            break
+        params["cursor"] = response.headers["X-Next-Cursor"]
+
+    assert post_ids == expected_order
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_last_page_has_no_cursor(
+    async_client: AsyncClient, created_post: dict
+):
+    response = await async_client.get("/post", params={"limit": 1})
+    assert response.status_code == 200
+    assert "X-Next-Cursor" not in response.headers
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("cursor", ["not a cursor", "eyJzb3J0aW5nIjoib2xkIiwiaWQiOjF9"])
+async def test_get_all_posts_invalid_cursor(async_client: AsyncClient, cursor: str):
+    # The second cursor is valid, but was issued for a different sorting
+    response = await async_client.get(
+        "/post", params={"sorting": "new", "cursor": cursor}
+    )
+    assert response.status_code == 400
+
+
 @pytest.mark.anyio
 async def test_get_all_posts_wrong_sorting(async_client: AsyncClient):
     response = await async_client.get("/post", params={"sorting": "wrong"})
@@ -248,3 +359,493 @@ async def test_get_missing_post_with_comments(
 ):
     response = await async_client.get("/post/2")
     assert response.status_code == 404
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "url, params",
+    [
+        ("/post/{post_id}/comment", {"limit": 2}),
+        ("/post/{post_id}", {"comment_limit": 2}),
+    ],
+)
+async def test_get_comments_paginated(
+    async_client: AsyncClient,
+    created_post: dict,
+    logged_in_token: str,
+    url: str,
+    params: dict,
+):
+    for body in ("Comment 1", "Comment 2", "Comment 3"):
+        await create_comment(body, created_post["id"], async_client, logged_in_token)
+    cursor_param = "cursor" if "limit" in params else "comment_cursor"
+
+    bodies = []
+    while True:
+        response = await async_client.get(
+            url.format(post_id=created_post["id"]), params=params
+        )
+        assert response.status_code == 200
+        data = response.json()
+        comments = data if isinstance(data, list) else data["comments"]
+        bodies += [comment["body"] for comment in comments]
+        if "X-Next-Cursor" not in response.headers:
+            break
+        params[cursor_param] = response.headers["X-Next-Cursor"]
+
+    assert bodies == ["Comment 1", "Comment 2", "Comment 3"]
+
+
+@pytest.mark.anyio
+async def test_get_post_with_comments_no_comments(
+    async_client: AsyncClient, created_post: dict
+):
+    response = await async_client.get(f"/post/{created_post['id']}")
+
+    assert response.status_code == 200
+    assert response.json() == {"post": {**created_post, "likes": 0}, "comments": []}
+
+
+@pytest.mark.anyio
+async def test_get_post_with_comments_single_query(
+    async_client: AsyncClient, created_post: dict, created_comment: dict, mocker
+):
+    spy = mocker.spy(database, "fetch_all")
+    fetch_one_spy = mocker.spy(database, "fetch_one")
+
+    response = await async_client.get(f"/post/{created_post['id']}")
+
+    assert response.status_code == 200
+    assert spy.call_count + fetch_one_spy.call_count == 1
+
+
+@pytest.mark.anyio
+async def test_get_comments_cursor_from_other_post(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    for body in ("Comment 1", "Comment 2"):
+        await create_comment(body, created_post["id"], async_client, logged_in_token)
+    response = await async_client.get(
+        f"/post/{created_post['id']}/comment", params={"limit": 1}
+    )
+    cursor = response.headers["X-Next-Cursor"]
+
+    await create_post("Test Post 2", async_client, logged_in_token)
+    response = await async_client.get("/post/2/comment", params={"cursor": cursor})
+    assert response.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_is_cached(
+    async_client: AsyncClient, created_post: dict, mocker
+):
+    await async_client.get("/post")
+    spy = mocker.spy(database, "fetch_all")
+
+    response = await async_client.get("/post")
+
+    assert response.status_code == 200
+    assert response.json()[0]["id"] == created_post["id"]
+    assert spy.call_count == 0
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_cache_keeps_next_cursor(
+    async_client: AsyncClient, logged_in_token: str
+):
+    for body in ("Post 1", "Post 2"):
+        await create_post(body, async_client, logged_in_token)
+
+    first = await async_client.get("/post", params={"limit": 1})
+    second = await async_client.get("/post", params={"limit": 1})
+
+    assert second.headers["X-Next-Cursor"] == first.headers["X-Next-Cursor"]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "write",
+    [
+        lambda post, client, token: create_post("Post 2", client, token),
+        lambda post, client, token: like_post(post["id"], client, token),
+    ],
+)
+async def test_get_all_posts_cache_invalidated(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str, write
+):
+    before = await async_client.get("/post")
+
+    await write(created_post, async_client, logged_in_token)
+    after = await async_client.get("/post")
+
+    assert after.json() != before.json()
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "write",
+    [
+        lambda post, client, token: create_comment("Hi", post["id"], client, token),
+        lambda post, client, token: like_post(post["id"], client, token),
+    ],
+)
+async def test_get_post_with_comments_cache_invalidated(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str, write
+):
+    before = await async_client.get(f"/post/{created_post['id']}")
+
+    await write(created_post, async_client, logged_in_token)
+    after = await async_client.get(f"/post/{created_post['id']}")
+
+    assert after.json() != before.json()
+
+
+@pytest.mark.anyio
+async def test_get_post_with_comments_cache_is_per_post(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str, mocker
+):
+    other_post = await create_post("Post 2", async_client, logged_in_token)
+    await async_client.get(f"/post/{created_post['id']}")
+    await create_comment("Hi", other_post["id"], async_client, logged_in_token)
+    spy = mocker.spy(database, "fetch_all")
+
+    await async_client.get(f"/post/{created_post['id']}")
+
+    assert spy.call_count == 0
+
+
+@pytest.mark.anyio
+async def test_get_post_image_update_invalidates_cache(
+    async_client: AsyncClient,
+    logged_in_token: str,
+    mock_generate_cute_creature_api,
+):
+    await async_client.post(
+        "/post?prompt=A cat",
+        json={"body": "Test Post"},
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    before = await async_client.get("/post/1")
+
+    await JobWorker(database).run_pending()
+    after = await async_client.get("/post/1")
+
+    assert before.json()["post"]["image_url"] is None
+    assert after.json()["post"]["image_url"] == "http://example.net"
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("url", ["/post", "/post/1"])
+async def test_get_post_not_modified(
+    async_client: AsyncClient, created_post: dict, url: str
+):
+    response = await async_client.get(url)
+    etag = response.headers["ETag"]
+
+    response = await async_client.get(url, headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.content == b""
+
+
+@pytest.mark.anyio
+async def test_get_post_etag_changes_with_content(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    response = await async_client.get("/post/1")
+    etag = response.headers["ETag"]
+    await like_post(created_post["id"], async_client, logged_in_token)
+
+    response = await async_client.get("/post/1", headers={"If-None-Match": etag})
+
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+@pytest.mark.anyio
+async def test_read_endpoints_keep_openapi_schema(async_client: AsyncClient):
+    response = await async_client.get("/openapi.json")
+    paths = response.json()["paths"]
+
+    def schema(path: str) -> dict:
+        return paths[path]["get"]["responses"]["200"]["content"]["application/json"][
+            "schema"
+        ]
+
+    assert schema("/post")["items"]["$ref"].endswith("/UserPostWithLikes")
+    assert schema("/post/{post_id}")["$ref"].endswith("/UserPostWithComments")
+    assert schema("/post/{post_id}/comment")["items"]["$ref"].endswith("/Comment")
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_matches_response_model(
+    async_client: AsyncClient, created_post: dict
+):
+    response = await async_client.get("/post")
+
+    assert response.json() == [UserPostWithLikes(**created_post, likes=0).model_dump()]
+
+
+@pytest.mark.anyio
+async def test_export_posts_ndjson(
+    async_client: AsyncClient, logged_in_token: str, confirmed_user: dict
+):
+    for body in ("Post 1", "Post 2"):
+        await create_post(body, async_client, logged_in_token)
+    await like_post(2, async_client, logged_in_token)
+
+    response = await async_client.get("/post/export")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert [json.loads(line) for line in response.text.splitlines()] == [
+        {
+            "id": 1,
+            "body": "Post 1",
+            "user_id": confirmed_user["id"],
+            "image_url": None,
+            "likes": 0,
+        },
+        {
+            "id": 2,
+            "body": "Post 2",
+            "user_id": confirmed_user["id"],
+            "image_url": None,
+            "likes": 1,
+        },
+    ]
+
+
+@pytest.mark.anyio
+async def test_export_posts_csv(
+    async_client: AsyncClient, logged_in_token: str, confirmed_user: dict
+):
+    await create_post("Post, with a comma", async_client, logged_in_token)
+
+    response = await async_client.get("/post/export", params={"format": "csv"})
+
+    assert response.headers["content-type"].startswith("text/csv")
+    assert list(csv.reader(io.StringIO(response.text))) == [
+        ["id", "body", "user_id", "image_url", "likes"],
+        ["1", "Post, with a comma", str(confirmed_user["id"]), "", "0"],
+    ]
+
+
+@pytest.mark.anyio
+async def test_export_posts_empty_csv_has_header(async_client: AsyncClient):
+    response = await async_client.get("/post/export", params={"format": "csv"})
+
+    assert response.text.splitlines() == ["id,body,user_id,image_url,likes"]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "params, ids",
+    [
+        ({"min_id": 2}, [2, 3, 4, 5]),
+        ({"max_id": 2}, [1, 2]),
+        ({"min_id": 2, "max_id": 3}, [2, 3]),
+        ({"user_id": 1}, [1, 2, 3, 4, 5]),
+        ({"user_id": 2}, []),
+    ],
+)
+async def test_export_posts_filtered(
+    async_client: AsyncClient, logged_in_token: str, params: dict, ids: list
+):
+    for number in range(5):
+        await create_post(f"Post {number}", async_client, logged_in_token)
+
+    response = await async_client.get("/post/export", params=params)
+
+    assert [json.loads(line)["id"] for line in response.text.splitlines()] == ids
+
+
+@pytest.mark.anyio
+async def test_export_posts_streams_in_batches(
+    async_client: AsyncClient, logged_in_token: str, mocker
+):
+    mocker.patch("storeapi.routers.post.EXPORT_BATCH_ROWS", 2)
+    fetch_all_spy = mocker.spy(database, "fetch_all")
+    for number in range(5):
+        await create_post(f"Post {number}", async_client, logged_in_token)
+
+    query = select_post_and_likes.order_by(post_table.c.id)
+    chunks = [chunk async for chunk in export_posts(query, ExportFormat.ndjson)]
+
+    assert [chunk.count(b"\n") for chunk in chunks] == [2, 2, 1]
+    fetch_all_spy.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_like_posts_batch(
+    async_client: AsyncClient, logged_in_token: str, mocker
+):
+    for body in ("Post 1", "Post 2", "Post 3"):
+        await create_post(body, async_client, logged_in_token)
+    await like_post(3, async_client, logged_in_token)
+    fetch_all_spy = mocker.spy(database, "fetch_all")
+    execute_spy = mocker.spy(database, "execute")
+
+    response = await async_client.post(
+        "/like/batch",
+        json=[{"post_id": post_id} for post_id in (1, 2, 1, 3, 99)],
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert response.status_code == 200
+    assert [result["status"] for result in response.json()["results"]] == [
+        "created",
+        "created",
+        "already_liked",
+        "already_liked",
+        "post_not_found",
+    ]
+    assert fetch_all_spy.call_count == 2
+    assert execute_spy.call_count == 1
+
+    response = await async_client.get("/post", params={"sorting": "old"})
+    assert [post["likes"] for post in response.json()] == [1, 1, 1]
+
+
+@pytest.mark.anyio
+async def test_like_posts_batch_liked_meanwhile(
+    async_client: AsyncClient,
+    registered_user: dict,
+    logged_in_token: str,
+    mocker,
+):
+    for body in ("Post 1", "Post 2"):
+        await create_post(body, async_client, logged_in_token)
+    find_existing_post_ids = post_router.find_existing_post_ids
+
+    async def find_then_like(post_ids: set[int]):
+        # Another request's like of post 2 lands before the insert
+        existing = await find_existing_post_ids(post_ids)
+        await database.execute(
+            like_table.insert().values(post_id=2, user_id=registered_user["id"])
+        )
+        return existing
+
+    mocker.patch.object(
+        post_router, "find_existing_post_ids", side_effect=find_then_like
+    )
+
+    response = await async_client.post(
+        "/like/batch",
+        json=[{"post_id": 1}, {"post_id": 2}],
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert [result["status"] for result in response.json()["results"]] == [
+        "created",
+        "already_liked",
+    ]
+    response = await async_client.get("/post", params={"sorting": "old"})
+    assert [post["likes"] for post in response.json()] == [1, 0]
+
+
+@pytest.mark.anyio
+async def test_create_comments_batch(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    response = await async_client.post(
+        "/comment/batch",
+        json=[
+            {"body": "Comment 1", "post_id": created_post["id"]},
+            {"body": "Comment 2", "post_id": 99},
+            {"body": "Comment 3", "post_id": created_post["id"]},
+        ],
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert response.status_code == 200
+    assert response.json()["results"] == [
+        {"post_id": created_post["id"], "status": "created"},
+        {"post_id": 99, "status": "post_not_found"},
+        {"post_id": created_post["id"], "status": "created"},
+    ]
+
+    response = await async_client.get(f"/post/{created_post['id']}/comment")
+    assert [comment["body"] for comment in response.json()] == [
+        "Comment 1",
+        "Comment 3",
+    ]
+
+
+@pytest.mark.anyio
+async def test_create_comments_batch_too_large(
+    async_client: AsyncClient, created_post: dict, logged_in_token: str
+):
+    response = await async_client.post(
+        "/comment/batch",
+        json=[{"body": "Hi", "post_id": created_post["id"]}] * 501,
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert response.status_code == 422
+
+
+@pytest.mark.anyio
+async def test_like_posts_batch_unauthorized(async_client: AsyncClient):
+    response = await async_client.post("/like/batch", json=[{"post_id": 1}])
+
+    assert response.status_code == 401
+
+
+class EmptyReplica:
+    """A replica that hasn't caught up with anything yet."""
+
+    async def fetch_all(self, query):
+        return []
+
+
+@pytest.fixture()
+def lagging_replica(mocker) -> ReplicaRouter:
+    router = ReplicaRouter(database, [EmptyReplica()])
+    mocker.patch("storeapi.routers.post.read_database", router)
+    return router
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_reads_from_replica(
+    async_client: AsyncClient, created_post: dict, lagging_replica
+):
+    # The post was written by another user
+    lagging_replica._recent_writers.clear()
+
+    response = await async_client.get("/post")
+
+    assert response.json() == []
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_reads_own_writes_on_another_worker(
+    async_client: AsyncClient, logged_in_token: str, lagging_replica
+):
+    await create_post("Test Post", async_client, logged_in_token)
+    # Another worker process doesn't know who wrote, but gets the cookie
+    lagging_replica._recent_writers.clear()
+
+    response = await async_client.get("/post")
+
+    assert "last_write" in async_client.cookies
+    assert len(response.json()) == 1
+
+
+@pytest.mark.anyio
+async def test_get_all_posts_reads_own_writes(
+    async_client: AsyncClient, logged_in_token: str, lagging_replica
+):
+    await create_post("Test Post", async_client, logged_in_token)
+
+    # Another client, without the writer's cookie
+    async_client.cookies.clear()
+    anonymous_response = await async_client.get("/post")
+    # Skips the cached response built from the replica
+    response = await async_client.get(
+        "/post", headers={"Authorization": f"Bearer {logged_in_token}"}
+    )
+
+    assert anonymous_response.json() == []
+    assert len(response.json()) == 1
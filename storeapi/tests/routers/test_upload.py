@@ -1,78 +1,526 @@
-import contextlib
 import os
-import pathlib
 import tempfile
 
 import pytest
 from httpx import AsyncClient
+from storeapi.config import config
+from storeapi.database import database, upload_session_table
+from storeapi.libs.b2.streaming import StoredFile
+from storeapi.routers.upload import (
+    expire_upload_sessions,
+    find_upload_url,
+    record_upload,
+)
 
+PART_SIZE = 1024
 
-# Add a sample image to the fake filesystem
-@pytest.fixture()
-def sample_image(fs) -> pathlib.Path:
-    path = (pathlib.Path(__file__).parent / "assets" / "myfile.png").resolve()
-    fs.create_file(path)
-    return path
 
-
-# Mock the b2_upload_file function so that it returns a fake URL
 @pytest.fixture(autouse=True)
-def mock_b2_upload_file(mocker):
-    return mocker.patch(
-        "storeapi.routers.upload.b2_upload_file", return_value="https://fakeurl.com"
+def small_parts(mocker):
+    mocker.patch("storeapi.libs.b2.streaming.CHUNK_SIZE", 256)
+    mocker.patch.object(config, "B2_PART_SIZE", PART_SIZE)
+    mocker.patch.object(config, "B2_UPLOAD_CONCURRENCY", 2)
+
+
+async def call_upload_endpoint(async_client: AsyncClient, token: str, content: bytes):
+    return await async_client.post(
+        "/upload",
+        files={"file": ("myfile.png", content, "image/png")},
+        headers={"Authorization": f"Bearer {token}"},
     )
 
 
-# Mock the aiofiles.open function so that it
-# returns a fake file object from the fake filesystem
-@pytest.fixture(autouse=True)
-def aiofiles_mock_open(mocker, fs):
-    import io
+@pytest.mark.anyio
+async def test_upload_image(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage
+):
+    response = await call_upload_endpoint(async_client, logged_in_token, b"image")
+    assert response.status_code == 201
+    assert response.json()["file_url"] == "https://fakeurl.com/file-1"
+    assert fake_b2_storage.files == {"file-1": b"image"}
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("size", [PART_SIZE + 1, PART_SIZE * 5, PART_SIZE * 5 + 7])
+async def test_upload_large_image_in_parts(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage, size: int
+):
+    content = os.urandom(size)
+
+    response = await call_upload_endpoint(async_client, logged_in_token, content)
+
+    assert response.status_code == 201
+    assert response.json()["file_url"] == "https://fakeurl.com/large-1"
+    assert fake_b2_storage.files == {"large-1": content}
+    assert fake_b2_storage.max_parts_in_flight <= 2
+
+
+@pytest.mark.anyio
+async def test_upload_exactly_one_part_is_not_large_file(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage
+):
+    content = os.urandom(PART_SIZE)
+
+    response = await call_upload_endpoint(async_client, logged_in_token, content)
+
+    assert response.status_code == 201
+    assert fake_b2_storage.files == {"file-1": content}
+
 
-    mock_open = mocker.patch("aiofiles.open")
+@pytest.mark.anyio
+async def test_upload_failed_part_cancels_large_file(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage
+):
+    fake_b2_storage.fail_part = 2
 
-    @contextlib.asynccontextmanager
-    async def async_file_open(fname: str, mode: str = "r"):
-        out_fs_mock = mocker.AsyncMock(name=f"async_file_open:{fname!r}/{mode!r}")
-        with io.open(fname, mode) as fin:
-            out_fs_mock.read.side_effect = fin.read
-            yield out_fs_mock
+    response = await call_upload_endpoint(
+        async_client, logged_in_token, os.urandom(PART_SIZE * 4)
+    )
 
-    mock_open.side_effect = async_file_open
-    return mock_open
+    assert response.status_code == 500
+    assert fake_b2_storage.cancelled == ["large-1"]
+    assert fake_b2_storage.files == {}
 
 
-async def call_upload_endpoint(
-    async_client: AsyncClient, token: str, sample_image: pathlib.Path
+@pytest.mark.anyio
+async def test_upload_does_not_stage_temp_file(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage, mocker
+):
+    named_temp_file_spy = mocker.spy(tempfile, "NamedTemporaryFile")
+
+    response = await call_upload_endpoint(async_client, logged_in_token, b"image")
+
+    assert response.status_code == 201
+    named_temp_file_spy.assert_not_called()
+
+
+async def call_batch_upload_endpoint(
+    async_client: AsyncClient, token: str, files: dict[str, bytes]
 ):
     return await async_client.post(
-        "/upload",
-        files={"file": open(sample_image, "rb")},
+        "/upload/batch",
+        files=[
+            ("files", (name, content, "image/png")) for name, content in files.items()
+        ],
         headers={"Authorization": f"Bearer {token}"},
     )
 
 
 @pytest.mark.anyio
-async def test_upload_image(
-    async_client: AsyncClient, logged_in_token: str, sample_image: pathlib.Path
+async def test_batch_upload(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage
 ):
-    response = await call_upload_endpoint(async_client, logged_in_token, sample_image)
+    large = os.urandom(PART_SIZE * 3)
+
+    response = await call_batch_upload_endpoint(
+        async_client, logged_in_token, {"a.png": b"a", "b.png": large}
+    )
+
     assert response.status_code == 201
-    assert response.json()["file_url"] == "https://fakeurl.com"
+    assert response.json()["results"] == [
+        {"filename": "a.png", "file_url": "https://fakeurl.com/file-1"},
+        {"filename": "b.png", "file_url": "https://fakeurl.com/large-1"},
+    ]
+    assert fake_b2_storage.files == {"file-1": b"a", "large-1": large}
 
 
 @pytest.mark.anyio
-async def test_temp_file_removed_after_upload(
-    async_client: AsyncClient, logged_in_token: str, sample_image: pathlib.Path, mocker
+async def test_batch_upload_runs_files_in_parallel(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage, mocker
 ):
-    # Spy on the NamedTemporaryFile function
-    named_temp_file_spy = mocker.spy(tempfile, "NamedTemporaryFile")
+    mocker.patch.object(config, "B2_BATCH_UPLOAD_CONCURRENCY", 3)
+    fake_b2_storage.upload_delay = 0.05
+    files = {f"{number}.png": os.urandom(16) for number in range(6)}
+
+    response = await call_batch_upload_endpoint(async_client, logged_in_token, files)
+
+    assert response.status_code == 201
+    assert len(fake_b2_storage.files) == 6
+    assert fake_b2_storage.max_files_in_flight == 3
+
+
+@pytest.mark.anyio
+async def test_batch_upload_reports_failed_files(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage
+):
+    fake_b2_storage.fail_file_name = "b.png"
+
+    response = await call_batch_upload_endpoint(
+        async_client, logged_in_token, {"a.png": b"a", "b.png": b"b"}
+    )
+
+    assert response.status_code == 207
+    assert response.json()["results"] == [
+        {"filename": "a.png", "file_url": "https://fakeurl.com/file-1"},
+        {"filename": "b.png", "error": "There was an error uploading the file"},
+    ]
+
+
+@pytest.mark.anyio
+async def test_upload_same_file_twice_reuses_it(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage
+):
+    first = await call_upload_endpoint(async_client, logged_in_token, b"image")
+    second = await call_upload_endpoint(async_client, logged_in_token, b"image")
+
+    assert second.status_code == 201
+    assert second.json()["file_url"] == first.json()["file_url"]
+    assert fake_b2_storage.files == {"file-1": b"image"}
+
+
+@pytest.mark.anyio
+async def test_upload_different_files_are_not_deduplicated(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage
+):
+    await call_upload_endpoint(async_client, logged_in_token, b"image")
+    await call_upload_endpoint(async_client, logged_in_token, b"other image")
+
+    assert len(fake_b2_storage.files) == 2
+
+
+@pytest.mark.anyio
+async def test_upload_same_large_file_twice_cancels_the_copy(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage
+):
+    content = os.urandom(PART_SIZE * 3)
+
+    first = await call_upload_endpoint(async_client, logged_in_token, content)
+    second = await call_upload_endpoint(async_client, logged_in_token, content)
+
+    assert second.json()["file_url"] == first.json()["file_url"]
+    assert fake_b2_storage.files == {"large-1": content}
+    assert fake_b2_storage.cancelled == ["large-2"]
+
+
+@pytest.mark.anyio
+async def test_failed_upload_is_not_recorded(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage
+):
+    fake_b2_storage.fail_file_name = "myfile.png"
+    await call_upload_endpoint(async_client, logged_in_token, b"image")
+    fake_b2_storage.fail_file_name = None
+
+    response = await call_upload_endpoint(async_client, logged_in_token, b"image")
+
+    assert response.status_code == 201
+    assert fake_b2_storage.files == {"file-1": b"image"}
+
+
+@pytest.mark.anyio
+async def test_record_upload_ignores_identical_file():
+    stored_file = StoredFile("https://b2/file-1", "hash", 5, "file-1")
+    await record_upload(stored_file)
+
+    await record_upload(StoredFile("https://b2/file-2", "hash", 5, "file-2"))
+
+    assert await find_upload_url("hash") == "https://b2/file-1"
+
+
+@pytest.mark.anyio
+async def test_record_upload_raises_other_database_errors(mocker):
+    mocker.patch.object(database, "fetch_val", side_effect=OSError("disk I/O error"))
+
+    with pytest.raises(OSError):
+        await record_upload(StoredFile("https://b2/file-1", "hash", 5, "file-1"))
+
+
+async def create_upload_session(async_client: AsyncClient, token: str) -> dict:
+    response = await async_client.post(
+        "/upload/sessions",
+        json={"file_name": "video.mp4", "content_type": "video/mp4"},
+        headers={"Authorization": f"Bearer {token}"},
+    )
+    assert response.status_code == 201
+    return response.json()
+
+
+async def put_part(
+    async_client: AsyncClient, token: str, session_id: str, number: int, data: bytes
+):
+    return await async_client.put(
+        f"/upload/sessions/{session_id}/parts/{number}",
+        content=data,
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+
+async def finish_upload_session(async_client: AsyncClient, token: str, session_id):
+    return await async_client.post(
+        f"/upload/sessions/{session_id}/finish",
+        headers={"Authorization": f"Bearer {token}"},
+    )
+
+
+@pytest.mark.anyio
+async def test_resumable_upload(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage
+):
+    parts = [os.urandom(PART_SIZE), os.urandom(PART_SIZE), os.urandom(10)]
+    session = await create_upload_session(async_client, logged_in_token)
+
+    assert session["status"] == "open"
+    assert session["part_size"] == PART_SIZE
+    # Parts may arrive in any order
+    for number in (2, 3, 1):
+        response = await put_part(
+            async_client, logged_in_token, session["id"], number, parts[number - 1]
+        )
+        assert response.status_code == 200
+        assert response.json()["size"] == len(parts[number - 1])
+
+    response = await finish_upload_session(async_client, logged_in_token, session["id"])
+
+    assert response.status_code == 201
+    assert response.json()["file_url"] == "https://fakeurl.com/large-1"
+    assert fake_b2_storage.files == {"large-1": b"".join(parts)}
+
+
+@pytest.mark.anyio
+async def test_resumable_upload_resumes_after_failed_part(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage
+):
+    parts = [os.urandom(PART_SIZE), os.urandom(5)]
+    session = await create_upload_session(async_client, logged_in_token)
+    await put_part(async_client, logged_in_token, session["id"], 1, parts[0])
+    fake_b2_storage.fail_part = 2
+
+    response = await put_part(async_client, logged_in_token, session["id"], 2, parts[1])
+    assert response.status_code == 500
+
+    # The client asks what arrived and sends the rest
+    response = await async_client.get(
+        f"/upload/sessions/{session['id']}",
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert [part["part_number"] for part in response.json()["parts"]] == [1]
+
+    fake_b2_storage.fail_part = None
+    await put_part(async_client, logged_in_token, session["id"], 2, parts[1])
+    response = await finish_upload_session(async_client, logged_in_token, session["id"])
 
-    response = await call_upload_endpoint(async_client, logged_in_token, sample_image)
     assert response.status_code == 201
+    assert fake_b2_storage.files == {"large-1": b"".join(parts)}
+
+
+@pytest.mark.anyio
+async def test_resumable_upload_replaces_resent_part(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage
+):
+    session = await create_upload_session(async_client, logged_in_token)
+    await put_part(async_client, logged_in_token, session["id"], 1, b"a" * PART_SIZE)
+    await put_part(async_client, logged_in_token, session["id"], 1, b"b" * PART_SIZE)
+    await put_part(async_client, logged_in_token, session["id"], 2, b"c")
+
+    response = await finish_upload_session(async_client, logged_in_token, session["id"])
+
+    assert response.status_code == 201
+    assert fake_b2_storage.files == {"large-1": b"b" * PART_SIZE + b"c"}
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("part_numbers", [[], [1], [1, 3]])
+async def test_finish_resumable_upload_with_missing_parts(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage, part_numbers
+):
+    session = await create_upload_session(async_client, logged_in_token)
+    for number in part_numbers:
+        await put_part(
+            async_client, logged_in_token, session["id"], number, b"a" * PART_SIZE
+        )
+
+    response = await finish_upload_session(async_client, logged_in_token, session["id"])
+
+    assert response.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_finish_resumable_upload_with_small_part(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage
+):
+    session = await create_upload_session(async_client, logged_in_token)
+    await put_part(async_client, logged_in_token, session["id"], 1, b"a")
+    await put_part(async_client, logged_in_token, session["id"], 2, b"b")
+
+    response = await finish_upload_session(async_client, logged_in_token, session["id"])
+
+    assert response.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_resumable_upload_rejects_large_part(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage, mocker
+):
+    mocker.patch.object(config, "B2_MAX_PART_SIZE", PART_SIZE)
+    session = await create_upload_session(async_client, logged_in_token)
+
+    response = await put_part(
+        async_client, logged_in_token, session["id"], 1, b"a" * (PART_SIZE + 1)
+    )
+
+    assert response.status_code == 413
+
+
+@pytest.mark.anyio
+async def test_resumable_upload_streams_part_to_b2(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage, mocker
+):
+    session = await create_upload_session(async_client, logged_in_token)
+    upload_part = mocker.spy(fake_b2_storage, "upload_part")
+
+    async def chunks():
+        for _ in range(4):
+            yield b"a" * 256
+
+    response = await async_client.put(
+        f"/upload/sessions/{session['id']}/parts/1",
+        content=chunks(),
+        headers={
+            "Authorization": f"Bearer {logged_in_token}",
+            "Content-Length": "1024",
+        },
+    )
+
+    assert response.status_code == 200
+    assert response.json()["size"] == 1024
+    assert upload_part.call_args.args[2] == b"a" * 1024
+
+
+@pytest.mark.anyio
+async def test_resumable_upload_rejects_part_without_length(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage
+):
+    session = await create_upload_session(async_client, logged_in_token)
+
+    async def chunks():
+        yield b"a"
+
+    response = await async_client.put(
+        f"/upload/sessions/{session['id']}/parts/1",
+        content=chunks(),
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert response.status_code == 411
+
+
+@pytest.mark.anyio
+async def test_resumable_upload_rejects_part_shorter_than_its_length(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage
+):
+    session = await create_upload_session(async_client, logged_in_token)
+
+    async def chunks():
+        yield b"a" * 10
+
+    response = await async_client.put(
+        f"/upload/sessions/{session['id']}/parts/1",
+        content=chunks(),
+        headers={
+            "Authorization": f"Bearer {logged_in_token}",
+            "Content-Length": "20",
+        },
+    )
+
+    assert response.status_code == 400
+    assert fake_b2_storage.large_files["large-1"] == {}
+
+
+@pytest.mark.anyio
+async def test_finished_upload_session_rejects_parts(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage
+):
+    session = await create_upload_session(async_client, logged_in_token)
+    await put_part(async_client, logged_in_token, session["id"], 1, b"a" * PART_SIZE)
+    await put_part(async_client, logged_in_token, session["id"], 2, b"b")
+    await finish_upload_session(async_client, logged_in_token, session["id"])
+
+    response = await put_part(async_client, logged_in_token, session["id"], 3, b"c")
+
+    assert response.status_code == 409
+
+
+@pytest.mark.anyio
+async def test_cancel_upload_session(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage
+):
+    session = await create_upload_session(async_client, logged_in_token)
+
+    response = await async_client.delete(
+        f"/upload/sessions/{session['id']}",
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+
+    assert response.status_code == 204
+    assert fake_b2_storage.cancelled == ["large-1"]
+
+
+@pytest.mark.anyio
+async def test_upload_session_not_found(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage
+):
+    response = await put_part(async_client, logged_in_token, "missing", 1, b"a")
+
+    assert response.status_code == 404
+
+
+async def age_upload_session(session_id: str, seconds: float):
+    query = (
+        upload_session_table.update()
+        .where(upload_session_table.c.id == session_id)
+        .values(updated_at=upload_session_table.c.updated_at - seconds)
+    )
+    await database.execute(query)
+
+
+@pytest.mark.anyio
+async def test_expired_upload_session_rejects_parts(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage
+):
+    session = await create_upload_session(async_client, logged_in_token)
+    await age_upload_session(session["id"], config.UPLOAD_SESSION_TTL_SECONDS + 1)
+
+    response = await put_part(async_client, logged_in_token, session["id"], 1, b"a")
+
+    assert response.status_code == 410
+
+
+@pytest.mark.anyio
+async def test_expire_upload_sessions(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage
+):
+    stale = await create_upload_session(async_client, logged_in_token)
+    await put_part(async_client, logged_in_token, stale["id"], 1, b"a")
+    await age_upload_session(stale["id"], config.UPLOAD_SESSION_TTL_SECONDS + 1)
+    active = await create_upload_session(async_client, logged_in_token)
+
+    assert await expire_upload_sessions() == 1
+
+    assert fake_b2_storage.cancelled == ["large-1"]
+    response = await async_client.get(
+        f"/upload/sessions/{stale['id']}",
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert response.status_code == 404
+    response = await async_client.get(
+        f"/upload/sessions/{active['id']}",
+        headers={"Authorization": f"Bearer {logged_in_token}"},
+    )
+    assert response.json()["status"] == "open"
+
+
+@pytest.mark.anyio
+async def test_expire_upload_sessions_keeps_session_when_cancel_fails(
+    async_client: AsyncClient, logged_in_token: str, fake_b2_storage, mocker
+):
+    session = await create_upload_session(async_client, logged_in_token)
+    await age_upload_session(session["id"], config.UPLOAD_SESSION_TTL_SECONDS + 1)
+    cancel = mocker.patch.object(
+        fake_b2_storage, "cancel_large_file", side_effect=RuntimeError("B2 is down")
+    )
 
-    # Get the filename of the temporary file created by the upload endpoint
-    created_temp_file = named_temp_file_spy.spy_return
+    assert await expire_upload_sessions() == 0
 
-    # Check if the temp_file is removed after the file is uploaded
-    assert not os.path.exists(created_temp_file.name)
+    # Still expired, so the next run tries again
+    cancel.side_effect = None
+    assert await expire_upload_sessions() == 1
+    cancel.assert_called_with("large-1")
@@ -1,6 +1,10 @@
+import asyncio
+import time
+
 import pytest
 from fastapi import BackgroundTasks
 from httpx import AsyncClient
+from storeapi import security
 
 
 async def register_user(async_client: AsyncClient, email: str, password: str):
@@ -39,6 +43,19 @@ async def test_confirm_user(async_client: AsyncClient, mocker):
     assert "User confirmed" in response.json()["detail"]
 
 
+@pytest.mark.anyio
+async def test_confirm_user_invalidates_cached_user(
+    async_client: AsyncClient, registered_user: dict, mocker
+):
+    token = security.create_access_token(registered_user["email"])
+    assert not (await security.get_current_user(token)).confirmed
+
+    confirmation_token = security.create_confirmation_token(registered_user["email"])
+    await async_client.get(f"/confirm/{confirmation_token}")
+
+    assert (await security.get_current_user(token)).confirmed
+
+
 @pytest.mark.anyio
 async def test_confirm_user_invalid_token(async_client: AsyncClient):
     response = await async_client.get("/confirm/invalid_token")
@@ -87,3 +104,33 @@ async def test_login_user(async_client: AsyncClient, confirmed_user: dict):
         json={"email": confirmed_user["email"], "password": confirmed_user["password"]},
     )
     assert response.status_code == 200
+
+
+@pytest.mark.anyio
+async def test_login_does_not_block_other_requests(
+    async_client: AsyncClient, confirmed_user: dict, mocker
+):
+    def slow_verify_password(plain_password: str, hashed_password: str) -> bool:
+        time.sleep(0.5)
+        return True
+
+    mocker.patch("storeapi.security.verify_password", side_effect=slow_verify_password)
+    credentials = {
+        "email": confirmed_user["email"],
+        "password": confirmed_user["password"],
+    }
+    logins = [
+        asyncio.ensure_future(async_client.post("/token", json=credentials))
+        for _ in range(4)
+    ]
+    # Give the logins time to reach password verification
+    await asyncio.sleep(0.1)
+
+    start = time.perf_counter()
+    response = await async_client.get("/post")
+    elapsed = time.perf_counter() - start
+
+    assert response.status_code == 200
+    assert elapsed < 0.25
+    for login in await asyncio.gather(*logins):
+        assert login.status_code == 200
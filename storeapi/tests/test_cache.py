@@ -0,0 +1,71 @@
+from storeapi.cache import TTLCache
+
+
+def test_get_missing():
+    cache = TTLCache(maxsize=2, ttl=60)
+    assert cache.get("missing") is None
+    assert cache.get("missing", "default") == "default"
+    assert cache.misses == 2
+
+
+def test_set_and_get():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("key", "value")
+    assert cache.get("key") == "value"
+    assert cache.hits == 1
+
+
+def test_expired_entries_are_misses(mocker):
+    monotonic = mocker.patch("storeapi.cache.time.monotonic", return_value=100)
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("key", "value")
+    cache.set("short", "value", ttl=10)
+
+    monotonic.return_value = 120
+    assert cache.get("short") is None
+    assert cache.get("key") == "value"
+
+    monotonic.return_value = 160
+    assert cache.get("key") is None
+    assert len(cache) == 0
+
+
+def test_ttl_never_exceeds_default(mocker):
+    monotonic = mocker.patch("storeapi.cache.time.monotonic", return_value=100)
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("key", "value", ttl=600)
+
+    monotonic.return_value = 160
+    assert cache.get("key") is None
+
+
+def test_least_recently_used_evicted():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+
+    assert cache.get("b") is None
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+
+
+def test_delete_and_clear():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.delete("a")
+    assert cache.get("a") is None
+
+    cache.clear()
+    assert len(cache) == 0
+    assert (cache.hits, cache.misses) == (0, 0)
+
+
+def test_counts_hits_and_misses():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.get("a")
+    cache.get("b")
+    assert (cache.hits, cache.misses) == (1, 1)
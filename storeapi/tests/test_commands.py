@@ -0,0 +1,34 @@
+import pytest
+from storeapi.commands import (
+    add_like_count_column,
+    create_indexes,
+    reconcile_like_counts,
+)
+from storeapi.database import database, like_table, post_table
+
+
+@pytest.mark.anyio
+async def test_reconcile_like_counts(confirmed_user: dict):
+    user_id = confirmed_user["id"]
+    await database.execute(
+        post_table.insert().values(id=1, body="Liked", user_id=user_id, like_count=5)
+    )
+    await database.execute(
+        post_table.insert().values(id=2, body="Not liked", user_id=user_id)
+    )
+    await database.execute(like_table.insert().values(post_id=2, user_id=user_id))
+
+    await reconcile_like_counts(database)
+
+    posts = await database.fetch_all(post_table.select().order_by(post_table.c.id))
+    assert [post.like_count for post in posts] == [0, 1]
+
+
+def test_add_like_count_column_is_idempotent():
+    add_like_count_column()
+    add_like_count_column()
+
+
+def test_create_indexes_is_idempotent():
+    create_indexes()
+    create_indexes()
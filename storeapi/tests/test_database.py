@@ -0,0 +1,71 @@
+import pytest
+import sqlalchemy
+from sqlalchemy.dialects import sqlite
+from storeapi.database import (
+    check_dialect,
+    comment_table,
+    database,
+    like_table,
+    post_table,
+)
+
+
+async def query_plan(query) -> str:
+    compiled = query.compile(
+        dialect=sqlite.dialect(), compile_kwargs={"literal_binds": True}
+    )
+    rows = await database.fetch_all(sqlalchemy.text(f"EXPLAIN QUERY PLAN {compiled}"))
+    return " ".join(row.detail for row in rows)
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize(
+    "query, index",
+    [
+        (
+            comment_table.select().where(comment_table.c.post_id == 1),
+            "ix_comments_post_id",
+        ),
+        (
+            sqlalchemy.select(sqlalchemy.func.count(like_table.c.id)).where(
+                like_table.c.post_id == 1
+            ),
+            "ix_likes_post_id_user_id",
+        ),
+        (
+            like_table.select().where(
+                (like_table.c.post_id == 1) & (like_table.c.user_id == 1)
+            ),
+            "ix_likes_post_id_user_id",
+        ),
+        (like_table.select().where(like_table.c.user_id == 1), "ix_likes_user_id"),
+        (post_table.select().where(post_table.c.user_id == 1), "ix_posts_user_id"),
+        (
+            sqlalchemy.select(post_table.c.id)
+            .order_by(post_table.c.like_count.desc(), post_table.c.id.desc())
+            .limit(20),
+            "ix_posts_like_count_id",
+        ),
+    ],
+)
+async def test_query_uses_index(query, index: str):
+    plan = await query_plan(query)
+    assert f"INDEX {index}" in plan
+
+
+@pytest.mark.anyio
+async def test_duplicate_like_rejected(confirmed_user: dict):
+    user_id = confirmed_user["id"]
+    await database.execute(post_table.insert().values(id=1, body="", user_id=user_id))
+    await database.execute(like_table.insert().values(post_id=1, user_id=user_id))
+
+    with pytest.raises(Exception, match="UNIQUE"):
+        await database.execute(like_table.insert().values(post_id=1, user_id=user_id))
+
+
+def test_check_dialect():
+    check_dialect("sqlite:///data.db")
+    check_dialect("postgresql://user@localhost/storeapi")
+
+    with pytest.raises(ValueError, match="Unsupported database 'mysql'"):
+        check_dialect("mysql://user@localhost/storeapi")
@@ -0,0 +1,184 @@
+import asyncio
+
+import aiosqlite
+import databases
+import pytest
+import sqlalchemy
+from prometheus_client import REGISTRY
+from storeapi.config import config
+from storeapi.database import database_pool
+from storeapi.db_pool import (
+    PoolTimeoutError,
+    configure_sqlite_engine,
+    database_options,
+    engine_options,
+    monitor_pool,
+    sqlite_pragmas,
+)
+
+
+@pytest.fixture()
+async def small_pool_database(tmp_path):
+    url = f"sqlite:///{tmp_path}/pool.db"
+    engine = sqlalchemy.create_engine(url)
+    configure_sqlite_engine(engine)
+    engine.dispose()
+    database = databases.Database(url)
+    backend = monitor_pool(database, max_size=2, acquire_timeout=0.1, name="small")
+    await database.connect()
+    yield database, backend
+    await database.disconnect()
+
+
+def test_database_options_postgres(mocker):
+    mocker.patch.object(config, "DB_POOL_MAX_SIZE", 25)
+    mocker.patch.object(config, "DB_STATEMENT_TIMEOUT_SECONDS", 1.5)
+
+    options = database_options("postgresql://user@localhost/storeapi")
+
+    assert options["max_size"] == 25
+    assert options["server_settings"] == {"statement_timeout": "1500"}
+
+
+def test_database_options_sqlite():
+    assert database_options("sqlite:///data.db") == {}
+
+
+def test_engine_options_are_backend_aware():
+    options = engine_options("sqlite:///data.db")
+    assert options["connect_args"]["check_same_thread"] is False
+
+    options = engine_options("postgresql://user@localhost/storeapi")
+    assert options["pool_size"] == config.DB_POOL_MAX_SIZE
+    assert "check_same_thread" not in options["connect_args"]
+
+
+@pytest.mark.anyio
+async def test_pool_counts_connections():
+    stats = database_pool.stats
+
+    # Tests share one connection, held for the whole test
+    assert stats.in_use == 1
+    assert stats.max_size == config.DB_POOL_MAX_SIZE
+    assert stats.acquired >= 1
+
+
+@pytest.mark.anyio
+async def test_pool_caps_connections_in_use(small_pool_database):
+    database, backend = small_pool_database
+    in_use = []
+    labels = {"pool": "small"}
+    waits = REGISTRY.get_sample_value("db_pool_acquire_duration_seconds_count", labels)
+
+    async def query():
+        async with database.connection() as connection:
+            in_use.append(backend.stats.in_use)
+            await asyncio.sleep(0.02)
+            await connection.fetch_val("SELECT 1")
+
+    await asyncio.gather(*(query() for _ in range(6)))
+
+    assert max(in_use) == 2
+    assert backend.stats.in_use == 0
+    assert backend.stats.acquired == 6
+    assert (
+        REGISTRY.get_sample_value("db_pool_acquire_duration_seconds_count", labels)
+        == (waits or 0) + 6
+    )
+    assert REGISTRY.get_sample_value("db_pool_connections_in_use", labels) == 0
+
+
+@pytest.mark.anyio
+async def test_pool_acquire_times_out(small_pool_database):
+    database, backend = small_pool_database
+    held = asyncio.Event()
+    done = asyncio.Event()
+
+    async def hold():
+        async with database.connection():
+            held.set()
+            await done.wait()
+
+    holders = [asyncio.create_task(hold()) for _ in range(2)]
+    await held.wait()
+    await asyncio.sleep(0.01)
+
+    with pytest.raises(PoolTimeoutError):
+        async with database.connection():
+            pass
+
+    done.set()
+    await asyncio.gather(*holders)
+    assert backend.stats.timeouts == 1
+    assert backend.stats.waiting == 0
+
+
+@pytest.mark.anyio
+async def test_pool_queries_still_work(small_pool_database):
+    database, _ = small_pool_database
+    await database.execute("CREATE TABLE items (id INTEGER PRIMARY KEY)")
+    await database.execute_many(
+        "INSERT INTO items (id) VALUES (:id)", [{"id": 1}, {"id": 2}]
+    )
+
+    rows = [row async for row in database.iterate("SELECT id FROM items")]
+
+    assert [row.id for row in rows] == [1, 2]
+
+
+@pytest.mark.anyio
+async def test_sqlite_pragmas_applied_to_each_connection(small_pool_database):
+    database, _ = small_pool_database
+
+    async with database.connection() as connection:
+        journal_mode = await connection.fetch_val("PRAGMA journal_mode")
+        synchronous = await connection.fetch_val("PRAGMA synchronous")
+        busy_timeout = await connection.fetch_val("PRAGMA busy_timeout")
+        mmap_size = await connection.fetch_val("PRAGMA mmap_size")
+        cache_size = await connection.fetch_val("PRAGMA cache_size")
+
+    assert journal_mode == "wal"
+    assert synchronous == 1  # NORMAL
+    assert busy_timeout == config.SQLITE_BUSY_TIMEOUT_MS
+    assert mmap_size == config.SQLITE_MMAP_SIZE
+    assert cache_size == -config.SQLITE_CACHE_SIZE_KB
+
+
+@pytest.mark.anyio
+async def test_sqlite_wal_can_be_disabled(tmp_path, mocker):
+    mocker.patch.object(config, "SQLITE_WAL", False)
+    mocker.patch.object(config, "SQLITE_SYNCHRONOUS", "FULL")
+    url = f"sqlite:///{tmp_path}/rollback.db"
+    configure_sqlite_engine(sqlalchemy.create_engine(url))
+    database = databases.Database(url)
+    monitor_pool(database)
+
+    async with database:
+        journal_mode = await database.fetch_val("PRAGMA journal_mode")
+        synchronous = await database.fetch_val("PRAGMA synchronous")
+
+    assert journal_mode == "delete"
+    assert synchronous == 2  # FULL
+
+
+@pytest.mark.anyio
+async def test_journal_mode_is_not_set_per_connection(small_pool_database, mocker):
+    database, _ = small_pool_database
+    execute = mocker.spy(aiosqlite.Connection, "execute")
+
+    await database.fetch_val("SELECT 1")
+
+    statements = [call.args[1] for call in execute.call_args_list]
+    assert [s for s in statements if s.startswith("PRAGMA")] == sqlite_pragmas()
+
+
+def test_sqlite_pragmas_applied_to_engine(tmp_path):
+    engine = sqlalchemy.create_engine(f"sqlite:///{tmp_path}/engine.db")
+    configure_sqlite_engine(engine)
+
+    with engine.connect() as connection:
+        journal_mode = connection.exec_driver_sql("PRAGMA journal_mode").scalar()
+        busy_timeout = connection.exec_driver_sql("PRAGMA busy_timeout").scalar()
+
+    assert journal_mode == "wal"
+    assert busy_timeout == config.SQLITE_BUSY_TIMEOUT_MS
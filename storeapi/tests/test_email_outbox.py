@@ -0,0 +1,189 @@
+import asyncio
+import functools
+import json
+from urllib.parse import parse_qs
+
+import httpx
+import pytest
+from storeapi.config import config
+from storeapi.email_outbox import Email, EmailOutbox
+from storeapi.tasks import send_batch_email
+
+
+class FakeMailgun:
+    """Stands in for the Mailgun messages API, failing the first `failures` calls."""
+
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.messages = []
+
+    def handler(self, request: httpx.Request) -> httpx.Response:
+        if self.failures:
+            self.failures -= 1
+            return httpx.Response(503)
+        form = parse_qs(request.content.decode())
+        self.messages.append(
+            {
+                "to": form["to"],
+                "subject": form["subject"][0],
+                "text": form["text"][0],
+                "recipient-variables": json.loads(form["recipient-variables"][0]),
+            }
+        )
+        return httpx.Response(200, json={"message": "Queued. Thank you."})
+
+
+@pytest.fixture()
+async def fake_mailgun(mocker):
+    mocker.patch.object(config, "MAILGUN_API_KEY", "key")
+    mailgun = FakeMailgun()
+    async with httpx.AsyncClient(
+        base_url="https://api.mailgun.net",
+        transport=httpx.MockTransport(mailgun.handler),
+    ) as client:
+        mailgun.send_batch = functools.partial(send_batch_email, client=client)
+        yield mailgun
+
+
+def welcome(to: str) -> Email:
+    return Email(
+        to=to,
+        subject="Welcome",
+        body="Hi %recipient.name%!",
+        variables={"name": to.split("@")[0]},
+    )
+
+
+def test_email_render():
+    assert welcome("jose@example.net").render() == "Hi jose!"
+
+
+@pytest.mark.anyio
+async def test_flush_coalesces_by_subject_and_body(fake_mailgun):
+    outbox = EmailOutbox(fake_mailgun.send_batch)
+    await outbox.flush(
+        [
+            welcome("a@example.net"),
+            welcome("b@example.net"),
+            Email(to="c@example.net", subject="Other", body="Hello"),
+        ]
+    )
+
+    assert len(fake_mailgun.messages) == 2
+    assert fake_mailgun.messages[0] == {
+        "to": ["a@example.net", "b@example.net"],
+        "subject": "Welcome",
+        "text": "Hi %recipient.name%!",
+        "recipient-variables": {
+            "a@example.net": {"name": "a"},
+            "b@example.net": {"name": "b"},
+        },
+    }
+    assert fake_mailgun.messages[1]["to"] == ["c@example.net"]
+
+
+@pytest.mark.anyio
+async def test_flush_splits_full_batches_and_repeated_recipients(fake_mailgun):
+    outbox = EmailOutbox(fake_mailgun.send_batch, max_batch_size=2)
+    await outbox.flush(
+        [
+            welcome("a@example.net"),
+            welcome("a@example.net"),
+            welcome("b@example.net"),
+            welcome("c@example.net"),
+        ]
+    )
+
+    assert [message["to"] for message in fake_mailgun.messages] == [
+        ["a@example.net"],
+        ["a@example.net", "b@example.net"],
+        ["c@example.net"],
+    ]
+
+
+@pytest.mark.anyio
+async def test_outbox_flushes_when_batch_is_full(fake_mailgun):
+    outbox = EmailOutbox(fake_mailgun.send_batch, max_batch_size=2, flush_interval=60)
+    outbox.start()
+    await outbox.put(welcome("a@example.net"))
+    await outbox.put(welcome("b@example.net"))
+    await asyncio.sleep(0.01)
+
+    assert len(fake_mailgun.messages) == 1
+    await outbox.stop()
+
+
+@pytest.mark.anyio
+async def test_outbox_flushes_after_interval(fake_mailgun):
+    outbox = EmailOutbox(fake_mailgun.send_batch, flush_interval=0.05)
+    outbox.start()
+    await outbox.put(welcome("a@example.net"))
+    await asyncio.sleep(0.01)
+    assert fake_mailgun.messages == []
+
+    await asyncio.sleep(0.1)
+    assert len(fake_mailgun.messages) == 1
+    await outbox.stop()
+
+
+@pytest.mark.anyio
+async def test_outbox_stop_sends_queued_emails(fake_mailgun):
+    outbox = EmailOutbox(fake_mailgun.send_batch, flush_interval=60)
+    outbox.start()
+    await outbox.put(welcome("a@example.net"))
+    await outbox.stop()
+
+    assert len(fake_mailgun.messages) == 1
+    assert not outbox.running
+
+
+@pytest.mark.anyio
+async def test_outbox_retries_failed_batches(fake_mailgun):
+    fake_mailgun.failures = 2
+    outbox = EmailOutbox(fake_mailgun.send_batch, retry_base_delay=0.001)
+    outbox.start()
+    await outbox.put(welcome("a@example.net"))
+    await outbox.stop()
+
+    assert len(fake_mailgun.messages) == 1
+
+
+@pytest.mark.anyio
+async def test_outbox_gives_up_after_max_retries(fake_mailgun):
+    fake_mailgun.failures = 3
+    outbox = EmailOutbox(fake_mailgun.send_batch, max_retries=2, retry_base_delay=0)
+    outbox.start()
+    await outbox.put(welcome("a@example.net"))
+    await outbox.stop()
+
+    assert fake_mailgun.messages == []
+
+
+@pytest.mark.anyio
+async def test_outbox_sends_new_emails_while_retry_is_pending(fake_mailgun):
+    fake_mailgun.failures = 1
+    outbox = EmailOutbox(
+        fake_mailgun.send_batch, flush_interval=0.01, retry_base_delay=0.5
+    )
+    outbox.start()
+    await outbox.put(welcome("a@example.net"))
+    await asyncio.sleep(0.05)
+    await outbox.put(Email(to="b@example.net", subject="Other", body="Hello"))
+    await asyncio.sleep(0.05)
+
+    assert [message["to"] for message in fake_mailgun.messages] == [["b@example.net"]]
+    await outbox.stop()
+    assert [message["to"] for message in fake_mailgun.messages] == [
+        ["b@example.net"],
+        ["a@example.net"],
+    ]
+
+
+@pytest.mark.anyio
+async def test_outbox_put_waits_when_queue_is_full(fake_mailgun):
+    outbox = EmailOutbox(fake_mailgun.send_batch, max_queue_size=1)
+    await outbox.put(welcome("a@example.net"))
+
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(outbox.put(welcome("b@example.net")), 0.01)
+    assert outbox.queue_depth == 1
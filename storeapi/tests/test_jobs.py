@@ -0,0 +1,170 @@
+import asyncio
+
+import pytest
+from storeapi import jobs
+from storeapi.database import database
+from storeapi.jobs import JobStatus, JobWorker, claim_job, enqueue_job, get_job
+
+
+@pytest.fixture()
+def handler(mocker):
+    handler = mocker.AsyncMock()
+    mocker.patch.dict(jobs.handlers, {"test": handler})
+    return handler
+
+
+@pytest.fixture()
+def clock(mocker):
+    return mocker.patch("storeapi.jobs.now", return_value=1000.0)
+
+
+@pytest.mark.anyio
+async def test_enqueue_job(handler):
+    job_id = await enqueue_job(database, "test", {"value": 1})
+
+    job = await get_job(database, job_id)
+    assert job.status == JobStatus.queued
+    assert job.attempts == 0
+
+
+@pytest.mark.anyio
+async def test_enqueue_unknown_job():
+    with pytest.raises(ValueError):
+        await enqueue_job(database, "unknown", {})
+
+
+@pytest.mark.anyio
+async def test_claim_job_takes_oldest_once(handler, clock):
+    first = await enqueue_job(database, "test", {})
+    second = await enqueue_job(database, "test", {})
+
+    job = await claim_job(database, "worker-1", visibility_timeout=60)
+    assert job.id == first
+    assert job.status == JobStatus.running
+    assert job.attempts == 1
+    assert job.locked_by == "worker-1"
+
+    assert (await claim_job(database, "worker-2", visibility_timeout=60)).id == second
+    assert await claim_job(database, "worker-3", visibility_timeout=60) is None
+
+
+@pytest.mark.anyio
+async def test_claim_job_after_visibility_timeout(handler, clock):
+    job_id = await enqueue_job(database, "test", {})
+    await claim_job(database, "worker-1", visibility_timeout=60)
+
+    clock.return_value += 61
+    job = await claim_job(database, "worker-2", visibility_timeout=60)
+    assert job.id == job_id
+    assert job.locked_by == "worker-2"
+    assert job.attempts == 2
+
+
+@pytest.mark.anyio
+async def test_worker_runs_job(handler):
+    job_id = await enqueue_job(database, "test", {"value": 1})
+
+    assert await JobWorker(database).run_pending() == 1
+
+    handler.assert_awaited_once_with(database=database, value=1)
+    assert (await get_job(database, job_id)).status == JobStatus.succeeded
+
+
+@pytest.mark.anyio
+async def test_worker_retries_failed_job(handler, clock):
+    handler.side_effect = [RuntimeError("boom"), None]
+    job_id = await enqueue_job(database, "test", {})
+    worker = JobWorker(database, retry_base_delay=10)
+
+    assert await worker.run_pending() == 1
+    job = await get_job(database, job_id)
+    assert job.status == JobStatus.queued
+    assert job.last_error == "RuntimeError: boom"
+    assert job.visible_at > clock.return_value
+
+    # Not runnable again until the retry delay has passed
+    assert await worker.run_pending() == 0
+    clock.return_value += 20
+    assert await worker.run_pending() == 1
+    assert (await get_job(database, job_id)).status == JobStatus.succeeded
+
+
+@pytest.mark.anyio
+async def test_worker_fails_job_after_max_attempts(handler):
+    handler.side_effect = RuntimeError("boom")
+    job_id = await enqueue_job(database, "test", {}, max_attempts=1)
+
+    assert await JobWorker(database).run_pending() == 1
+
+    job = await get_job(database, job_id)
+    assert job.status == JobStatus.failed
+    assert job.last_error == "RuntimeError: boom"
+
+
+@pytest.mark.anyio
+async def test_worker_runs_failure_handler_after_max_attempts(handler, mocker):
+    handler.side_effect = RuntimeError("boom")
+    failure_handler = mocker.AsyncMock()
+    mocker.patch.dict(jobs.failure_handlers, {"test": failure_handler})
+    await enqueue_job(database, "test", {"value": 1}, max_attempts=2)
+
+    assert await JobWorker(database, retry_base_delay=0).run_pending() == 2
+
+    failure_handler.assert_awaited_once_with(database=database, value=1)
+
+
+@pytest.mark.anyio
+async def test_late_result_ignored_after_job_reclaimed(handler, clock):
+    job_id = await enqueue_job(database, "test", {})
+    stale = await claim_job(database, "worker-1", visibility_timeout=60)
+    clock.return_value += 61
+    await claim_job(database, "worker-2", visibility_timeout=60)
+
+    await jobs.finish_job(database, stale, JobStatus.succeeded)
+
+    job = await get_job(database, job_id)
+    assert job.status == JobStatus.running
+    assert job.locked_by == "worker-2"
+
+
+@pytest.mark.anyio
+async def test_fail_abandoned_jobs(handler, clock):
+    job_id = await enqueue_job(database, "test", {}, max_attempts=1)
+    await claim_job(database, "worker-1", visibility_timeout=60)
+
+    clock.return_value += 61
+    await jobs.fail_abandoned_jobs(database)
+
+    job = await get_job(database, job_id)
+    assert job.status == JobStatus.failed
+    assert job.last_error == "Timed out"
+
+
+@pytest.mark.anyio
+async def test_worker_runs_failure_handler_of_abandoned_jobs(handler, clock, mocker):
+    failure_handler = mocker.AsyncMock()
+    mocker.patch.dict(jobs.failure_handlers, {"test": failure_handler})
+    await enqueue_job(database, "test", {"value": 1}, max_attempts=1)
+    await claim_job(database, "worker-1", visibility_timeout=60)
+
+    clock.return_value += 61
+    await JobWorker(database).fail_abandoned_jobs()
+    await JobWorker(database).fail_abandoned_jobs()
+
+    failure_handler.assert_awaited_once_with(database=database, value=1)
+
+
+@pytest.mark.anyio
+async def test_worker_run_forever(handler):
+    await enqueue_job(database, "test", {})
+    await enqueue_job(database, "test", {})
+    worker = JobWorker(database, concurrency=2, poll_interval=0.01)
+
+    worker.start()
+    for _ in range(100):
+        if handler.await_count == 2:
+            break
+        await asyncio.sleep(0.01)
+    await worker.stop()
+
+    assert handler.await_count == 2
@@ -0,0 +1,129 @@
+import contextvars
+import json
+import logging
+import queue
+
+import pytest
+from storeapi import logging_conf
+from storeapi.logging_conf import DroppingQueueHandler, LogPipeline
+
+request_id = contextvars.ContextVar("request_id", default="-")
+
+
+class ListHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id.get()
+        return True
+
+
+def make_record(message: str) -> logging.LogRecord:
+    return logging.LogRecord("test", logging.INFO, __file__, 1, message, None, None)
+
+
+@pytest.fixture()
+def restore_loggers():
+    names = logging_conf.PIPELINE_LOGGERS + ["test_pipeline"]
+    loggers = [logging.getLogger(name) for name in names]
+    saved = [
+        (logger, logger.handlers[:], logger.level, logger.propagate)
+        for logger in loggers
+    ]
+    yield
+    logging_conf.shutdown_logging()
+    for logger, handlers, level, propagate in saved:
+        logger.handlers = handlers
+        logger.setLevel(level)
+        logger.propagate = propagate
+
+
+@pytest.mark.parametrize(
+    "policy, kept",
+    [("drop_newest", "first"), ("drop_oldest", "third"), ("block", "first")],
+)
+def test_full_queue_drops_records(policy: str, kept: str):
+    handler = DroppingQueueHandler(
+        queue.Queue(1), route="test", policy=policy, block_seconds=0.01
+    )
+
+    for message in ("first", "second", "third"):
+        handler.handle(make_record(message))
+
+    assert handler.dropped == 2
+    assert handler.queue.get_nowait().getMessage() == kept
+
+
+def test_pipeline_writes_from_background_thread(restore_loggers):
+    logger = logging.getLogger("test_pipeline")
+    logger.setLevel(logging.INFO)
+    target = ListHandler()
+    target.addFilter(RequestIdFilter())
+    logger.handlers = [target]
+
+    pipeline = LogPipeline(["test_pipeline"])
+    pipeline.start()
+    token = request_id.set("abc123")
+    logger.info("Hello %s", "world")
+    request_id.reset(token)
+    pipeline.stop()
+
+    [record] = target.records
+    assert record.getMessage() == "Hello world"
+    # The filter ran when the record was logged, not on the listener thread
+    assert record.request_id == "abc123"
+    assert target.filters == []
+    assert pipeline.dropped == 0
+
+
+def test_pipeline_routes_records_to_their_logger_handlers(restore_loggers):
+    first, second = ListHandler(), ListHandler()
+    logging.getLogger("uvicorn").handlers = [first]
+    logging.getLogger("test_pipeline").handlers = [second]
+    logging.getLogger("test_pipeline").setLevel(logging.INFO)
+
+    pipeline = LogPipeline(["uvicorn", "test_pipeline"])
+    pipeline.start()
+    logging.getLogger("test_pipeline").info("Only for the second handler")
+    pipeline.stop()
+
+    assert first.records == []
+    assert len(second.records) == 1
+
+
+def test_configure_logging(restore_loggers, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    logging_conf.configure_logging()
+    logging.getLogger("storeapi.test").warning(
+        "User signed up", extra={"email": "someone@example.net"}
+    )
+    logging_conf.shutdown_logging()
+
+    [line] = (tmp_path / "storeapi.log").read_text().splitlines()
+    record = json.loads(line)
+    assert record["message"] == "User signed up"
+    assert record["correlation_id"] == "-"
+    assert record["email"] != "someone@example.net"
+
+
+def test_configure_logging_queues_access_log(restore_loggers, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    logging_conf.configure_logging()
+    access_logger = logging.getLogger("uvicorn.access")
+    access_logger.info("GET / 200")
+    logging_conf.shutdown_logging()
+
+    assert [type(handler) for handler in access_logger.handlers] == [
+        DroppingQueueHandler
+    ]
+    [line] = (tmp_path / "storeapi.log").read_text().splitlines()
+    assert json.loads(line)["message"] == "GET / 200"
@@ -0,0 +1,43 @@
+import os
+import subprocess
+import sys
+
+from storeapi.metrics import latest_metrics
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORKER = """
+import sys
+from storeapi.metrics import http_requests, http_requests_in_progress
+from storeapi.metrics import mark_process_dead
+
+http_requests.labels("GET", "/post", "200").inc()
+http_requests_in_progress.inc()
+if sys.argv[1] == "exited":
+    mark_process_dead()
+"""
+
+
+def run_worker(metrics_dir: str, state: str):
+    env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": metrics_dir}
+    subprocess.run([sys.executable, "-c", WORKER, state], cwd=ROOT, env=env, check=True)
+
+
+def test_latest_metrics_adds_up_processes(tmp_path, monkeypatch):
+    run_worker(str(tmp_path), "running")
+    run_worker(str(tmp_path), "exited")
+    monkeypatch.setenv("PROMETHEUS_MULTIPROC_DIR", str(tmp_path))
+
+    text = latest_metrics().decode()
+
+    assert 'http_requests_total{method="GET",route="/post",status="200"} 2.0' in text
+    # The gauge of the process that marked itself dead is dropped
+    assert "\nhttp_requests_in_progress 1.0" in text
+
+
+def test_latest_metrics_of_this_process(monkeypatch):
+    monkeypatch.delenv("PROMETHEUS_MULTIPROC_DIR", raising=False)
+
+    text = latest_metrics().decode()
+
+    assert "# TYPE http_requests_in_progress gauge" in text
@@ -0,0 +1,61 @@
+import logging
+
+import pytest
+from storeapi import query_logging
+from storeapi.database import post_table
+from storeapi.query_logging import compiled_sql, log_query
+
+logger = logging.getLogger("tests.query_logging")
+
+
+@pytest.fixture(autouse=True)
+def clear_compiled_sql():
+    query_logging._compiled_sql.clear()
+
+
+def test_compiled_sql_is_cached_per_statement_shape():
+    hits = query_logging._compiled_sql.hits
+    first = compiled_sql(post_table.select().where(post_table.c.id == 1))
+    second = compiled_sql(post_table.select().where(post_table.c.id == 2))
+    other = compiled_sql(post_table.select().where(post_table.c.user_id == 1))
+
+    assert first == second
+    assert "posts.id = :id_1" in first
+    assert other != first
+    assert query_logging._compiled_sql.hits == hits + 1
+    assert len(query_logging._compiled_sql) == 2
+
+
+def test_log_query_logs_sql_and_duration(caplog):
+    query = post_table.select().where(post_table.c.id == 1)
+
+    with caplog.at_level(logging.DEBUG, logger=logger.name):
+        with log_query(logger, query):
+            pass
+
+    [record] = caplog.records
+    assert record.getMessage().startswith(compiled_sql(query))
+    assert record.getMessage().endswith(" ms]")
+    assert record.duration_ms >= 0
+
+
+def test_log_query_logs_failed_queries(caplog):
+    query = post_table.select()
+
+    with caplog.at_level(logging.DEBUG, logger=logger.name):
+        with pytest.raises(RuntimeError):
+            with log_query(logger, query):
+                raise RuntimeError("Database is gone")
+
+    assert len(caplog.records) == 1
+
+
+def test_log_query_does_nothing_unless_debug_is_enabled(caplog, mocker):
+    compile = mocker.patch("storeapi.query_logging.compiled_sql")
+
+    with caplog.at_level(logging.INFO, logger=logger.name):
+        with log_query(logger, post_table.select()):
+            pass
+
+    assert caplog.records == []
+    compile.assert_not_called()
@@ -0,0 +1,143 @@
+import time
+
+import pytest
+from storeapi.replicas import ReplicaRouter, RequestWrites, _request_writes
+
+
+class FakeDatabase:
+    def __init__(self, name: str, fail: bool = False):
+        self.name = name
+        self.fail = fail
+        self.queries = []
+        self.is_connected = False
+
+    async def connect(self):
+        if self.fail:
+            raise ConnectionError(f"{self.name} is down")
+        self.is_connected = True
+
+    async def disconnect(self):
+        self.is_connected = False
+
+    async def fetch_all(self, query):
+        if self.fail:
+            raise ConnectionError(f"{self.name} is down")
+        self.queries.append(query)
+        return [self.name]
+
+    async def fetch_one(self, query):
+        return (await self.fetch_all(query))[0]
+
+    async def fetch_val(self, query):
+        return (await self.fetch_all(query))[0]
+
+
+@pytest.mark.anyio
+async def test_without_replicas_reads_from_primary():
+    router = ReplicaRouter(FakeDatabase("primary"), [])
+
+    assert await router.fetch_all("SELECT 1") == ["primary"]
+
+
+@pytest.mark.anyio
+async def test_round_robin():
+    router = ReplicaRouter(
+        FakeDatabase("primary"), [FakeDatabase("a"), FakeDatabase("b")]
+    )
+
+    names = [await router.fetch_one("SELECT 1") for _ in range(4)]
+
+    assert names == ["a", "b", "a", "b"]
+
+
+def test_least_busy():
+    router = ReplicaRouter(
+        FakeDatabase("primary"),
+        [FakeDatabase("a"), FakeDatabase("b"), FakeDatabase("c")],
+        selection="least_busy",
+    )
+    router._in_flight = [3, 1, 2]
+
+    assert router.choose_replica() == 1
+
+
+@pytest.mark.anyio
+async def test_failed_replica_falls_back_to_primary():
+    broken = FakeDatabase("a", fail=True)
+    router = ReplicaRouter(FakeDatabase("primary"), [broken, FakeDatabase("b")])
+
+    first = await router.fetch_val("SELECT 1")
+    # The broken replica sits out, so reads go to the other one
+    rest = [await router.fetch_val("SELECT 1") for _ in range(3)]
+
+    assert first == "primary"
+    assert rest == ["b", "b", "b"]
+
+
+@pytest.mark.anyio
+async def test_failed_replica_is_retried_later():
+    broken = FakeDatabase("a", fail=True)
+    router = ReplicaRouter(FakeDatabase("primary"), [broken], retry_seconds=0)
+
+    await router.fetch_val("SELECT 1")
+    broken.fail = False
+
+    assert await router.fetch_val("SELECT 1") == "a"
+
+
+@pytest.mark.anyio
+async def test_recent_writer_reads_from_primary():
+    router = ReplicaRouter(FakeDatabase("primary"), [FakeDatabase("a")])
+
+    router.record_write("writer@example.net")
+
+    assert await router.fetch_val("SELECT 1", "writer@example.net") == "primary"
+    assert await router.fetch_val("SELECT 1", "other@example.net") == "a"
+    assert await router.fetch_val("SELECT 1") == "a"
+
+
+@pytest.mark.anyio
+async def test_stickiness_expires():
+    router = ReplicaRouter(
+        FakeDatabase("primary"), [FakeDatabase("a")], sticky_seconds=0
+    )
+
+    router.record_write("writer@example.net")
+
+    assert await router.fetch_val("SELECT 1", "writer@example.net") == "a"
+
+
+@pytest.mark.anyio
+async def test_connect_skips_unreachable_replica():
+    router = ReplicaRouter(
+        FakeDatabase("primary"), [FakeDatabase("a", fail=True), FakeDatabase("b")]
+    )
+
+    await router.connect()
+
+    assert router.choose_replica() == 1
+    await router.disconnect()
+
+
+@pytest.mark.anyio
+async def test_last_write_cookie_reads_from_primary():
+    router = ReplicaRouter(FakeDatabase("primary"), [FakeDatabase("a")])
+    token = _request_writes.set(RequestWrites(last_write=time.time()))
+    try:
+        assert await router.fetch_val("SELECT 1") == "primary"
+    finally:
+        _request_writes.reset(token)
+
+    assert await router.fetch_val("SELECT 1") == "a"
+
+
+@pytest.mark.anyio
+async def test_old_last_write_cookie_reads_from_replica():
+    router = ReplicaRouter(
+        FakeDatabase("primary"), [FakeDatabase("a")], sticky_seconds=10
+    )
+    token = _request_writes.set(RequestWrites(last_write=time.time() - 11))
+    try:
+        assert await router.fetch_val("SELECT 1") == "a"
+    finally:
+        _request_writes.reset(token)
@@ -0,0 +1,108 @@
+import asyncio
+import logging
+
+import pytest
+from httpx import AsyncClient
+from storeapi.database import database, post_table
+from storeapi.request_timing import (
+    RequestTimings,
+    _timings,
+    current_timings,
+    timed_db_query,
+    timed_external_call,
+)
+from storeapi.security import create_confirmation_token
+
+
+@pytest.fixture()
+async def timings():
+    timings = RequestTimings()
+    token = _timings.set(timings)
+    yield timings
+    _timings.reset(token)
+
+
+def test_nothing_is_timed_outside_requests():
+    with timed_db_query():
+        pass
+    with timed_external_call("b2"):
+        pass
+
+    assert current_timings() is None
+
+
+@pytest.mark.anyio
+async def test_timed_external_call_adds_up_per_target(timings, mocker):
+    mocker.patch("storeapi.request_timing.time.perf_counter", side_effect=[1, 3, 4, 5])
+
+    with timed_external_call("b2"):
+        pass
+    with timed_external_call("b2"):
+        pass
+
+    assert timings.external_seconds == {"b2": 3}
+
+
+def test_server_timing():
+    timings = RequestTimings()
+    timings.db_queries = 2
+    timings.db_seconds = 0.0125
+    timings.external_seconds["b2"] = 0.5
+
+    metrics = timings.server_timing().split(", ")
+
+    assert metrics[:2] == ['db;dur=12.50;desc="2 queries"', "b2;dur=500.00"]
+    assert metrics[2].startswith("total;dur=")
+
+
+@pytest.mark.anyio
+async def test_database_queries_are_timed(timings):
+    await database.execute_many(
+        post_table.insert(),
+        [{"body": "First", "user_id": 1}, {"body": "Second", "user_id": 1}],
+    )
+    await database.fetch_all(post_table.select())
+    async for _ in database.iterate(post_table.select()):
+        pass
+
+    assert timings.db_queries == 4
+    assert timings.db_seconds > 0
+
+
+@pytest.mark.anyio
+async def test_timings_are_shared_with_child_tasks(timings):
+    async def query():
+        await database.fetch_val(post_table.select())
+
+    await asyncio.gather(query(), query())
+
+    assert timings.db_queries == 2
+
+
+@pytest.mark.anyio
+async def test_request_timings_are_sent_and_logged(
+    async_client: AsyncClient, registered_user: dict, caplog
+):
+    with caplog.at_level(logging.INFO, logger="storeapi.request_timing"):
+        token = create_confirmation_token(registered_user["email"])
+        response = await async_client.get(f"/confirm/{token}")
+
+    assert response.status_code == 200
+    assert response.headers["server-timing"].startswith("db;dur=")
+    [record] = [r for r in caplog.records if r.name == "storeapi.request_timing"]
+    assert record.getMessage() == "GET /confirm/{token} 200"
+    assert record.route == "/confirm/{token}"
+    assert record.status_code == 200
+    assert record.db_queries >= 1
+    assert record.duration_ms >= record.db_ms
+
+
+@pytest.mark.anyio
+async def test_unmatched_requests_are_logged_by_path(async_client: AsyncClient, caplog):
+    with caplog.at_level(logging.INFO, logger="storeapi.request_timing"):
+        response = await async_client.get("/missing")
+
+    assert response.status_code == 404
+    [record] = [r for r in caplog.records if r.name == "storeapi.request_timing"]
+    assert record.getMessage() == "GET /missing 404"
+    assert record.route is None
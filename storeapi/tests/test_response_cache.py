@@ -0,0 +1,120 @@
+import pytest
+from starlette.requests import Request
+from storeapi.response_cache import (
+    CachedResponse,
+    InMemoryBackend,
+    ResponseCache,
+    etag_matches,
+)
+
+
+def make_request(if_none_match: str = None) -> Request:
+    headers = []
+    if if_none_match:
+        headers.append((b"if-none-match", if_none_match.encode()))
+    return Request({"type": "http", "path": "/post", "headers": headers})
+
+
+def make_cache(**kwargs) -> ResponseCache:
+    return ResponseCache(InMemoryBackend(maxsize=10, ttl=60), ttl=60, **kwargs)
+
+
+def counting_render():
+    calls = []
+
+    async def render():
+        calls.append(1)
+        return f"[{len(calls)}]".encode(), {"X-Next-Cursor": "abc"}
+
+    return render, calls
+
+
+@pytest.mark.anyio
+async def test_respond_caches_body_and_headers():
+    cache = make_cache()
+    render, calls = counting_render()
+
+    await cache.respond(make_request(), ["posts"], (), render)
+    response = await cache.respond(make_request(), ["posts"], (), render)
+
+    assert len(calls) == 1
+    assert response.body == b"[1]"
+    assert response.headers["X-Next-Cursor"] == "abc"
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+@pytest.mark.anyio
+async def test_respond_keys_on_params():
+    cache = make_cache()
+    render, calls = counting_render()
+
+    await cache.respond(make_request(), ["posts"], ("new",), render)
+    await cache.respond(make_request(), ["posts"], ("old",), render)
+
+    assert len(calls) == 2
+
+
+@pytest.mark.anyio
+async def test_invalidate_scope():
+    cache = make_cache()
+    render, calls = counting_render()
+    await cache.respond(make_request(), ["posts", "post:1"], (), render)
+
+    await cache.invalidate("post:2")
+    await cache.respond(make_request(), ["posts", "post:1"], (), render)
+    await cache.invalidate("post:1")
+    response = await cache.respond(make_request(), ["posts", "post:1"], (), render)
+
+    assert len(calls) == 2
+    assert response.body == b"[2]"
+
+
+@pytest.mark.anyio
+async def test_evicted_generation_is_not_reused():
+    backend = InMemoryBackend(maxsize=2, ttl=60)
+    cache = ResponseCache(backend, ttl=60)
+    render, calls = counting_render()
+    await cache.respond(make_request(), ["post:1"], (), render)
+
+    await cache.invalidate("post:1", "post:2", "post:3")
+    response = await cache.respond(make_request(), ["post:1"], (), render)
+
+    assert len(backend.generations) == 2
+    assert len(calls) == 2
+    assert response.body == b"[2]"
+
+
+@pytest.mark.anyio
+async def test_disabled_cache_still_sets_etag():
+    cache = make_cache(enabled=False)
+    render, calls = counting_render()
+
+    await cache.respond(make_request(), ["posts"], (), render)
+    response = await cache.respond(make_request(), ["posts"], (), render)
+
+    assert len(calls) == 2
+    assert response.headers["ETag"]
+
+
+def test_to_response_not_modified():
+    cached = CachedResponse(b"[]")
+
+    response = cached.to_response(make_request(cached.etag))
+
+    assert response.status_code == 304
+    assert response.body == b""
+
+
+@pytest.mark.parametrize(
+    "if_none_match, matches",
+    [
+        (None, False),
+        ('"a"', True),
+        ('W/"a"', True),
+        ('"b", "a"', True),
+        ("*", True),
+        ('"b"', False),
+    ],
+)
+def test_etag_matches(if_none_match, matches):
+    assert etag_matches(if_none_match, '"a"') is matches
@@ -1,6 +1,12 @@
+import asyncio
+import threading
+
 import pytest
 from jose import jwt
+from prometheus_client import REGISTRY
 from storeapi import security
+from storeapi.database import database
+from storeapi.replicas import ReplicaRouter
 
 
 def test_access_token_expire_minutes():
@@ -80,6 +86,52 @@ def test_password_hashes():
     assert security.verify_password(password, security.get_password_hash(password))
 
 
+@pytest.mark.anyio
+async def test_password_hashes_in_pool():
+    password = "password"
+    hashed_password = await security.hash_password(password)
+    assert await security.check_password(password, hashed_password)
+    assert not await security.check_password("wrong password", hashed_password)
+
+
+@pytest.mark.anyio
+async def test_password_hash_pool_queue_depth():
+    pool = security.PasswordHashPool(max_workers=1)
+    release = threading.Event()
+    depths = []
+    waits = REGISTRY.get_sample_value("password_hash_wait_seconds_count")
+
+    first = asyncio.ensure_future(pool.run(release.wait))
+    second = asyncio.ensure_future(pool.run(lambda: depths.append(pool.queue_depth)))
+    await asyncio.sleep(0.01)
+    assert pool.queue_depth == 1
+
+    release.set()
+    await asyncio.gather(first, second)
+    assert depths == [0]
+    assert pool.queue_depth == 0
+    assert pool.last_wait_seconds > 0
+    assert REGISTRY.get_sample_value("password_hash_wait_seconds_count") == waits + 2
+    assert REGISTRY.get_sample_value("password_hash_queue_depth") == 0
+
+
+@pytest.mark.anyio
+async def test_password_hash_pool_queue_depth_after_cancel():
+    pool = security.PasswordHashPool(max_workers=1)
+    release = threading.Event()
+
+    first = asyncio.ensure_future(pool.run(release.wait))
+    second = asyncio.ensure_future(pool.run(lambda: None))
+    await asyncio.sleep(0.01)
+    second.cancel()
+    await asyncio.gather(second, return_exceptions=True)
+
+    assert pool.queue_depth == 0
+    release.set()
+    await first
+    assert pool.queue_depth == 0
+
+
 @pytest.mark.anyio
 async def test_get_user(registered_user: dict):
     user = await security.get_user(registered_user["email"])
@@ -131,4 +183,67 @@ async def test_get_current_user_wrong_type_token(registered_user: dict):
     token = security.create_confirmation_token(registered_user["email"])
 
     with pytest.raises(security.HTTPException):
-        await security.get_current_user(token)
\ No newline at end of file
+        await security.get_current_user(token)
+
+
+@pytest.mark.anyio
+async def test_get_current_user_cached(registered_user: dict, mocker):
+    token = security.create_access_token(registered_user["email"])
+    await security.get_current_user(token)
+
+    spy = mocker.spy(security, "get_user")
+    user = await security.get_current_user(token)
+
+    assert user.email == registered_user["email"]
+    spy.assert_not_called()
+    assert security.user_cache.hits == 1
+
+
+@pytest.mark.anyio
+async def test_invalidate_user(registered_user: dict, mocker):
+    token = security.create_access_token(registered_user["email"])
+    await security.get_current_user(token)
+
+    security.invalidate_user(registered_user["email"])
+    spy = mocker.spy(security, "get_user")
+    await security.get_current_user(token)
+
+    spy.assert_called_once()
+
+
+def test_decode_token_cached(mocker):
+    token = security.create_access_token("test@example.com")
+    security.decode_token(token)
+
+    spy = mocker.spy(security.jwt, "decode")
+    security.decode_token(token)
+    spy.assert_not_called()
+
+    # Once the cached payload expires the token is decoded again
+    mocker.patch("storeapi.cache.time.monotonic", return_value=10**10)
+    security.decode_token(token)
+    spy.assert_called_once()
+
+
+class EmptyReplica:
+    """A replica that hasn't caught up with anything yet."""
+
+    async def fetch_one(self, query):
+        return None
+
+
+@pytest.mark.anyio
+async def test_auth_reads_users_from_primary(confirmed_user: dict, mocker):
+    mocker.patch(
+        "storeapi.security.read_database",
+        ReplicaRouter(database, [EmptyReplica()]),
+    )
+    token = security.create_access_token(confirmed_user["email"])
+
+    user = await security.authenticate_user(
+        confirmed_user["email"], confirmed_user["password"]
+    )
+    current_user = await security.get_current_user(token)
+
+    assert user.email == confirmed_user["email"]
+    assert current_user.email == confirmed_user["email"]
@@ -1,15 +1,59 @@
 import httpx
 import pytest
 from databases import Database
+from storeapi.config import config
 from storeapi.database import database, post_table
 from storeapi.tasks import (
     APIResponseError,
+    HTTPClientPool,
     _generate_cute_creature_api,
     generate_and_add_to_post,
+    send_image_generation_failed_email,
     send_simple_email,
+    send_user_registration_email,
 )
 
 
+@pytest.fixture()
+async def created_post(confirmed_user: dict) -> dict:
+    query = post_table.insert().values(body="Test Post", user_id=confirmed_user["id"])
+    post_id = await database.execute(query)
+    return {"id": post_id, "body": "Test Post", "user_id": confirmed_user["id"]}
+
+
+@pytest.mark.anyio
+async def test_http_client_pool_reuses_clients_per_host():
+    pool = HTTPClientPool()
+    client = pool.get("https://example.net")
+
+    assert pool.get("https://example.net") is client
+    assert pool.get("https://example.org") is not client
+    assert client.base_url == "https://example.net"
+
+    await pool.aclose()
+    assert client.is_closed
+    assert pool.get("https://example.net") is not client
+    await pool.aclose()
+
+
+@pytest.mark.anyio
+async def test_send_simple_email_with_client(mocker):
+    mocker.patch.object(config, "MAILGUN_API_KEY", "key")
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200)
+
+    async with httpx.AsyncClient(
+        base_url="https://api.mailgun.net", transport=httpx.MockTransport(handler)
+    ) as client:
+        await send_simple_email("test@example.net", "Subject", "Body", client=client)
+
+    assert len(requests) == 1
+    assert requests[0].url.path.endswith("/messages")
+
+
 @pytest.mark.anyio
 async def test_send_simple_email(mock_httpx_client):
     await send_simple_email("test@example.net", "Test Subject", "Test Body")
@@ -81,3 +125,75 @@ async def test_generate_and_add_to_post_success(
     updated_post = await database.fetch_one(query)
 
     assert updated_post.image_url == json_data["output_url"]
+
+
+@pytest.mark.anyio
+async def test_generate_and_add_to_post_api_error_propagates(
+    mock_httpx_client, created_post: dict, confirmed_user: dict, mocker
+):
+    send_email = mocker.patch("storeapi.tasks.send_email")
+    mock_httpx_client.post.return_value = httpx.Response(
+        status_code=500, content="", request=httpx.Request("POST", "//")
+    )
+
+    with pytest.raises(APIResponseError):
+        await generate_and_add_to_post(
+            confirmed_user["email"], created_post["id"], "/post/1", database
+        )
+
+    send_email.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_generate_and_add_to_post_skips_post_with_image(
+    created_post: dict, confirmed_user: dict, mocker
+):
+    generate = mocker.patch("storeapi.tasks._generate_cute_creature_api")
+    send_email = mocker.patch("storeapi.tasks.send_email")
+    await database.execute(
+        post_table.update()
+        .where(post_table.c.id == created_post["id"])
+        .values(image_url="https://example.com/image.jpg")
+    )
+
+    await generate_and_add_to_post(
+        confirmed_user["email"], created_post["id"], "/post/1", database
+    )
+
+    generate.assert_not_called()
+    send_email.assert_not_called()
+
+
+@pytest.mark.anyio
+async def test_send_image_generation_failed_email(mocker):
+    send_email = mocker.patch("storeapi.tasks.send_email")
+
+    await send_image_generation_failed_email(
+        "test@example.net", post_id=1, post_url="/post/1", database=database
+    )
+
+    assert send_email.call_args.args[0].subject == "Error generating image"
+
+
+@pytest.mark.anyio
+async def test_send_user_registration_email_queued(mocker):
+    outbox_put = mocker.patch("storeapi.tasks.email_outbox.put")
+    mocker.patch(
+        "storeapi.tasks.EmailOutbox.running",
+        new_callable=mocker.PropertyMock,
+        return_value=True,
+    )
+
+    await send_user_registration_email("test@example.net", "http://confirm")
+
+    email = outbox_put.call_args.args[0]
+    assert email.to == "test@example.net"
+    assert "http://confirm" in email.render()
+
+
+@pytest.mark.anyio
+async def test_send_user_registration_email_without_outbox(mock_httpx_client):
+    await send_user_registration_email("test@example.net", "http://confirm")
+
+    data = mock_httpx_client.post.call_args.kwargs["data"]
+    assert "http://confirm" in data["text"]